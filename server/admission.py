@@ -0,0 +1,256 @@
+import math
+import time
+import asyncio
+import threading
+from collections import OrderedDict, deque
+from functools import wraps
+
+from flask import Response
+from flask_jwt_extended import get_jwt_identity
+from prometheus_client import Counter, Gauge, Histogram
+
+from app import app
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "sidekick_admission_queue_depth",
+    "AI requests waiting for an upstream concurrency slot")
+ADMISSION_ACTIVE = Gauge(
+    "sidekick_admission_active_requests",
+    "AI requests holding an upstream concurrency slot")
+ADMISSION_WAIT_SECONDS = Histogram(
+    "sidekick_admission_wait_seconds",
+    "Time AI requests waited in the admission queue before being admitted",
+    ["route"])
+ADMISSION_REJECTED = Counter(
+    "sidekick_admission_rejected_total",
+    "AI requests rejected with 429, by reason (queue_full, user_queue_full or timeout)",
+    ["route", "reason"])
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Too many AI requests ({reason}), retry after {retry_after} seconds")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """
+    A request's place in the admission queue, and then its concurrency slot until released
+    """
+    def __init__(self, controller, user_id, route, notify):
+        self.controller = controller
+        self.user_id = user_id
+        self.route = route
+        self.notify = notify
+        self.granted = False
+        self.released = False
+        self.enqueued = controller.clock()
+        self.admitted = None
+
+    def release(self):
+        self.controller.release(self)
+
+
+class AdmissionController:
+    """
+    Limits the upstream AI calls a worker makes at the same time, in total and
+    per user. Requests over the limits wait in a fair queue: each time a slot
+    frees up the users with requests waiting take turns, so a user with a long
+    queue of requests only gets every other slot when one other user is waiting.
+    Requests are rejected straight away when the queue is full and after
+    waiting max_wait seconds.
+
+    A limit of 0 means no limit.
+    """
+    def __init__(self, max_concurrent=32, max_per_user=4, max_queue=100, max_queue_per_user=20,
+                 max_wait=30, clock=time.monotonic):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.max_queue = max_queue
+        self.max_queue_per_user = max_queue_per_user
+        self.max_wait = max_wait
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.active = 0
+        self.active_by_user = {}
+        self.waiting = OrderedDict()  # user_id -> deque of tickets, in the order users take turns
+        self.queued = 0
+        self.average_hold = 1.0  # moving average of the seconds a slot is held, to estimate Retry-After
+
+    def acquire(self, user_id, route):
+        """
+        Wait for a slot for the user's request. Returns the ticket to release
+        when the request has finished, or raises AdmissionRejected.
+        """
+        event = threading.Event()
+        ticket = self.enqueue(user_id, route, event.set)
+        if not ticket.granted and not event.wait(self.max_wait):
+            self.abandon(ticket)
+        return self._admit(ticket)
+
+    async def acquire_async(self, user_id, route):
+        """
+        acquire for a coroutine, which waits without blocking the event loop
+        """
+        loop = asyncio.get_running_loop()
+        admitted = loop.create_future()
+
+        def notify():
+            loop.call_soon_threadsafe(lambda: admitted.done() or admitted.set_result(True))
+
+        ticket = self.enqueue(user_id, route, notify)
+        if not ticket.granted:
+            try:
+                await asyncio.wait_for(asyncio.shield(admitted), self.max_wait)
+            except asyncio.TimeoutError:
+                self.abandon(ticket)
+            except asyncio.CancelledError:
+                with self.lock:
+                    if not ticket.granted:
+                        self._remove_waiting(ticket)
+                ticket.release()
+                raise
+        return self._admit(ticket)
+
+    def enqueue(self, user_id, route, notify):
+        with self.lock:
+            user_queue = self.waiting.get(user_id)
+            if self.max_queue and self.queued >= self.max_queue:
+                reason = "queue_full"
+            elif self.max_queue_per_user and user_queue and len(user_queue) >= self.max_queue_per_user:
+                reason = "user_queue_full"
+            else:
+                reason = None
+            if reason is not None:
+                retry_after = self._retry_after(user_id)
+            else:
+                ticket = Ticket(self, user_id, route, notify)
+                self.waiting.setdefault(user_id, deque()).append(ticket)
+                self.queued += 1
+                granted = self._dispatch()
+        if reason is not None:
+            ADMISSION_REJECTED.labels(route=route, reason=reason).inc()
+            raise AdmissionRejected(reason, retry_after)
+        self._notify(granted)
+        return ticket
+
+    def abandon(self, ticket):
+        """
+        Give up waiting, unless the ticket was granted a slot in the meantime
+        """
+        with self.lock:
+            if ticket.granted:
+                return
+            self._remove_waiting(ticket)
+            retry_after = self._retry_after(ticket.user_id)
+        ADMISSION_REJECTED.labels(route=ticket.route, reason="timeout").inc()
+        raise AdmissionRejected("timeout", retry_after)
+
+    def _admit(self, ticket):
+        ticket.admitted = self.clock()
+        ADMISSION_WAIT_SECONDS.labels(route=ticket.route).observe(ticket.admitted - ticket.enqueued)
+        return ticket
+
+    def release(self, ticket):
+        with self.lock:
+            if ticket.released or not ticket.granted:
+                ticket.released = True
+                return
+            ticket.released = True
+            self.active -= 1
+            self.active_by_user[ticket.user_id] -= 1
+            if not self.active_by_user[ticket.user_id]:
+                del self.active_by_user[ticket.user_id]
+            if ticket.admitted is not None:
+                self.average_hold += 0.1 * (self.clock() - ticket.admitted - self.average_hold)
+            granted = self._dispatch()
+        self._notify(granted)
+
+    def _dispatch(self):
+        """
+        Grant free slots to waiting requests, taking each user in turn. Returns the granted tickets.
+        """
+        granted = []
+        while self.waiting and not (self.max_concurrent and self.active >= self.max_concurrent):
+            user_id = next((user_id for user_id in self.waiting
+                            if not (self.max_per_user and
+                                    self.active_by_user.get(user_id, 0) >= self.max_per_user)), None)
+            if user_id is None:
+                break
+            user_queue = self.waiting.pop(user_id)
+            ticket = user_queue.popleft()
+            if user_queue:
+                self.waiting[user_id] = user_queue  # back of the line for the next turn
+            self.queued -= 1
+            self.active += 1
+            self.active_by_user[user_id] = self.active_by_user.get(user_id, 0) + 1
+            ticket.granted = True
+            granted.append(ticket)
+        ADMISSION_QUEUE_DEPTH.set(self.queued)
+        ADMISSION_ACTIVE.set(self.active)
+        return granted
+
+    def _notify(self, tickets):
+        for ticket in tickets:
+            ticket.notify()
+
+    def _remove_waiting(self, ticket):
+        user_queue = self.waiting.get(ticket.user_id)
+        if user_queue is None or ticket not in user_queue:
+            return
+        user_queue.remove(ticket)
+        if not user_queue:
+            del self.waiting[ticket.user_id]
+        self.queued -= 1
+        ADMISSION_QUEUE_DEPTH.set(self.queued)
+
+    def _retry_after(self, user_id):
+        """
+        Estimate the seconds until the user's next request would be admitted
+        """
+        if self.max_per_user:
+            ahead, slots = len(self.waiting.get(user_id, ())) + 1, self.max_per_user
+        else:
+            ahead, slots = self.queued + 1, self.max_concurrent or 1
+        return max(1, min(math.ceil(self.average_hold * ahead / slots), math.ceil(self.max_wait) or 1))
+
+
+def too_many_requests(e):
+    return Response(str(e), status=429, headers={"Retry-After": str(e.retry_after)})
+
+
+def admission_controlled(route):
+    """
+    Decorator for AI routes, after jwt_required, that admits the request through the
+    admission controller and holds its slot until the response, including a streamed
+    response, has been sent
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                ticket = admission.acquire(get_jwt_identity(), route)
+            except AdmissionRejected as e:
+                app.logger.info(f"message::AI request rejected, route::{route}, "
+                                f"user::{get_jwt_identity()}, reason::{e.reason}")
+                return too_many_requests(e)
+            try:
+                response = app.make_response(view(*args, **kwargs))
+            except BaseException:
+                ticket.release()
+                raise
+            if response.is_streamed:
+                response.call_on_close(ticket.release)
+            else:
+                ticket.release()
+            return response
+        return wrapper
+    return decorator
+
+
+admission = AdmissionController(max_concurrent=app.config["SIDEKICK_ADMISSION_MAX_CONCURRENT"],
+                                max_per_user=app.config["SIDEKICK_ADMISSION_MAX_PER_USER"],
+                                max_queue=app.config["SIDEKICK_ADMISSION_MAX_QUEUE"],
+                                max_queue_per_user=app.config["SIDEKICK_ADMISSION_MAX_QUEUE_PER_USER"],
+                                max_wait=app.config["SIDEKICK_ADMISSION_MAX_WAIT"])
@@ -0,0 +1,226 @@
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+from prometheus_client import Counter
+from sqlalchemy import bindparam, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import CachedResponse
+from ai_client import get_upstream_client
+from single_flight import SingleFlight, file_lock
+
+
+RESPONSE_CACHE_REQUESTS = Counter(
+    "sidekick_response_cache_requests_total",
+    "Utility AI requests by response cache result (hit, miss or bypass)",
+    ["route", "result"])
+UPSTREAM_CALLS_SAVED = Counter(
+    "sidekick_single_flight_calls_saved_total",
+    "Utility AI requests answered by an identical request already in flight instead of their own upstream call",
+    ["route", "scope"])
+
+# Request header the web UI or API clients can set to skip the response cache
+CACHE_BYPASS_HEADER = "X-Sidekick-Cache"
+
+
+def cache_bypass_requested(request):
+    """
+    Return True if the request asked not to be served from the response cache
+    """
+    return request.headers.get(CACHE_BYPASS_HEADER, "").lower() == "bypass" or \
+        "no-cache" in request.headers.get("Cache-Control", "").lower()
+
+
+def response_cache_key(ai_request):
+    """
+    Return a hash of the parts of an ai_request that determine the response
+    """
+    normalized = {
+        "model": ai_request.get("model"),
+        "temperature": ai_request.get("temperature"),
+        "messages": [{"role": message.get("role"), "content": message.get("content")}
+                     for message in ai_request.get("messages", [])]
+    }
+    return hashlib.sha256(json.dumps(normalized, sort_keys=True,
+                                     separators=(",", ":")).encode("utf-8")).hexdigest()
+
+
+class MemoryResponseCache:
+    """
+    Per-worker LRU cache of AI responses with a time to live
+    """
+    def __init__(self, ttl=3600, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, response = entry
+            if expires < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return response
+
+    def set(self, key, response):
+        with self.lock:
+            self.entries[key] = (time.time() + self.ttl, response)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+class DatabaseResponseCache:
+    """
+    LRU cache of AI responses with a time to live, stored in the
+    response_cache table so that entries are shared by all workers.
+
+    Cache hits do not write to the database: the times entries were used are
+    kept in memory and written together with the next insert, or at most every
+    touch_interval seconds. Each insert evicts up to eviction_batch_size of the
+    least recently used entries beyond max_entries, without counting the table.
+    Expired entries are not returned, and are replaced when the same response is
+    cached again or evicted once they are among the least recently used.
+    """
+    def __init__(self, ttl=3600, max_entries=10000, touch_interval=60, eviction_batch_size=100):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self.eviction_batch_size = eviction_batch_size
+        self.touched = {}  # key: time last used, not yet written to the database
+        self.touched_written = time.time()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        now = time.time()
+        entry = db.session.query(CachedResponse.response) \
+            .filter(CachedResponse.key == key, CachedResponse.expires >= now).first()
+        if entry is None:
+            return None
+        with self.lock:
+            self.touched[key] = now
+            write_touched = now - self.touched_written >= self.touch_interval
+        if write_touched:
+            self._write_touched()
+            db.session.commit()
+        return json.loads(entry.response)
+
+    def _write_touched(self):
+        with self.lock:
+            touched, self.touched = self.touched, {}
+            self.touched_written = time.time()
+        if touched:
+            table = CachedResponse.__table__
+            db.session.execute(update(table).where(table.c.key == bindparam("touched_key"))
+                               .values(last_accessed=bindparam("touched_time")),
+                               [{"touched_key": key, "touched_time": touched_time}
+                                for key, touched_time in touched.items()])
+
+    def set(self, key, response):
+        now = time.time()
+        try:
+            db.session.merge(CachedResponse(key=key, response=json.dumps(response),
+                                            expires=now + self.ttl, last_accessed=now))
+            self._write_touched()
+            least_recently_used = db.session.query(CachedResponse.key) \
+                .order_by(CachedResponse.last_accessed.desc()) \
+                .offset(self.max_entries).limit(self.eviction_batch_size).subquery()
+            CachedResponse.query.filter(CachedResponse.key.in_(db.select(least_recently_used.c.key))) \
+                .delete(synchronize_session=False)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker cached the same response at the same time
+            db.session.rollback()
+
+
+class NoResponseCache:
+    def get(self, key):
+        return None
+
+    def set(self, key, response):
+        pass
+
+
+_response_cache = None
+
+
+def get_response_cache():
+    """
+    Return the response cache backend selected by SIDEKICK_RESPONSE_CACHE
+    """
+    global _response_cache
+    if _response_cache is None:
+        backend = app.config["SIDEKICK_RESPONSE_CACHE"]
+        ttl = app.config["SIDEKICK_RESPONSE_CACHE_TTL"]
+        max_entries = app.config["SIDEKICK_RESPONSE_CACHE_MAX_ENTRIES"]
+        if backend == "memory":
+            _response_cache = MemoryResponseCache(ttl=ttl, max_entries=max_entries)
+        elif backend == "database":
+            _response_cache = DatabaseResponseCache(ttl=ttl, max_entries=max_entries)
+        else:
+            _response_cache = NoResponseCache()
+    return _response_cache
+
+
+_single_flight = SingleFlight()
+
+
+def cached_chat_completion(route, ai_request, bypass=False):
+    """
+    Return the provider's JSON response to a non-streaming ai_request,
+    from the response cache if an identical request has been answered before.
+
+    Identical requests made at the same time share one upstream call: within
+    a worker always (unless SIDEKICK_SINGLE_FLIGHT is off), and across workers
+    when SIDEKICK_SINGLE_FLIGHT_LOCK_DIR is set and the database cache is used.
+
+    Returns:
+        response: The chat completion response as a dict
+        cache_hit: True if the response came from the cache or from an identical request in flight
+    """
+    cache = get_response_cache()
+    key = response_cache_key(ai_request)
+    if not bypass:
+        response = cache.get(key)
+        if response is not None:
+            RESPONSE_CACHE_REQUESTS.labels(route=route, result="hit").inc()
+            return response, True
+    RESPONSE_CACHE_REQUESTS.labels(route=route, result="bypass" if bypass else "miss").inc()
+
+    def fetch():
+        upstream_response = get_upstream_client().chat_completions(ai_request)
+        response = upstream_response.json()
+        if upstream_response.status_code == 200 and "choices" in response:
+            cache.set(key, response)
+        return response, False
+
+    def fetch_once_across_workers():
+        with file_lock(app.config["SIDEKICK_SINGLE_FLIGHT_LOCK_DIR"], key) as waited:
+            if waited and not bypass:
+                # Another worker made the same request while we waited for the lock
+                response = cache.get(key)
+                if response is not None:
+                    UPSTREAM_CALLS_SAVED.labels(route=route, scope="cross_worker").inc()
+                    return response, True
+            return fetch()
+
+    if not app.config["SIDEKICK_SINGLE_FLIGHT"]:
+        return fetch()
+    if app.config["SIDEKICK_SINGLE_FLIGHT_LOCK_DIR"] and isinstance(cache, DatabaseResponseCache):
+        call = fetch_once_across_workers
+    else:
+        call = fetch
+    (response, cache_hit), shared = _single_flight.do((key, bypass), call)
+    if shared:
+        UPSTREAM_CALLS_SAVED.labels(route=route, scope="worker").inc()
+        return response, True
+    return response, cache_hit
@@ -0,0 +1,260 @@
+import os
+import json
+import time
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from prometheus_client import Counter, Histogram
+
+from app import app
+from custom_utils.get_openai_token import get_openai_token
+from provider_router import ProviderRouter, parse_endpoints
+
+
+UPSTREAM_REQUESTS = Counter(
+    "sidekick_upstream_requests_total",
+    "Requests sent to upstream AI providers, by whether a pooled connection was reused",
+    ["provider", "pool"])
+UPSTREAM_CONNECT_SECONDS = Histogram(
+    "sidekick_upstream_connect_seconds",
+    "Time taken to open a new TCP (and TLS) connection to an upstream AI provider",
+    ["host"])
+
+# Number of new connections opened by the current thread (or greenlet under gevent),
+# used to tell whether a request was served from the connection pool
+_connect_counter = threading.local()
+
+
+def _count_connect(host, duration):
+    UPSTREAM_CONNECT_SECONDS.labels(host=host).observe(duration)
+    _connect_counter.value = getattr(_connect_counter, "value", 0) + 1
+
+
+class _TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        start_time = time.time()
+        super().connect()
+        _count_connect(self.host, time.time() - start_time)
+
+
+class _TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        start_time = time.time()
+        super().connect()
+        _count_connect(self.host, time.time() - start_time)
+
+
+class _TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _PoolingAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose connections record how long they take to connect
+    """
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TimedHTTPConnectionPool,
+            "https": _TimedHTTPSConnectionPool
+        }
+
+
+class UpstreamClient:
+    """
+    Keep-alive HTTP client for the OpenAI compatible APIs of the model providers.
+
+    One client is shared by all requests handled by a worker process so that
+    TCP and TLS connections to the provider are reused between requests
+    instead of being re-established for every chat turn.
+
+    Each provider can have several endpoints, e.g. a number of local inference
+    boxes. A ProviderRouter picks the endpoint for each request and the request
+    is retried on another endpoint if it cannot connect or gets a 5xx response.
+
+    Usage:
+        response = get_upstream_client().chat_completions(ai_request, provider="OpenAI")
+    """
+    def __init__(self, base_urls, pool_connections=10, pool_maxsize=20,
+                 connect_timeout=10, read_timeout=120, routing_policy="least_outstanding",
+                 failure_threshold=3):
+        # base_urls maps each provider to a base URL, a comma separated list of
+        # base URLs (see parse_endpoints) or a list of (url, weight) tuples
+        self.routers = {
+            provider: ProviderRouter(provider,
+                                     parse_endpoints(urls) if isinstance(urls, str) else urls,
+                                     policy=routing_policy, failure_threshold=failure_threshold)
+            for provider, urls in base_urls.items()
+        }
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = _PoolingAdapter(pool_connections=pool_connections,
+                                  pool_maxsize=pool_maxsize)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.health_check_thread = None
+
+    def router(self, provider=None):
+        """
+        Return the router for the provider, defaulting to OpenAI
+        if the provider is not specified or not known.
+        """
+        return self.routers.get(provider, self.routers["OpenAI"])
+
+    def base_url(self, provider=None):
+        """
+        Return the base URL of the endpoint the next request to the provider would be sent to
+        """
+        return self.router(provider).choose().url
+
+    def headers(self):
+        return {
+            'content-type': 'application/json; charset=utf-8',
+            'Authorization': f"Bearer {get_openai_token()}"
+        }
+
+    def request(self, method, path, provider=None, **kwargs):
+        provider = provider if provider in self.routers else "OpenAI"
+        router = self.routers[provider]
+        kwargs.setdefault("headers", self.headers())
+        kwargs.setdefault("timeout", self.timeout)
+        tried = []
+        while True:
+            endpoint = router.choose(exclude=tried)
+            tried.append(endpoint)
+            can_fail_over = router.choose(exclude=tried) is not None
+            connects_before = getattr(_connect_counter, "value", 0)
+            router.start(endpoint)
+            start_time = time.time()
+            try:
+                response = self.session.request(method, f"{endpoint.url}{path}", **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                router.finish(endpoint)
+                router.record_failure(endpoint)
+                # Once the request has been sent the endpoint may already be generating
+                # (and billing for) the completion, so it is not sent again
+                if not can_fail_over or not _failed_before_sent(e):
+                    raise
+                router.record_failover()
+                continue
+            pool = "miss" if getattr(_connect_counter, "value", 0) > connects_before else "hit"
+            UPSTREAM_REQUESTS.labels(provider=provider, pool=pool).inc()
+            if response.status_code >= 500:
+                router.record_failure(endpoint)
+                if can_fail_over:
+                    response.close()
+                    router.finish(endpoint)
+                    router.record_failover()
+                    continue
+            else:
+                router.record_success(endpoint, time.time() - start_time)
+            if kwargs.get("stream"):
+                # A streamed response keeps the endpoint busy until it is closed
+                _call_on_close(response, lambda: router.finish(endpoint))
+            else:
+                router.finish(endpoint)
+            return response
+
+    def chat_completions(self, ai_request, provider=None, stream=False):
+        return self.request("POST", "/chat/completions", provider=provider,
+                            data=json.dumps(ai_request), stream=stream)
+
+    def check_health(self):
+        for router in self.routers.values():
+            router.check_health(self.session, self.headers(), timeout=self.timeout[0])
+
+    def start_health_checks(self, interval):
+        """
+        Check the health of the endpoints every interval seconds in a daemon thread,
+        if any provider has more than one endpoint to route between
+        """
+        if interval <= 0 or self.health_check_thread is not None or \
+                all(len(router.endpoints) < 2 for router in self.routers.values()):
+            return
+
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check_health()
+                except Exception as e:
+                    app.logger.exception("Upstream health check failed: %s", e)
+
+        self.health_check_thread = threading.Thread(target=run, name="upstream-health-check",
+                                                    daemon=True)
+        self.health_check_thread.start()
+
+
+def _failed_before_sent(e):
+    """
+    Return True if a requests exception was raised while connecting,
+    before any of the request was sent
+    """
+    if isinstance(e, requests.ConnectTimeout):
+        return True
+    if isinstance(e, requests.ConnectionError) and e.args:
+        return isinstance(getattr(e.args[0], "reason", None), NewConnectionError)
+    return False
+
+
+def _call_on_close(response, callback):
+    """
+    Call callback once when the response is closed
+    """
+    close = response.close
+    called = []
+
+    def close_and_call():
+        try:
+            close()
+        finally:
+            if not called:
+                called.append(True)
+                callback()
+    response.close = close_and_call
+
+
+def upstream_base_urls():
+    """
+    Return the endpoints for each provider, from SIDEKICK_OPENAI_ENDPOINTS and
+    SIDEKICK_OLLAMA_ENDPOINTS if set, otherwise OPENAI_BASE_URL and OLLAMA_BASE_URL
+    """
+    return {
+        "OpenAI": app.config["SIDEKICK_OPENAI_ENDPOINTS"] or app.config["OPENAI_BASE_URL"],
+        "Ollama": app.config["SIDEKICK_OLLAMA_ENDPOINTS"] or app.config["OLLAMA_BASE_URL"]
+    }
+
+
+_upstream_client = None
+_upstream_client_pid = None
+_upstream_client_lock = threading.Lock()
+
+
+def get_upstream_client():
+    """
+    Return the UpstreamClient for this worker process, creating it on first use.
+    A new client is created after a fork so that workers never share sockets.
+    """
+    global _upstream_client, _upstream_client_pid
+    if _upstream_client is None or _upstream_client_pid != os.getpid():
+        with _upstream_client_lock:
+            if _upstream_client is None or _upstream_client_pid != os.getpid():
+                _upstream_client = UpstreamClient(
+                    base_urls=upstream_base_urls(),
+                    pool_connections=app.config["SIDEKICK_UPSTREAM_POOL_CONNECTIONS"],
+                    pool_maxsize=app.config["SIDEKICK_UPSTREAM_POOL_MAXSIZE"],
+                    connect_timeout=app.config["SIDEKICK_UPSTREAM_CONNECT_TIMEOUT"],
+                    read_timeout=app.config["SIDEKICK_UPSTREAM_READ_TIMEOUT"],
+                    routing_policy=app.config["SIDEKICK_UPSTREAM_ROUTING_POLICY"],
+                    failure_threshold=app.config["SIDEKICK_UPSTREAM_FAILURE_THRESHOLD"])
+                _upstream_client.start_health_checks(app.config["SIDEKICK_UPSTREAM_HEALTH_CHECK_INTERVAL"])
+                _upstream_client_pid = os.getpid()
+    return _upstream_client
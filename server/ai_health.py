@@ -0,0 +1,113 @@
+import time
+import threading
+from datetime import datetime
+
+from prometheus_client import Gauge, Histogram
+
+from app import app
+from ai_client import get_upstream_client
+
+AI_HEALTH_PROBE_SECONDS = Histogram(
+    "sidekick_ai_health_probe_seconds",
+    "Time taken by the background /health/ai probe of the AI provider",
+    ["probe", "status"])
+AI_UP = Gauge(
+    "sidekick_ai_up",
+    "Whether the last /health/ai probe of the AI provider succeeded (1) or failed (0)")
+
+AI_HEALTH_PROBES = ("models", "completion")
+
+
+class AIHealthProbe:
+    """
+    Checks the AI provider in the background every interval seconds so that
+    /health/ai can return the last result instead of calling the provider on
+    every request. The probe either lists the models, which costs nothing, or
+    asks the utility model for a one token completion.
+    """
+    def __init__(self, probe="models", interval=30):
+        if probe not in AI_HEALTH_PROBES:
+            raise ValueError(f"Unknown AI health probe {probe}, expected one of {AI_HEALTH_PROBES}")
+        self.probe_type = probe
+        self.interval = interval
+        self.health = None
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def call_provider(self):
+        client = get_upstream_client()
+        if self.probe_type == "models":
+            response = client.request("GET", "/models")
+            response.raise_for_status()
+            return {"models": len(response.json().get("data", []))}
+        response = client.chat_completions({
+            "model": app.config["SIDEKICK_UTILITY_MODEL"],
+            "max_tokens": 1,
+            "messages": [{"role": "user", "content": "Reply with OK"}]
+        })
+        response.raise_for_status()
+        return {"ai_response": response.json()["choices"][0]["message"]["content"]}
+
+    def probe(self):
+        """
+        Check the provider now and return the result
+        """
+        start_time = time.time()
+        try:
+            details = self.call_provider()
+            status = "UP"
+        except Exception as e:
+            details = {"error": str(e)}
+            status = "DOWN"
+        latency = time.time() - start_time
+        AI_HEALTH_PROBE_SECONDS.labels(probe=self.probe_type, status=status).observe(latency)
+        AI_UP.set(1 if status == "UP" else 0)
+        health = {
+            "success": status == "UP",
+            "status": status,
+            "timestamp": datetime.now().isoformat(),
+            "latency": round(latency, 3),
+            "probe": self.probe_type,
+            **details
+        }
+        with self.lock:
+            self.health = health
+        return health
+
+    def start(self):
+        """
+        Start probing in a daemon thread, if not already started
+        """
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.run, name="ai-health-probe", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            self.probe()
+
+    def get_health(self):
+        """
+        Return the last probe result, probing now if there is none yet
+        and starting the background probe on first use
+        """
+        self.start()
+        with self.lock:
+            health = self.health
+        return health if health is not None else self.probe()
+
+
+_ai_health_probe = None
+_ai_health_probe_lock = threading.Lock()
+
+
+def get_ai_health_probe():
+    global _ai_health_probe
+    with _ai_health_probe_lock:
+        if _ai_health_probe is None:
+            _ai_health_probe = AIHealthProbe(probe=app.config["SIDEKICK_AI_HEALTH_PROBE"],
+                                             interval=app.config["SIDEKICK_AI_HEALTH_INTERVAL"])
+    return _ai_health_probe
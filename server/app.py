@@ -26,11 +26,87 @@ app.config["OPENAI_BASE_URL"] = os.environ.get("OPENAI_BASE_URL", "https://api.o
 app.config["OLLAMA_BASE_URL"] = os.environ.get("OLLAMA_BASE_URL", "http://localhost:11434/v1")
 app.config["SIDEKICK_UTILITY_MODEL"] = os.environ.get("SIDEKICK_UTILITY_MODEL", "gpt-4o")
 
+# /health/ai returns the result of a background probe of the AI provider, run every INTERVAL seconds
+# PROBE is "models" to list the provider's models or "completion" for a one token completion from the utility model
+app.config["SIDEKICK_AI_HEALTH_PROBE"] = os.environ.get("SIDEKICK_AI_HEALTH_PROBE", "models")
+app.config["SIDEKICK_AI_HEALTH_INTERVAL"] = float(os.environ.get("SIDEKICK_AI_HEALTH_INTERVAL", 30))
+
+# Connection pooling and timeouts for the HTTP client used to call the model providers
+# Each worker process keeps up to POOL_MAXSIZE keep-alive connections per provider host
+app.config["SIDEKICK_UPSTREAM_POOL_CONNECTIONS"] = int(os.environ.get("SIDEKICK_UPSTREAM_POOL_CONNECTIONS", 10))
+app.config["SIDEKICK_UPSTREAM_POOL_MAXSIZE"] = int(os.environ.get("SIDEKICK_UPSTREAM_POOL_MAXSIZE", 20))
+app.config["SIDEKICK_UPSTREAM_CONNECT_TIMEOUT"] = float(os.environ.get("SIDEKICK_UPSTREAM_CONNECT_TIMEOUT", 10))
+app.config["SIDEKICK_UPSTREAM_READ_TIMEOUT"] = float(os.environ.get("SIDEKICK_UPSTREAM_READ_TIMEOUT", 120))
+
+# Spread requests across several endpoints per provider, e.g. a number of local inference boxes
+# ENDPOINTS are comma separated base URLs with an optional weight: http://box1:11434/v1;weight=2,http://box2:11434/v1
+# ROUTING_POLICY is one of "weighted", "least_outstanding" or "ewma" (lowest moving average latency)
+app.config["SIDEKICK_OPENAI_ENDPOINTS"] = os.environ.get("SIDEKICK_OPENAI_ENDPOINTS", "")
+app.config["SIDEKICK_OLLAMA_ENDPOINTS"] = os.environ.get("SIDEKICK_OLLAMA_ENDPOINTS", "")
+app.config["SIDEKICK_UPSTREAM_ROUTING_POLICY"] = os.environ.get("SIDEKICK_UPSTREAM_ROUTING_POLICY", "least_outstanding")
+app.config["SIDEKICK_UPSTREAM_FAILURE_THRESHOLD"] = int(os.environ.get("SIDEKICK_UPSTREAM_FAILURE_THRESHOLD", 3))
+app.config["SIDEKICK_UPSTREAM_HEALTH_CHECK_INTERVAL"] = float(os.environ.get("SIDEKICK_UPSTREAM_HEALTH_CHECK_INTERVAL", 30))
+
+# Chat streams are relayed to the web UI in chunks of coalesced tokens, flushed when
+# FLUSH_SIZE characters are buffered or FLUSH_INTERVAL_MS has passed since the first one
+app.config["SIDEKICK_STREAM_FLUSH_INTERVAL"] = float(os.environ.get("SIDEKICK_STREAM_FLUSH_INTERVAL_MS", 20)) / 1000
+app.config["SIDEKICK_STREAM_FLUSH_SIZE"] = int(os.environ.get("SIDEKICK_STREAM_FLUSH_SIZE", 256))
+# When counting tokens, ask the OpenAI provider to report the tokens used at the end of each chat stream
+# (stream_options.include_usage). Turn off if it rejects stream_options, token usage is then counted locally
+app.config["SIDEKICK_STREAM_USAGE"] = os.environ.get("SIDEKICK_STREAM_USAGE", "True").lower() == "true"
+
+# Chat streams cancelled with /chat/v2/cancel on another worker are picked up from the database
+# at most every CANCEL_POLL_INTERVAL seconds, 0 to only cancel streams on the worker that receives the request
+app.config["SIDEKICK_STREAM_CANCEL_POLL_INTERVAL"] = float(os.environ.get("SIDEKICK_STREAM_CANCEL_POLL_INTERVAL", 1))
+
+# Cache responses to identical /nametopic/v1 and /generatetext/v1 requests
+# Set to "memory" for a per-worker cache, "database" to share the cache between workers, or "none"
+app.config["SIDEKICK_RESPONSE_CACHE"] = os.environ.get("SIDEKICK_RESPONSE_CACHE", "memory")
+app.config["SIDEKICK_RESPONSE_CACHE_TTL"] = int(os.environ.get("SIDEKICK_RESPONSE_CACHE_TTL", 3600))
+app.config["SIDEKICK_RESPONSE_CACHE_MAX_ENTRIES"] = int(os.environ.get("SIDEKICK_RESPONSE_CACHE_MAX_ENTRIES", 1000))
+
+# Identical /nametopic/v1 and /generatetext/v1 requests in flight at the same time share one upstream call
+# Set LOCK_DIR to a directory shared by the workers to also share calls between workers (needs the database cache)
+app.config["SIDEKICK_SINGLE_FLIGHT"] = os.environ.get("SIDEKICK_SINGLE_FLIGHT", "True").lower() == "true"
+app.config["SIDEKICK_SINGLE_FLIGHT_LOCK_DIR"] = os.environ.get("SIDEKICK_SINGLE_FLIGHT_LOCK_DIR", "")
+
+# /nametopic/v1/batch names up to MAX_ITEMS texts per request, with up to CONCURRENCY upstream calls
+# at a time per worker process, shared by all batch requests
+app.config["SIDEKICK_BATCH_MAX_ITEMS"] = int(os.environ.get("SIDEKICK_BATCH_MAX_ITEMS", 100))
+app.config["SIDEKICK_BATCH_CONCURRENCY"] = int(os.environ.get("SIDEKICK_BATCH_CONCURRENCY", 8))
+
+# Maximum number of documents in a page of a /docdb listing requested with a limit
+app.config["SIDEKICK_DOCDB_MAX_PAGE_SIZE"] = int(os.environ.get("SIDEKICK_DOCDB_MAX_PAGE_SIZE", 1000))
+
+# Users with more documents than this are deleted in the background, 0 to always delete users in the request
+app.config["SIDEKICK_DELETE_USER_BACKGROUND_DOCUMENTS"] = int(os.environ.get("SIDEKICK_DELETE_USER_BACKGROUND_DOCUMENTS", 10000))
+
+# Admission control for the AI routes in each worker process: at most MAX_CONCURRENT upstream calls at a time,
+# MAX_PER_USER of them for one user, with the rest waiting their user's turn in a queue of up to MAX_QUEUE requests,
+# MAX_QUEUE_PER_USER of them for one user. Requests are rejected with 429 when the queue is full or after MAX_WAIT seconds
+# Set a limit to 0 for no limit
+app.config["SIDEKICK_ADMISSION_MAX_CONCURRENT"] = int(os.environ.get("SIDEKICK_ADMISSION_MAX_CONCURRENT", 32))
+app.config["SIDEKICK_ADMISSION_MAX_PER_USER"] = int(os.environ.get("SIDEKICK_ADMISSION_MAX_PER_USER", 4))
+app.config["SIDEKICK_ADMISSION_MAX_QUEUE"] = int(os.environ.get("SIDEKICK_ADMISSION_MAX_QUEUE", 100))
+app.config["SIDEKICK_ADMISSION_MAX_QUEUE_PER_USER"] = int(os.environ.get("SIDEKICK_ADMISSION_MAX_QUEUE_PER_USER", 20))
+app.config["SIDEKICK_ADMISSION_MAX_WAIT"] = float(os.environ.get("SIDEKICK_ADMISSION_MAX_WAIT", 30))
+# The async chat stream server holds many more streams than a gunicorn worker so has its own limits,
+# by default none. Its queue uses the limits above
+app.config["SIDEKICK_STREAM_ADMISSION_MAX_CONCURRENT"] = int(os.environ.get("SIDEKICK_STREAM_ADMISSION_MAX_CONCURRENT", 0))
+app.config["SIDEKICK_STREAM_ADMISSION_MAX_PER_USER"] = int(os.environ.get("SIDEKICK_STREAM_ADMISSION_MAX_PER_USER", 0))
+
+# Drop the oldest chat history from /chat/v2 requests that would not fit in the model's
+# context window (contextTokenSize in model_settings), leaving room for COMPLETION_TOKENS of response
+app.config["SIDEKICK_CONTEXT_FITTING"] = os.environ.get("SIDEKICK_CONTEXT_FITTING", "True").lower() == "true"
+app.config["SIDEKICK_CONTEXT_COMPLETION_TOKENS"] = int(os.environ.get("SIDEKICK_CONTEXT_COMPLETION_TOKENS", 4096))
+
 # Optionally count chat tokens if specified in the env var
 # (token count is not returned by the streaming interface)
 # Set to True to count prompt and completion tokens, or leave blank
 # Counting tokens uses the tiktoken library, which calls an additional cloud endpoint
 app.config["SIDEKICK_COUNT_TOKENS"] = os.environ.get("SIDEKICK_COUNT_TOKENS", False)
+# Set to "approximate" to estimate tokens from the number of characters instead of encoding them
+app.config["SIDEKICK_COUNT_TOKENS_MODE"] = os.environ.get("SIDEKICK_COUNT_TOKENS_MODE", "exact")
 
 app.config["OIDC_WELL_KNOWN_URL"] = os.environ.get("OIDC_WELL_KNOWN_URL")
 app.config["OIDC_TOKEN_ENDPOINT"] = os.environ.get("OIDC_TOKEN_ENDPOINT")
@@ -52,7 +128,10 @@ except:
 db = SQLAlchemy()
 db.init_app(app)
 jwt = JWTManager(app)
-CORS(app)
+CORS(app, expose_headers=["X-Sidekick-Context-Dropped-Messages",
+                         "X-Sidekick-Context-Dropped-Tokens",
+                         "X-Sidekick-Stream-Id",
+                         "Retry-After"])
 migrate = Migrate(app, db)
 
 metrics = PrometheusMetrics(app)
@@ -0,0 +1,161 @@
+"""
+Benchmark concurrent /chat/v2 streams held open by the async chat server.
+
+Starts the fake provider and chat_stream_server.py as subprocesses, opens
+--streams concurrent chat streams, waits until every stream has received
+its first token and then reports how many streams are open at once and the
+resident memory of the chat server per open stream. The chat server uses a
+temporary SQLite database set up by init.py, so it checks for cancelled
+streams as it would in production.
+
+Usage (Linux, from the server directory):
+    python benchmarks/bench_chat_stream.py --streams 2000
+"""
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import resource
+import tempfile
+import subprocess
+
+from flask import Flask
+from flask_jwt_extended import JWTManager, create_access_token
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JWT_SECRET_KEY = "sidekick-benchmark"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_kb(pid):
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+
+
+def access_token():
+    jwt_app = Flask(__name__)
+    jwt_app.config["JWT_SECRET_KEY"] = JWT_SECRET_KEY
+    JWTManager(jwt_app)
+    with jwt_app.app_context():
+        return create_access_token(identity="benchmark")
+
+
+async def wait_for_port(port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.2)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+async def chat_stream(port, token, first_token_event, results):
+    body = json.dumps({
+        "model_settings": {"provider": "OpenAI", "request": {"model": "fake-model"}},
+        "system_prompt": "You are a helpful advisor.",
+        "prompt": "Tell me a story",
+        "chatHistory": []
+    }).encode()
+    start_time = time.time()
+    reader, writer = await asyncio.open_connection("127.0.0.1", port, limit=2 ** 20)
+    writer.write((f"POST /chat/v2 HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                  f"Authorization: Bearer {token}\r\nContent-Type: application/json\r\n"
+                  f"Connection: close\r\nContent-Length: {len(body)}\r\n\r\n").encode() + body)
+    await writer.drain()
+    status_line = await reader.readuntil(b"\r\n\r\n")
+    first_chunk = await reader.readline()
+    if b" 200 " not in status_line.split(b"\r\n", 1)[0] or not first_chunk:
+        results["failed"] += 1
+    results["first_token"].append(time.time() - start_time)
+    first_token_event()
+    body = first_chunk
+    while data := await reader.read(65536):
+        body += data
+    if b"Error - " in body:
+        results["failed"] += 1
+    results["complete"].append(time.time() - start_time)
+    writer.close()
+
+
+async def run(args, chat_port, server_pid):
+    token = access_token()
+    await wait_for_port(chat_port)
+    baseline_rss = rss_kb(server_pid)
+    results = {"first_token": [], "complete": [], "failed": 0}
+    all_open = asyncio.Event()
+
+    def first_token():
+        if len(results["first_token"]) == args.streams:
+            all_open.set()
+
+    start_time = time.time()
+    tasks = [asyncio.create_task(chat_stream(chat_port, token, first_token, results))
+             for _ in range(args.streams)]
+    await asyncio.wait_for(all_open.wait(), timeout=args.tokens * args.token_interval + 60)
+    open_time = time.time() - start_time
+    streaming_rss = rss_kb(server_pid)
+    await asyncio.gather(*tasks)
+    total_time = time.time() - start_time
+
+    first_tokens = sorted(results["first_token"])
+    print(f"Concurrent open streams:     {args.streams}")
+    print(f"Time to open all streams:    {open_time:.2f}s")
+    print(f"Time to first token p50/p99: {first_tokens[len(first_tokens) // 2]:.3f}s / "
+          f"{first_tokens[int(len(first_tokens) * 0.99)]:.3f}s")
+    print(f"Time to complete all:        {total_time:.2f}s")
+    print(f"Failed streams:              {results['failed']}")
+    print(f"Chat server RSS idle:        {baseline_rss / 1024:.1f} MB")
+    print(f"Chat server RSS streaming:   {streaming_rss / 1024:.1f} MB")
+    print(f"Memory per open stream:      {(streaming_rss - baseline_rss) / args.streams:.1f} KB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--streams", type=int, default=1000)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--token-interval", type=float, default=0.05)
+    args = parser.parse_args()
+
+    # each stream uses a client, server and upstream socket
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    provider_port, chat_port = free_port(), free_port()
+    database = tempfile.TemporaryDirectory()
+    env = dict(os.environ,
+               JWT_SECRET_KEY=JWT_SECRET_KEY,
+               OPENAI_API_KEY="fake",
+               SQLALCHEMY_DATABASE_URI=f"sqlite:///{os.path.join(database.name, 'sidekick.db')}",
+               OPENAI_BASE_URL=f"http://127.0.0.1:{provider_port}/v1",
+               SIDEKICK_ASYNC_CHAT_HOST="127.0.0.1",
+               SIDEKICK_ASYNC_CHAT_PORT=str(chat_port),
+               SIDEKICK_UPSTREAM_POOL_MAXSIZE=str(args.streams))
+    subprocess.run([sys.executable, "init.py"], cwd=SERVER_DIR, env=env, check=True)
+    provider = subprocess.Popen([sys.executable, "benchmarks/fake_provider.py",
+                                 "--port", str(provider_port), "--tokens", str(args.tokens),
+                                 "--token-interval", str(args.token_interval)], cwd=SERVER_DIR)
+    server = subprocess.Popen([sys.executable, "chat_stream_server.py"], cwd=SERVER_DIR, env=env)
+    try:
+        asyncio.run(run(args, chat_port, server.pid))
+    finally:
+        server.terminate()
+        provider.terminate()
+        server.wait()
+        database.cleanup()
+
+
+if __name__ == "__main__":
+    main()
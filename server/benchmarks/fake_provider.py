@@ -0,0 +1,185 @@
+"""
+Fake OpenAI compatible model provider for benchmarking Sidekick without
+calling (and paying for) a real provider.
+
+Serves /v1/chat/completions as either a JSON response or an SSE stream
+of one content delta per token, and /v1/models. The latency before the
+response, the token rate and the rate of errors and dropped streams can be
+set to mimic a real provider under load.
+
+Usage:
+    python benchmarks/fake_provider.py --port 5099 --tokens 200 --token-rate 20
+    python benchmarks/fake_provider.py --port 5099 --latency 0.5 --error-rate 0.05 --error-status 429
+    OPENAI_BASE_URL=http://127.0.0.1:5099/v1 python run.py
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+
+
+class FakeProvider:
+    def __init__(self, tokens=100, token_interval=0.02, token_text="token ", latency=0,
+                 latency_jitter=0, error_rate=0, error_status=500, disconnect_rate=0, seed=None,
+                 models=("fake-model",)):
+        self.tokens = tokens
+        self.token_interval = token_interval
+        self.token_text = token_text
+        self.latency = latency  # seconds before the response starts, i.e. the time to first token
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate  # fraction of completions answered with error_status
+        self.error_status = error_status
+        self.disconnect_rate = disconnect_rate  # fraction of streams dropped part way through
+        self.models = models
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.disconnects = 0
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                if method == "POST" and path.endswith("/chat/completions"):
+                    ai_request = json.loads(body or b"{}")
+                    self.requests += 1
+                    await asyncio.sleep(max(0, self.latency + self.random.uniform(
+                        -self.latency_jitter, self.latency_jitter)))
+                    if self.random.random() < self.error_rate:
+                        self.write_error(writer)
+                    elif ai_request.get("stream"):
+                        await self.stream_completion(writer, ai_request)
+                    else:
+                        await self.completion(writer, ai_request)
+                elif method == "GET" and path.endswith("/models"):
+                    await self.list_models(writer)
+                elif method == "GET" and path.endswith("/stats"):
+                    self.write_json(writer, 200, {"requests": self.requests, "errors": self.errors,
+                                                  "disconnects": self.disconnects})
+                else:
+                    self.write_json(writer, 404, {"error": {"message": f"Unknown path {path}"}})
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def write_json(self, writer, status, body, headers=""):
+        data = json.dumps(body).encode()
+        writer.write((f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n"
+                      "Content-Type: application/json\r\n" + headers +
+                      f"Content-Length: {len(data)}\r\n\r\n").encode() + data)
+
+    def write_error(self, writer):
+        self.errors += 1
+        if self.error_status == 429:
+            self.write_json(writer, 429, {"error": {
+                "message": "Rate limit reached, please try again in 1s",
+                "type": "requests", "code": "rate_limit_exceeded"}}, "Retry-After: 1\r\n")
+        else:
+            self.write_json(writer, self.error_status, {"error": {
+                "message": "The server had an error while processing your request",
+                "type": "server_error", "code": None}})
+
+    def chunk(self, model, delta, finish_reason=None):
+        return {"id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]}
+
+    def write_event(self, writer, data):
+        event = f"data: {data}\n\n".encode()
+        writer.write(f"{len(event):x}\r\n".encode() + event + b"\r\n")
+
+    async def list_models(self, writer):
+        self.write_json(writer, 200, {"object": "list", "data": [
+            {"id": model, "object": "model", "owned_by": "sidekick"} for model in self.models]})
+
+    async def stream_completion(self, writer, ai_request):
+        model = ai_request.get("model", "fake-model")
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Transfer-Encoding: chunked\r\n\r\n")
+        self.write_event(writer, json.dumps(self.chunk(model, {"role": "assistant", "content": ""})))
+        # drop the connection after a random number of tokens, like a provider or proxy timing out
+        disconnect_after = self.random.randrange(self.tokens) \
+            if self.tokens and self.random.random() < self.disconnect_rate else None
+        for token in range(self.tokens):
+            if token == disconnect_after:
+                self.disconnects += 1
+                await writer.drain()
+                raise ConnectionResetError("Dropped stream")
+            await asyncio.sleep(self.token_interval)
+            self.write_event(writer, json.dumps(self.chunk(model, {"content": self.token_text})))
+            await writer.drain()
+        self.write_event(writer, json.dumps(self.chunk(model, {}, finish_reason="stop")))
+        if ai_request.get("stream_options", {}).get("include_usage"):
+            # Like OpenAI, the usage is sent in a final event with no choices
+            self.write_event(writer, json.dumps({
+                "id": "chatcmpl-fake", "object": "chat.completion.chunk",
+                "created": int(time.time()), "model": model, "choices": [],
+                "usage": {"prompt_tokens": 10, "completion_tokens": self.tokens,
+                          "total_tokens": 10 + self.tokens}}))
+        self.write_event(writer, "[DONE]")
+        writer.write(b"0\r\n\r\n")
+
+    async def completion(self, writer, ai_request):
+        await asyncio.sleep(self.token_interval * self.tokens)
+        self.write_json(writer, 200, {
+            "id": "chatcmpl-fake", "object": "chat.completion",
+            "created": int(time.time()), "model": ai_request.get("model", "fake-model"),
+            "choices": [{"index": 0, "finish_reason": "stop",
+                         "message": {"role": "assistant",
+                                     "content": self.token_text * self.tokens}}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": self.tokens,
+                      "total_tokens": 10 + self.tokens}
+        })
+
+
+async def serve(host, port, provider):
+    server = await asyncio.start_server(provider.handle_connection, host, port, backlog=4096)
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake OpenAI compatible model provider")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5099)
+    parser.add_argument("--tokens", type=int, default=100,
+                        help="Number of tokens in each completion")
+    parser.add_argument("--token-interval", type=float, default=0.02,
+                        help="Seconds between streamed tokens")
+    parser.add_argument("--token-rate", type=float,
+                        help="Streamed tokens per second, instead of --token-interval")
+    parser.add_argument("--latency", type=float, default=0,
+                        help="Seconds before each completion starts")
+    parser.add_argument("--latency-jitter", type=float, default=0,
+                        help="Random variation of up to this many seconds either side of --latency")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of completion requests answered with --error-status")
+    parser.add_argument("--error-status", type=int, default=500,
+                        help="HTTP status of injected errors, e.g. 429, 500 or 503")
+    parser.add_argument("--disconnect-rate", type=float, default=0,
+                        help="Fraction of streams dropped part way through")
+    parser.add_argument("--seed", type=int, help="Random seed for reproducible latency and errors")
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port, FakeProvider(
+        tokens=args.tokens,
+        token_interval=1 / args.token_rate if args.token_rate else args.token_interval,
+        latency=args.latency, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, error_status=args.error_status,
+        disconnect_rate=args.disconnect_rate, seed=args.seed)))
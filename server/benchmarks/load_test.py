@@ -0,0 +1,287 @@
+"""
+End-to-end load test of the Sidekick server against the fake provider.
+
+Each virtual user creates an account, logs in and then repeatedly does what
+the web UI does for a chat: list their chats, create a chat, stream a chat
+response, name the chat, save it and now and then ask AI Help to generate
+text. The latency percentiles and throughput of each route are reported
+at the end.
+
+By default the fake provider and the server (gunicorn, as in
+docker-entrypoint.sh) are started as subprocesses with a fresh sqlite
+database. Use --url to load test a server that is already running, with its
+OPENAI_BASE_URL pointing at a fake provider.
+
+Usage (from the server directory):
+    python benchmarks/load_test.py --users 50 --duration 60
+    python benchmarks/load_test.py --users 20 --duration 30 --output results.json
+    python benchmarks/load_test.py --users 20 --duration 30 --compare results.json
+    python benchmarks/load_test.py --url http://localhost:5000 --users 10 --iterations 5
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+
+import requests
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SERVER_COMMAND = "gunicorn --worker-class gevent -b 127.0.0.1:{port} app:app --timeout 120 " \
+                 "--workers {workers} --threads 4"
+CHAT_HISTORY_MESSAGES = 20  # the most recent messages sent with each chat prompt
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def wait_for_url(url, timeout=60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=1)
+            return
+        except requests.ConnectionError:
+            time.sleep(0.2)
+    raise TimeoutError(f"Nothing listening at {url}")
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+
+    def record(self, route, seconds, ok=True):
+        with self.lock:
+            self.latencies.setdefault(route, []).append(seconds)
+            self.errors[route] = self.errors.get(route, 0) + (0 if ok else 1)
+
+    def summary(self, duration):
+        return {route: {"requests": len(latencies),
+                        "errors": self.errors[route],
+                        "p50": percentile(latencies, 0.5),
+                        "p99": percentile(latencies, 0.99),
+                        "throughput": len(latencies) / duration}
+                for route, latencies in sorted(self.latencies.items())}
+
+
+class VirtualUser:
+    def __init__(self, url, user_id, stats, args):
+        self.url = url
+        self.user_id = user_id
+        self.stats = stats
+        self.args = args
+        self.session = requests.Session()
+        self.chat_id = None
+        self.chat = []
+
+    def call(self, route, method, path, **kwargs):
+        """
+        Send a request and record its latency, returning the response or None if it failed
+        """
+        start_time = time.time()
+        try:
+            response = self.session.request(method, self.url + path, timeout=120, **kwargs)
+            ok = response.status_code < 400 and not (
+                response.headers.get("Content-Type", "").startswith("application/json")
+                and isinstance(response.json(), dict) and response.json().get("success") is False)
+        except (requests.RequestException, ValueError):
+            response, ok = None, False
+        self.stats.record(route, time.time() - start_time, ok)
+        return response if ok else None
+
+    def login(self):
+        password = uuid.uuid4().hex
+        self.call("POST /create_account", "POST", "/create_account",
+                  json={"user_id": self.user_id, "name": self.user_id, "password": password})
+        response = self.call("POST /login", "POST", "/login",
+                             json={"user_id": self.user_id, "password": password})
+        if response is None:
+            return False
+        self.session.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+        return True
+
+    def chat_document(self):
+        return {"metadata": {"name": f"Load test chat {self.chat_id or ''}".strip(), "tags": []},
+                "content": {"context": "", "goal": "", "chat": self.chat}}
+
+    def chat_stream(self, prompt):
+        """
+        Stream a chat response, recording the time to first token and to the end of the stream
+        """
+        start_time = time.time()
+        body = {"model_settings": {"provider": "OpenAI", "request": {"model": "fake-model"}},
+                "system_prompt": "You are a helpful advisor.",
+                "prompt": prompt,
+                "chatHistory": self.chat[-CHAT_HISTORY_MESSAGES:]}
+        completion = ""
+        try:
+            with self.session.post(self.url + "/chat/v2", json=body, stream=True, timeout=120) as response:
+                ok = response.status_code == 200
+                for data in response.iter_content(chunk_size=None):
+                    if not completion:
+                        self.stats.record("POST /chat/v2 (first token)", time.time() - start_time, ok)
+                    completion += data.decode("utf-8", errors="replace")
+            ok = ok and "Error - " not in completion
+        except requests.RequestException:
+            ok = False
+        self.stats.record("POST /chat/v2", time.time() - start_time, ok)
+        return completion if ok else None
+
+    def run(self, deadline):
+        if not self.login():
+            return
+        iteration = 0
+        while time.time() < deadline and (not self.args.iterations or iteration < self.args.iterations):
+            self.call("GET /docdb/chats/mine/documents", "GET", "/docdb/chats/mine/documents")
+            if self.chat_id is None:
+                response = self.call("POST /docdb/chats/documents", "POST", "/docdb/chats/documents",
+                                     json=self.chat_document())
+                if response is None:
+                    return
+                self.chat_id = response.json()["metadata"]["id"]
+            prompt = f"Tell me something new about topic {iteration} for {self.user_id}"
+            completion = self.chat_stream(prompt)
+            self.chat.append({"role": "user", "content": prompt})
+            if completion is not None:
+                self.chat.append({"role": "assistant", "content": completion})
+            if iteration == 0:
+                self.call("POST /nametopic/v1", "POST", "/nametopic/v1",
+                          json={"text": json.dumps(self.chat)})
+            self.call("PUT /docdb/chats/documents/<id>", "PUT", f"/docdb/chats/documents/{self.chat_id}",
+                      json=self.chat_document())
+            if self.args.ai_help_every and iteration % self.args.ai_help_every == 0:
+                self.call("POST /generatetext/v1", "POST", "/generatetext/v1",
+                          json={"request": "Continue this", "context": completion or prompt})
+            iteration += 1
+            time.sleep(random.uniform(0, 2 * self.args.think_time))
+
+
+def report(summary, duration, users):
+    print(f"Virtual users: {users}, duration: {duration:.1f}s")
+    print(f"{'Route':<40}{'Requests':>10}{'Errors':>8}{'p50 ms':>10}{'p99 ms':>10}{'Req/s':>9}")
+    for route, stats in summary.items():
+        print(f"{route:<40}{stats['requests']:>10}{stats['errors']:>8}"
+              f"{stats['p50'] * 1000:>10.1f}{stats['p99'] * 1000:>10.1f}{stats['throughput']:>9.2f}")
+
+
+def compare(summary, baseline, tolerance):
+    """
+    Print the routes whose p99 latency is more than tolerance slower than the baseline
+    and return True if there are none
+    """
+    regressions = [(route, baseline[route]["p99"], stats["p99"]) for route, stats in summary.items()
+                   if route in baseline and stats["p99"] > baseline[route]["p99"] * (1 + tolerance)]
+    for route, before, after in regressions:
+        print(f"REGRESSION {route}: p99 {before * 1000:.1f}ms -> {after * 1000:.1f}ms")
+    return not regressions
+
+
+def run(url, args):
+    stats = Stats()
+    run_id = uuid.uuid4().hex[:8]
+    start_time = time.time()
+    deadline = start_time + args.duration
+    threads = []
+    for index in range(args.users):
+        user = VirtualUser(url, f"loadtest-{run_id}-{index}", stats, args)
+        thread = threading.Thread(target=user.run, args=(deadline,), daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(args.ramp_up / args.users)
+    for thread in threads:
+        thread.join()
+    duration = time.time() - start_time
+    summary = stats.summary(duration)
+    report(summary, duration, args.users)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            return compare(summary, json.load(f), args.tolerance)
+    return True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", help="URL of a running server to test, instead of starting one")
+    parser.add_argument("--users", type=int, default=20, help="Number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run for")
+    parser.add_argument("--iterations", type=int, default=0,
+                        help="Chat turns per user, 0 to keep going until --duration")
+    parser.add_argument("--ramp-up", type=float, default=5, help="Seconds over which to start the users")
+    parser.add_argument("--think-time", type=float, default=1,
+                        help="Average seconds a user waits between chat turns")
+    parser.add_argument("--ai-help-every", type=int, default=5,
+                        help="Ask AI Help to generate text every this many chat turns, 0 to never")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file and exit "
+                                          "with status 1 if a route's p99 latency has regressed")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Fraction by which p99 latency may exceed the --compare results")
+    parser.add_argument("--server", default=SERVER_COMMAND,
+                        help="Command to start the server with, {port} and {workers} are filled in")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--server-log", default=os.devnull,
+                        help="File to write the output of the server and fake provider to")
+    parser.add_argument("--tokens", type=int, default=200, help="Tokens in each fake completion")
+    parser.add_argument("--token-rate", type=float, default=50, help="Fake provider tokens per second")
+    parser.add_argument("--latency", type=float, default=0.3,
+                        help="Fake provider seconds before each completion starts")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of fake provider completions that fail")
+    args = parser.parse_args()
+
+    if args.url:
+        sys.exit(0 if run(args.url.rstrip("/"), args) else 1)
+
+    provider_port, server_port = free_port(), free_port()
+    database_dir = tempfile.TemporaryDirectory()
+    env = dict(os.environ,
+               JWT_SECRET_KEY="sidekick-load-test",
+               OPENAI_API_KEY="fake",
+               SQLALCHEMY_DATABASE_URI=f"sqlite:///{database_dir.name}/sidekick.db",
+               OPENAI_BASE_URL=f"http://127.0.0.1:{provider_port}/v1",
+               SIDEKICK_SERVER_PORT=str(server_port))
+    log = open(args.server_log, "w")
+    provider = subprocess.Popen([sys.executable, "benchmarks/fake_provider.py",
+                                 "--port", str(provider_port), "--tokens", str(args.tokens),
+                                 "--token-rate", str(args.token_rate), "--latency", str(args.latency),
+                                 "--error-rate", str(args.error_rate)],
+                                cwd=SERVER_DIR, stdout=log, stderr=log)
+    server = None
+    try:
+        subprocess.run([sys.executable, "init.py"], cwd=SERVER_DIR, env=env, check=True,
+                       stdout=log, stderr=log)
+        server = subprocess.Popen(args.server.format(port=server_port, workers=args.workers).split(),
+                                  cwd=SERVER_DIR, env=env, stdout=log, stderr=log)
+        url = f"http://127.0.0.1:{server_port}"
+        wait_for_url(url + "/ping")
+        ok = run(url, args)
+    finally:
+        if server is not None:
+            server.terminate()
+        provider.terminate()
+        database_dir.cleanup()
+        log.close()
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,567 @@
+"""
+Asyncio streaming server for the /chat/v2 route.
+
+The gunicorn app streams each chat response from a generator that holds a
+worker greenlet/thread for the whole life of the upstream stream. This server
+proxies the provider's SSE stream with non-blocking sockets instead, so one
+process can hold thousands of concurrent chat streams.
+
+It serves the same /chat/v2 request and response format as routes.chat_v2,
+authenticates with the same JWTs, and is run as a separate process alongside
+gunicorn with /chat/v2 routed to it by the ingress or reverse proxy:
+
+    SIDEKICK_ASYNC_CHAT_PORT=5001 python chat_stream_server.py
+"""
+import os
+import ssl
+import json
+import time
+import uuid
+import asyncio
+from contextlib import aclosing
+from datetime import datetime
+from urllib.parse import urlsplit
+
+import requests
+from flask_jwt_extended import decode_token
+
+from app import app, VERSION
+from utils import construct_ai_request, increment_server_stat, num_characters_from_messages, \
+    record_stream_usage, stream_usage_requested, chat_turn_messages, token_counter, DBUtils, \
+    CHAT_STREAM_ERROR
+from context_window import fit_ai_request, approximate_token_counter
+from sse_relay import SSERelay
+from chat_streams import chat_streams, request_cancel, STREAM_ID_HEADER
+from provider_router import ProviderRouter, parse_endpoints
+from ai_client import upstream_base_urls
+from admission import AdmissionController, AdmissionRejected
+from custom_utils.get_openai_token import get_openai_token
+
+CHATV2_ROUTE = "/chat/v2"
+
+CORS_HEADERS = ("Access-Control-Allow-Origin: *\r\n"
+                "Access-Control-Expose-Headers: X-Sidekick-Context-Dropped-Messages, "
+                "X-Sidekick-Context-Dropped-Tokens, " + STREAM_ID_HEADER + ", Retry-After\r\n"
+                "Access-Control-Allow-Headers: Authorization, Content-Type\r\n"
+                "Access-Control-Allow-Methods: POST, OPTIONS\r\n")
+
+
+class ClientDisconnected(Exception):
+    pass
+
+
+class StreamAborted(Exception):
+    """
+    Raised after a chat stream has been ended early with an error,
+    so the connection to the client is closed
+    """
+    pass
+
+
+def _in_app_context(fn, *args):
+    with app.app_context():
+        return fn(*args)
+
+
+def _log(level, message, **kwargs):
+    timestamp = datetime.now().strftime('%y%m%d-%H%M%S.%f')[:-3]
+    log_message = f"{level.upper()} version::{VERSION} time::{timestamp}, route::{CHATV2_ROUTE}, message::{message}"
+    for key, value in kwargs.items():
+        log_message += f", {key}::{value}"
+    getattr(app.logger, level)(log_message)
+
+
+async def read_headers(reader, timeout=None):
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if line in (b"\r\n", b"\n", b""):
+            return headers
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+
+
+async def iter_body(reader, headers, timeout=None):
+    """
+    Yield the body of an HTTP/1.1 response as it arrives,
+    decoding chunked transfer encoding if used.
+    Raises asyncio.TimeoutError if nothing arrives for timeout seconds.
+    """
+    if headers.get("transfer-encoding", "").lower() == "chunked":
+        while True:
+            size_line = await asyncio.wait_for(reader.readline(), timeout)
+            size = int(size_line.split(b";")[0].strip() or b"0", 16)
+            if size == 0:
+                await read_headers(reader, timeout)  # discard any trailers
+                return
+            data = await asyncio.wait_for(reader.readexactly(size + 2), timeout)
+            yield data[:-2]
+    elif "content-length" in headers:
+        remaining = int(headers["content-length"])
+        while remaining > 0:
+            data = await asyncio.wait_for(reader.read(min(remaining, 65536)), timeout)
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            yield data
+    else:
+        while True:
+            data = await asyncio.wait_for(reader.read(65536), timeout)
+            if not data:
+                return
+            yield data
+
+
+async def relay_body(relay, body):
+    """
+    Feed the body of an upstream stream to the relay and yield the lists of text
+    it releases, including buffered text released by polling while the upstream is quiet
+    """
+    next_data = None
+    try:
+        while True:
+            timeout = relay.flush_due_in()
+            if next_data is None:
+                if timeout is None:
+                    try:
+                        data = await body.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    yield relay.feed(data)
+                    continue
+                next_data = asyncio.ensure_future(body.__anext__())
+            done, _ = await asyncio.wait({next_data}, timeout=timeout)
+            if not done:
+                yield relay.poll()
+                continue
+            data_read, next_data = next_data, None
+            try:
+                data = data_read.result()
+            except StopAsyncIteration:
+                return
+            yield relay.feed(data)
+    finally:
+        if next_data is not None:
+            next_data.cancel()
+
+
+class AsyncUpstreamPool:
+    """
+    Keep-alive connections to the model providers, shared by all streams in this process
+    """
+    def __init__(self, maxsize=20):
+        self.maxsize = maxsize
+        self.idle = {}
+        self.ssl_context = ssl.create_default_context(cafile=os.getenv("REQUESTS_CA_BUNDLE"))
+
+    @staticmethod
+    def key(url):
+        parts = urlsplit(url)
+        port = parts.port or (443 if parts.scheme == "https" else 80)
+        return parts.scheme, parts.hostname, port
+
+    async def acquire(self, key):
+        """
+        Return an idle connection to the endpoint, or a new one if there is none,
+        and whether the connection was reused
+        """
+        idle = self.idle.get(key, [])
+        while idle:
+            reader, writer = idle.pop()
+            if not writer.is_closing() and not reader.at_eof():
+                return (reader, writer), True
+            writer.close()
+        return await self.connect(key), False
+
+    async def connect(self, key):
+        scheme, host, port = key
+        return await asyncio.open_connection(
+            host, port, ssl=self.ssl_context if scheme == "https" else None,
+            limit=2 ** 20)
+
+    def release(self, key, connection, reusable=True):
+        idle = self.idle.setdefault(key, [])
+        if reusable and len(idle) < self.maxsize:
+            idle.append(connection)
+        else:
+            connection[1].close()
+
+
+class ChatStreamServer:
+    def __init__(self, routers, pool_maxsize=20, connect_timeout=None, read_timeout=None, admission=None):
+        self.routers = routers
+        self.admission = admission or AdmissionController(max_concurrent=0, max_per_user=0)
+        self.pool = AsyncUpstreamPool(maxsize=pool_maxsize)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.open_streams = 0
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = await read_headers(reader)
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                path = urlsplit(target).path
+                if method == "OPTIONS":
+                    writer.write(("HTTP/1.1 204 No Content\r\n" + CORS_HEADERS +
+                                  "Content-Length: 0\r\n\r\n").encode())
+                elif method == "POST" and path == CHATV2_ROUTE:
+                    await self.chat_v2(writer, headers, body)
+                elif method == "POST" and path == CHATV2_ROUTE + "/cancel":
+                    await self.chat_v2_cancel(writer, headers, body)
+                elif method == "GET" and path == "/health":
+                    self.write_response(writer, 200, json.dumps({
+                        "status": "UP", "version": VERSION, "openStreams": self.open_streams}),
+                        "application/json")
+                else:
+                    self.write_response(writer, 404, "Not found")
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, ClientDisconnected, StreamAborted, asyncio.IncompleteReadError, ValueError):
+            pass
+        except Exception as e:
+            _log("error", "Error handling connection", error_message=str(e))
+        finally:
+            writer.close()
+
+    def write_response(self, writer, status, text, content_type="text/html; charset=utf-8", headers=None):
+        data = text.encode("utf-8")
+        headers = headers or {}
+        writer.write((f"HTTP/1.1 {status} {'OK' if status == 200 else 'Error'}\r\n" + CORS_HEADERS +
+                      f"Content-Type: {content_type}\r\n" +
+                      "".join(f"{name}: {value}\r\n" for name, value in headers.items()) +
+                      f"Content-Length: {len(data)}\r\n\r\n").encode() + data)
+
+    async def write_chunk(self, writer, text):
+        data = text.encode("utf-8")
+        if not data:
+            return
+        writer.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        try:
+            await writer.drain()
+        except ConnectionError as e:
+            raise ClientDisconnected() from e
+
+    def authenticate(self, headers):
+        token = headers.get("authorization", "").removeprefix("Bearer ").strip()
+        try:
+            with app.app_context():
+                return decode_token(token)["sub"]
+        except Exception:
+            return None
+
+    async def chat_v2(self, writer, headers, body):
+        start_time = time.time()
+        tid = str(uuid.uuid4())
+        user_id = self.authenticate(headers)
+        if user_id is None:
+            self.write_response(writer, 401, json.dumps({"msg": "Missing or invalid Authorization"}),
+                                "application/json")
+            return
+        increment_server_stat(category="requests", stat_name="chatV2")
+        try:
+            request_json = json.loads(body)
+            provider = request_json["model_settings"].get("provider")
+            ai_request = construct_ai_request(request_json)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            _log("info", "Invalid chat request", user=user_id, error_message=repr(e), tid=tid)
+            self.write_response(writer, 400, json.dumps({"msg": f"Invalid chat request: {e!r}"}),
+                                "application/json")
+            return
+        router = self.routers.get(provider, self.routers["OpenAI"])
+        ai_request["stream"] = True
+        if stream_usage_requested(provider):
+            ai_request["stream_options"] = {"include_usage": True}
+        # Counting the tokens of a long chat takes long enough to hold up the other streams
+        dropped_messages, dropped_tokens = await asyncio.to_thread(
+            fit_ai_request, ai_request, request_json["model_settings"],
+            token_counter if provider in (None, "OpenAI") else approximate_token_counter)
+        if dropped_messages:
+            increment_server_stat(category="usage", stat_name="contextDroppedMessages", increment=dropped_messages)
+            increment_server_stat(category="usage", stat_name="contextDroppedTokens", increment=dropped_tokens)
+            _log("info", "context-fitted", user=user_id, dropped_messages=dropped_messages,
+                 dropped_tokens=dropped_tokens, tid=tid)
+        promptCharacters = num_characters_from_messages(ai_request["messages"])
+        increment_server_stat(category="usage", stat_name="promptCharacters", increment=promptCharacters)
+        increment_server_stat(category="usage", stat_name="totalCharacters", increment=promptCharacters)
+
+        try:
+            ticket = await self.admission.acquire_async(user_id, "chatV2")
+        except AdmissionRejected as e:
+            _log("info", "AI request rejected", user=user_id, reason=e.reason, tid=tid)
+            self.write_response(writer, 429, str(e), headers={"Retry-After": e.retry_after})
+            return
+        try:
+            stream = chat_streams.open(user_id, request_json.get("stream_id"))
+            writer.write(("HTTP/1.1 200 OK\r\n" + CORS_HEADERS +
+                          "Content-Type: text/html; charset=utf-8\r\n"
+                          f"X-Sidekick-Context-Dropped-Messages: {dropped_messages}\r\n"
+                          f"X-Sidekick-Context-Dropped-Tokens: {dropped_tokens}\r\n"
+                          f"{STREAM_ID_HEADER}: {stream.id}\r\n"
+                          "Transfer-Encoding: chunked\r\n\r\n").encode())
+            self.open_streams += 1
+            relay = SSERelay(flush_interval=app.config["SIDEKICK_STREAM_FLUSH_INTERVAL"],
+                             flush_size=app.config["SIDEKICK_STREAM_FLUSH_SIZE"])
+            response_size = 0
+            closed_early = None
+            failed = False
+            document_id = request_json.get("document_id")
+            document_prompt = request_json.get("document_prompt", request_json["prompt"])
+            completion_text = []
+            try:
+                async with aclosing(self.stream_completion(router, ai_request, relay, stream,
+                                                           completion_text, user_id, tid)) as completion:
+                    async for text in completion:
+                        response_size += len(text)
+                        await self.write_chunk(writer, text)
+                writer.write(b"0\r\n\r\n")
+                if stream.cancel_requested:
+                    closed_early = "cancel"
+                _log("info", "stream-completed", user=user_id, size=response_size,
+                     duration=f"{time.time() - start_time:.3f}", tid=tid)
+            except ClientDisconnected:
+                # Closing the completion above closed the upstream connection
+                closed_early = "disconnect"
+                raise
+            except Exception as e:
+                # The 200 response has been sent, so end the stream with the error
+                # rather than leaving the client with a truncated response
+                _log("error", "Error in chat stream", user=user_id, error_message=repr(e), tid=tid)
+                failed = True
+                try:
+                    await self.write_chunk(writer, CHAT_STREAM_ERROR)
+                    writer.write(b"0\r\n\r\n")
+                    await writer.drain()
+                except (ConnectionError, ClientDisconnected):
+                    pass
+                raise StreamAborted() from e
+            finally:
+                self.open_streams -= 1
+                if stream.cancel_recorded:
+                    await asyncio.to_thread(_in_app_context, chat_streams.close, stream)
+                else:
+                    chat_streams.close(stream)
+                if closed_early:
+                    tokens_saved = chat_streams.record_closed_early(closed_early, relay.events)
+                    _log("info", "stream-closed-early", user=user_id, reason=closed_early,
+                         size=response_size, tokens_saved=tokens_saved, tid=tid)
+                    if closed_early == "disconnect" and app.config["SIDEKICK_COUNT_TOKENS"]:
+                        # The provider does not report the usage of a stream closed early
+                        await asyncio.to_thread(record_stream_usage, ai_request, relay)
+                elif relay.done:
+                    chat_streams.record_completed(relay.events)
+                if document_id:
+                    await self.append_to_chat_document(document_id, user_id, chat_turn_messages(
+                        document_prompt, "".join(completion_text), closed_early, failed), tid)
+        finally:
+            ticket.release()
+
+    async def append_to_chat_document(self, document_id, user_id, messages, tid):
+        try:
+            if not await asyncio.to_thread(_in_app_context, DBUtils.append_chat_messages,
+                                           document_id, user_id, messages):
+                _log("error", "Chat document not found", user=user_id, document_id=document_id, tid=tid)
+        except Exception as e:
+            _log("error", "Error appending to chat document", user=user_id, document_id=document_id,
+                 error_message=str(e), tid=tid)
+
+    async def chat_v2_cancel(self, writer, headers, body):
+        user_id = self.authenticate(headers)
+        if user_id is None:
+            self.write_response(writer, 401, json.dumps({"msg": "Missing or invalid Authorization"}),
+                                "application/json")
+            return
+        increment_server_stat(category="requests", stat_name="chatV2Cancel")
+        try:
+            stream_id = json.loads(body).get("stream_id")
+        except (ValueError, AttributeError):
+            stream_id = None
+        if not stream_id:
+            self.write_response(writer, 400, "stream_id is required")
+            return
+        # The stream may be open in a gunicorn worker, which will pick up
+        # the cancellation from the database
+        if not chat_streams.cancel(stream_id, user_id):
+            await asyncio.to_thread(_in_app_context, request_cancel, stream_id, user_id)
+        _log("info", "stream-cancel-requested", user=user_id, stream_id=stream_id)
+        self.write_response(writer, 200, json.dumps({"success": True, "stream_id": stream_id}),
+                            "application/json")
+
+    async def open_completion(self, router, ai_request):
+        """
+        Send the chat request to an endpoint chosen by the router, failing over to
+        another endpoint on a connect error or 5xx response while there is one to try.
+        Other errors are raised rather than sending the request again, as the
+        endpoint may already be generating the completion.
+
+        Returns the endpoint, pool key, upstream connection, status and response headers.
+        The caller must release the connection and finish the endpoint.
+        """
+        body = json.dumps(ai_request).encode("utf-8")
+        tried = []
+        while True:
+            endpoint = router.choose(exclude=tried)
+            tried.append(endpoint)
+            can_fail_over = router.choose(exclude=tried) is not None
+            key = self.pool.key(endpoint.url)
+            path = urlsplit(endpoint.url).path.rstrip("/") + "/chat/completions"
+            router.start(endpoint)
+            start_time = time.time()
+            try:
+                connection, reused = await asyncio.wait_for(self.pool.acquire(key), self.connect_timeout)
+            except (OSError, asyncio.TimeoutError):
+                router.finish(endpoint)
+                router.record_failure(endpoint)
+                if not can_fail_over:
+                    raise
+                router.record_failover()
+                continue
+            try:
+                try:
+                    status, headers = await self.send_request(connection, key, path, body)
+                except ConnectionError:
+                    if not reused:
+                        raise
+                    # The provider closed the idle pooled connection, e.g. at the end of its
+                    # keep-alive timeout, before reading the request, so send it on a new one
+                    connection[1].close()
+                    connection = await asyncio.wait_for(self.pool.connect(key), self.connect_timeout)
+                    status, headers = await self.send_request(connection, key, path, body)
+            except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, IndexError, ValueError):
+                connection[1].close()
+                router.finish(endpoint)
+                router.record_failure(endpoint)
+                raise
+            if status >= 500:
+                router.record_failure(endpoint)
+                if can_fail_over:
+                    connection[1].close()
+                    router.finish(endpoint)
+                    router.record_failover()
+                    continue
+            else:
+                router.record_success(endpoint, time.time() - start_time)
+            return endpoint, key, connection, status, headers
+
+    async def send_request(self, connection, key, path, body):
+        """
+        Send the chat request on an upstream connection and return the response status and headers
+        """
+        reader, writer = connection
+        writer.write((f"POST {path} HTTP/1.1\r\n"
+                      f"Host: {key[1]}:{key[2]}\r\n"
+                      "Content-Type: application/json; charset=utf-8\r\n"
+                      "Accept: text/event-stream\r\n"
+                      f"Authorization: Bearer {get_openai_token()}\r\n"
+                      f"Content-Length: {len(body)}\r\n\r\n").encode() + body)
+        await writer.drain()
+        status_line = await asyncio.wait_for(reader.readline(), self.read_timeout)
+        if not status_line:
+            raise ConnectionResetError("Connection closed before the response")
+        status = int(status_line.split(b" ", 2)[1])
+        return status, await read_headers(reader, self.read_timeout)
+
+    async def stream_completion(self, router, ai_request, relay, stream, completion_text, user_id, tid):
+        """
+        Send the chat request upstream and yield the text of the content deltas, also
+        appending it to completion_text, or yield the error if the request fails.
+        The error is not appended so that it is not saved in the chat as a reply.
+        """
+        endpoint, key, (reader, writer), status, headers = await self.open_completion(router, ai_request)
+        reusable = False
+        try:
+            if status != 200:
+                error_body = b"".join([data async for data in iter_body(reader, headers, self.read_timeout)])
+                error_message = f"Error - OpenAI API returned status code {status}"
+                try:
+                    for k, v in json.loads(error_body)["error"].items():
+                        error_message += f", {k}: {v}"
+                except (ValueError, KeyError, TypeError, AttributeError):
+                    pass
+                _log("error", "Error returned by OpenAI", user=user_id, status_code=status,
+                     error_message=error_message, tid=tid)
+                reusable = headers.get("connection", "").lower() != "close"
+                yield error_message
+                return
+            increment_server_stat(category="responses", stat_name="chatV2")
+
+            async for texts in relay_body(relay, iter_body(reader, headers, self.read_timeout)):
+                for text in texts:
+                    completion_text.append(text)
+                    yield text
+                if not stream.cancel_requested and chat_streams.poll_due():
+                    # One check of the database for all the streams open in this process
+                    await asyncio.to_thread(_in_app_context, chat_streams.poll)
+                if stream.cancel_requested:
+                    # Leaving the connection unread means it is closed, which stops the upstream stream
+                    break
+            for text in relay.close():
+                completion_text.append(text)
+                yield text
+            for error in relay.errors:
+                _log("error", "Error in chat stream", user=user_id, error_message=error, tid=tid)
+            increment_server_stat(category="usage", stat_name="completionCharacters", increment=relay.characters)
+            increment_server_stat(category="usage", stat_name="totalCharacters", increment=relay.characters)
+            if app.config["SIDEKICK_COUNT_TOKENS"]:
+                await asyncio.to_thread(record_stream_usage, ai_request, relay)
+            reusable = not stream.cancel_requested and \
+                ("content-length" in headers or "chunked" in headers.get("transfer-encoding", "")) \
+                and headers.get("connection", "").lower() != "close"
+        finally:
+            self.pool.release(key, (reader, writer), reusable)
+            router.finish(endpoint)
+
+
+async def check_health(routers, interval):
+    """
+    Check the health of the endpoints every interval seconds,
+    if any provider has more than one endpoint to route between
+    """
+    if interval <= 0 or all(len(router.endpoints) < 2 for router in routers.values()):
+        return
+    session = requests.Session()
+    while True:
+        await asyncio.sleep(interval)
+        headers = {"Authorization": f"Bearer {get_openai_token()}"}
+        for router in routers.values():
+            try:
+                await asyncio.to_thread(router.check_health, session, headers)
+            except Exception as e:
+                _log("error", "Upstream health check failed", error_message=str(e))
+
+
+async def serve(host, port):
+    routers = {
+        provider: ProviderRouter(provider, parse_endpoints(urls),
+                                 policy=app.config["SIDEKICK_UPSTREAM_ROUTING_POLICY"],
+                                 failure_threshold=app.config["SIDEKICK_UPSTREAM_FAILURE_THRESHOLD"])
+        for provider, urls in upstream_base_urls().items()
+    }
+    server = ChatStreamServer(
+        routers=routers,
+        pool_maxsize=app.config["SIDEKICK_UPSTREAM_POOL_MAXSIZE"],
+        connect_timeout=app.config["SIDEKICK_UPSTREAM_CONNECT_TIMEOUT"],
+        read_timeout=app.config["SIDEKICK_UPSTREAM_READ_TIMEOUT"],
+        admission=AdmissionController(
+            max_concurrent=app.config["SIDEKICK_STREAM_ADMISSION_MAX_CONCURRENT"],
+            max_per_user=app.config["SIDEKICK_STREAM_ADMISSION_MAX_PER_USER"],
+            max_queue=app.config["SIDEKICK_ADMISSION_MAX_QUEUE"],
+            max_queue_per_user=app.config["SIDEKICK_ADMISSION_MAX_QUEUE_PER_USER"],
+            max_wait=app.config["SIDEKICK_ADMISSION_MAX_WAIT"]))
+    health_checks = asyncio.create_task(check_health(
+        routers, app.config["SIDEKICK_UPSTREAM_HEALTH_CHECK_INTERVAL"]))
+    asyncio_server = await asyncio.start_server(server.handle_connection, host, port,
+                                                backlog=4096, limit=2 ** 24)
+    app.logger.info(f"message::Sidekick async chat server started, version::{VERSION}, port::{port}")
+    async with asyncio_server:
+        await asyncio_server.serve_forever()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(os.environ.get("SIDEKICK_ASYNC_CHAT_HOST", "0.0.0.0"),
+                      int(os.environ.get("SIDEKICK_ASYNC_CHAT_PORT", 5001))))
@@ -0,0 +1,174 @@
+import time
+import uuid
+import threading
+
+from prometheus_client import Counter
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from models import CancelledStream
+
+CHAT_STREAMS_CANCELLED = Counter(
+    "sidekick_chat_streams_cancelled_total",
+    "Chat streams whose upstream request was closed early, by reason (disconnect or cancel)",
+    ["reason"])
+CHAT_CANCEL_TOKENS_SAVED = Counter(
+    "sidekick_chat_cancel_tokens_saved_total",
+    "Estimated completion tokens not generated because chat streams were closed early, "
+    "based on the average length of completed streams")
+
+# Header the stream id is returned in, for use with /chat/v2/cancel
+STREAM_ID_HEADER = "X-Sidekick-Stream-Id"
+
+# Cancellation requests older than this are removed
+CANCELLED_STREAM_TTL = 3600
+
+# The most stream ids to look up in one query
+CANCELLED_STREAMS_QUERY_SIZE = 500
+
+
+class ChatStream:
+    def __init__(self, registry, stream_id, user_id):
+        self.registry = registry
+        self.id = stream_id
+        self.user_id = user_id
+        self.cancel_requested = False
+        self.cancel_recorded = False
+
+    def cancelled(self):
+        """
+        Return True if the stream has been cancelled by this or another worker.
+        The database is checked at most once per poll_interval for all the
+        streams open in this process.
+        """
+        if not self.cancel_requested and self.registry.poll_due():
+            self.registry.poll()
+        return self.cancel_requested
+
+
+class ChatStreams:
+    """
+    The chat streams open in this process, so they can be cancelled by
+    stream id, and the running average completion length used to estimate
+    the tokens saved when a stream is closed early.
+
+    Stream ids can be chosen by the web UI, so streams are looked up by user
+    and stream id and one user's streams cannot be found with another's ids.
+    """
+    def __init__(self, poll_interval=1.0, clock=time.monotonic):
+        self.poll_interval = poll_interval
+        self.clock = clock
+        self.streams = {}
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.completed_tokens = 0
+        self.last_poll = clock()
+
+    def open(self, user_id, stream_id=None):
+        stream = ChatStream(self, stream_id or str(uuid.uuid4()), user_id)
+        with self.lock:
+            self.streams[(user_id, stream.id)] = stream
+        return stream
+
+    def close(self, stream):
+        with self.lock:
+            if self.streams.get((stream.user_id, stream.id)) is stream:
+                del self.streams[(stream.user_id, stream.id)]
+        if stream.cancel_recorded:
+            clear_cancel(stream.id, stream.user_id)
+
+    def cancel(self, stream_id, user_id):
+        """
+        Cancel a stream open in this process. Returns True if it was found.
+        """
+        with self.lock:
+            stream = self.streams.get((user_id, stream_id))
+        if stream is None:
+            return False
+        stream.cancel_requested = True
+        return True
+
+    def poll_due(self):
+        """
+        Return True if the database should be checked for cancellations now.
+        Returns True once per poll_interval, to the stream that should check it.
+        """
+        if self.poll_interval <= 0:
+            return False
+        with self.lock:
+            now = self.clock()
+            if now - self.last_poll < self.poll_interval:
+                return False
+            self.last_poll = now
+            return True
+
+    def poll(self):
+        """
+        Check the database for cancellations of the streams open in this process
+        received by other workers. If the check fails the streams carry on.
+        """
+        with self.lock:
+            streams = dict(self.streams)
+        if not streams:
+            return
+        try:
+            cancelled = cancelled_streams(list(streams))
+        except Exception as e:
+            db.session.rollback()
+            app.logger.error(f"message::Error checking for cancelled chat streams, error_message::{e}")
+            return
+        for key in cancelled:
+            stream = streams[key]
+            stream.cancel_requested = stream.cancel_recorded = True
+
+    def record_completed(self, tokens):
+        with self.lock:
+            self.completed += 1
+            self.completed_tokens += tokens
+
+    def record_closed_early(self, reason, tokens):
+        """
+        Record a stream closed after receiving tokens, because the client
+        disconnected or cancelled it. Returns the estimated tokens saved.
+        """
+        with self.lock:
+            average = self.completed_tokens / self.completed if self.completed else 0
+        tokens_saved = max(0, round(average) - tokens)
+        CHAT_STREAMS_CANCELLED.labels(reason=reason).inc()
+        CHAT_CANCEL_TOKENS_SAVED.inc(tokens_saved)
+        return tokens_saved
+
+
+def request_cancel(stream_id, user_id):
+    """
+    Record that the user cancelled the stream, for the worker streaming it to pick up
+    """
+    now = time.time()
+    try:
+        CancelledStream.query.filter(CancelledStream.cancelled < now - CANCELLED_STREAM_TTL).delete()
+        db.session.merge(CancelledStream(stream_id=stream_id, user_id=user_id, cancelled=now))
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+
+
+def cancelled_streams(keys):
+    """
+    Return the (user_id, stream_id) keys of the given streams that have been cancelled
+    """
+    keys = set(keys)
+    stream_ids = sorted({stream_id for _, stream_id in keys})
+    cancelled = set()
+    for start in range(0, len(stream_ids), CANCELLED_STREAMS_QUERY_SIZE):
+        rows = db.session.query(CancelledStream.user_id, CancelledStream.stream_id).filter(
+            CancelledStream.stream_id.in_(stream_ids[start:start + CANCELLED_STREAMS_QUERY_SIZE]))
+        cancelled.update((user_id, stream_id) for user_id, stream_id in rows if (user_id, stream_id) in keys)
+    return cancelled
+
+
+def clear_cancel(stream_id, user_id):
+    CancelledStream.query.filter_by(stream_id=stream_id, user_id=user_id).delete()
+    db.session.commit()
+
+
+chat_streams = ChatStreams(poll_interval=app.config["SIDEKICK_STREAM_CANCEL_POLL_INTERVAL"])
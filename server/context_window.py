@@ -0,0 +1,89 @@
+import json
+from functools import lru_cache
+
+from app import app
+from token_counter import TokenCounter
+
+approximate_token_counter = TokenCounter(approximate=True)
+
+
+@lru_cache(maxsize=1)
+def default_model_settings():
+    with open("default_settings/model_settings.json", "r") as f:
+        return json.load(f)["model_settings"]
+
+
+def get_context_token_size(model_settings):
+    """
+    Return the context window size in tokens for the model in a /chat/v2 model_settings,
+    from default_settings/model_settings.json or else as sent by the web UI.
+    Returns None if the size is not known.
+    """
+    provider = model_settings.get("provider")
+    model = model_settings.get("request", {}).get("model")
+    providers = default_model_settings().get("providers", {})
+    context_token_size = providers.get(provider, {}).get("models", {}) \
+        .get(model, {}).get("contextTokenSize")
+    if context_token_size is None:
+        context_token_size = model_settings.get("contextTokenSize")
+    try:
+        return int(context_token_size) if context_token_size else None
+    except (TypeError, ValueError):
+        return None
+
+
+def fit_context_window(messages, context_token_size, completion_tokens, model,
+                       token_counter=approximate_token_counter):
+    """
+    Drop the oldest chat history messages until the messages fit in the model's
+    context window, leaving room for completion_tokens of response. The system
+    prompt (the first message) and the prompt (the last message) are always kept.
+
+    Returns:
+        messages: The messages that fit in the context window
+        dropped_messages: The number of messages dropped
+        dropped_tokens: The number of tokens dropped
+    """
+    budget = context_token_size - completion_tokens
+    # A token is at least one byte, so if there are fewer bytes than the budget
+    # the messages fit without having to count their tokens
+    num_bytes = sum(len(k) + len(str(v).encode("utf-8")) + 4
+                    for message in messages for k, v in message.items()) + 3
+    if num_bytes <= budget or len(messages) <= 2:
+        return messages, 0, 0
+    try:
+        message_tokens = token_counter.count_each_message(messages, model)
+    except Exception:
+        message_tokens = approximate_token_counter.count_each_message(messages, model)
+    num_tokens = sum(message_tokens) + 3
+    first_kept = 1
+    dropped_tokens = 0
+    while num_tokens > budget and first_kept < len(messages) - 1:
+        num_tokens -= message_tokens[first_kept]
+        dropped_tokens += message_tokens[first_kept]
+        first_kept += 1
+    dropped_messages = first_kept - 1
+    if dropped_messages == 0:
+        return messages, 0, 0
+    return [messages[0]] + messages[first_kept:], dropped_messages, dropped_tokens
+
+
+def fit_ai_request(ai_request, model_settings, token_counter=approximate_token_counter):
+    """
+    Fit the messages of a /chat/v2 ai_request in the model's context window
+
+    Returns:
+        dropped_messages: The number of chat history messages dropped
+        dropped_tokens: The number of tokens dropped
+    """
+    if not app.config["SIDEKICK_CONTEXT_FITTING"]:
+        return 0, 0
+    context_token_size = get_context_token_size(model_settings)
+    if context_token_size is None:
+        return 0, 0
+    completion_tokens = ai_request.get("max_tokens") or \
+        min(app.config["SIDEKICK_CONTEXT_COMPLETION_TOKENS"], context_token_size // 4)
+    ai_request["messages"], dropped_messages, dropped_tokens = fit_context_window(
+        ai_request["messages"], context_token_size, completion_tokens,
+        ai_request.get("model", ""), token_counter)
+    return dropped_messages, dropped_tokens
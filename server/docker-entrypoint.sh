@@ -1,2 +1,5 @@
 python init.py
+if [ -n "$SIDEKICK_ASYNC_CHAT_PORT" ]; then
+    python chat_stream_server.py &
+fi
 gunicorn --worker-class gevent -b 0.0.0.0:5000 app:app --timeout 120 --workers 4 --threads 4
\ No newline at end of file
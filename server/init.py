@@ -1,9 +1,23 @@
 import os
-from flask_migrate import upgrade
+from flask_migrate import upgrade, stamp
+from sqlalchemy import inspect
 from sqlalchemy.engine.url import make_url
 from sqlalchemy.exc import NoResultFound
 from app import app, db
 
+# the revision matching the tables of SQLite databases that init set up with create_all
+SQLITE_CREATE_ALL_REVISION = "4e52a8b4c8f1"
+
+def stamp_create_all_database():
+    """
+    Stamp a SQLite database that init set up with create_all, before it ran
+    the migrations, so that upgrade adds the changes made since
+    """
+    tables = inspect(db.engine).get_table_names()
+    if "documents" in tables and "alembic_version" not in tables:
+        app.logger.info(f"Stamping database with revision {SQLITE_CREATE_ALL_REVISION}...")
+        stamp(directory="migrations", revision=SQLITE_CREATE_ALL_REVISION)
+
 def init():
     try:
         app.logger.info("Initializing Sidekick server...")
@@ -11,12 +25,12 @@ def init():
         db_dialect_name = db_url.get_dialect().name
 
         with app.app_context():
-            from utils import DBUtils, get_random_string, update_system_settings, update_default_settings
+            from utils import DBUtils, get_random_string, update_system_settings, update_default_settings, \
+                update_default_documents
             
             if db_dialect_name == "sqlite":
-                db.create_all()
-            if db_dialect_name == "postgresql":
-                upgrade(directory="migrations")
+                stamp_create_all_database()
+            upgrade(directory="migrations")
 
             # Create sidekick user if they don't exist
             try:
@@ -39,6 +53,7 @@ def init():
                 
             update_system_settings()
             update_default_settings("sidekick")
+            update_default_documents()
         app.logger.info("Sidekick server initialized.")
     except Exception as e:
         app.logger.error("Sidekick server initialization failed.")
@@ -0,0 +1,48 @@
+"""Add documents access pattern indexes
+
+Revision ID: 7d4e2a9c1f36
+Revises: 5b7f3c9d2e18
+Create Date: 2026-10-18 19:42:07.514930
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d4e2a9c1f36'
+down_revision = '5b7f3c9d2e18'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_documents_user_id_type_name', 'documents', ['user_id', 'type', 'name']),
+    ('ix_documents_type_visibility_user_id', 'documents', ['type', 'visibility', 'user_id']),
+    ('ix_document_tags_tag_name', 'document_tags', ['tag_name']),
+    ('ix_user_tags_tag_name', 'user_tags', ['tag_name']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        # Build the indexes without locking the tables against writes, which can take
+        # a while on a large documents table. CONCURRENTLY cannot run in a transaction.
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=True, if_not_exists=True)
+    else:
+        for name, table, columns in INDEXES:
+            with op.batch_alter_table(table, schema=None) as batch_op:
+                batch_op.create_index(name, columns, unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        for name, table, columns in reversed(INDEXES):
+            with op.batch_alter_table(table, schema=None) as batch_op:
+                batch_op.drop_index(name)
@@ -0,0 +1,44 @@
+"""Add documents updated date indexes
+
+Revision ID: c81f5e3a7d02
+Revises: 7d4e2a9c1f36
+Create Date: 2026-10-18 20:16:44.208153
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f5e3a7d02'
+down_revision = '7d4e2a9c1f36'
+branch_labels = None
+depends_on = None
+
+INDEXES = [
+    ('ix_documents_user_id_type_updated_date', 'documents', ['user_id', 'type', 'updated_date', 'id']),
+    ('ix_documents_type_visibility_updated_date', 'documents', ['type', 'visibility', 'updated_date', 'id']),
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in INDEXES:
+                op.create_index(name, table, columns, unique=False,
+                                postgresql_concurrently=True, if_not_exists=True)
+    else:
+        with op.batch_alter_table('documents', schema=None) as batch_op:
+            for name, table, columns in INDEXES:
+                batch_op.create_index(name, columns, unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            for name, table, columns in reversed(INDEXES):
+                op.drop_index(name, table_name=table, postgresql_concurrently=True, if_exists=True)
+    else:
+        with op.batch_alter_table('documents', schema=None) as batch_op:
+            for name, table, columns in reversed(INDEXES):
+                batch_op.drop_index(name)
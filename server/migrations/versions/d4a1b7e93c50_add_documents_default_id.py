@@ -0,0 +1,169 @@
+"""Add documents default_id and share the default documents
+
+Revision ID: d4a1b7e93c50
+Revises: c81f5e3a7d02
+Create Date: 2026-10-18 22:41:09.517203
+
+The personas and prompt templates from default_documents used to be copied
+to every user. The sidekick user's copies become the shared default
+documents, each user's copies are linked to them with default_id, and the
+copies the user has not changed are deleted.
+
+The copies have no record of the default they were copied from, so they
+are matched by the order they were made in when the user was created,
+which is the order the sidekick user's copies were made in. The copies the
+user has not renamed anchor the match, so a renamed copy is linked to the
+default in its place. A default the user has no copy of, because they
+deleted it, gets a copy with visibility 'deleted' to keep it hidden from
+them.
+
+Downgrading does not bring back the deleted copies: users keep the ones
+they changed, and the shared default documents become the sidekick user's
+private documents again.
+"""
+import uuid
+import difflib
+from datetime import datetime, timedelta
+from collections import defaultdict
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a1b7e93c50'
+down_revision = 'c81f5e3a7d02'
+branch_labels = None
+depends_on = None
+
+DEFAULT_DOCUMENTS_USER_ID = 'sidekick'
+DEFAULT_DOCUMENT_TYPES = "('personas', 'prompt_templates')"
+
+# the copies made of the default documents when a user was created are the
+# user's documents of those types created this soon after their first document
+SEEDING_WINDOW = timedelta(seconds=60)
+
+# the users' copies that are the same as the default document they were copied from
+UNCHANGED_COPIES = """
+    SELECT c.id FROM documents c JOIN documents d ON d.id = c.default_id
+    WHERE c.visibility = 'private' AND c.name = d.name
+    AND c.content = d.content AND c.properties = d.properties
+    AND NOT EXISTS (SELECT 1 FROM document_tags ct WHERE ct.document_id = c.id
+                    AND NOT EXISTS (SELECT 1 FROM document_tags dt
+                                    WHERE dt.document_id = d.id AND dt.tag_name = ct.tag_name))
+    AND NOT EXISTS (SELECT 1 FROM document_tags dt WHERE dt.document_id = d.id
+                    AND NOT EXISTS (SELECT 1 FROM document_tags ct
+                                    WHERE ct.document_id = c.id AND ct.tag_name = dt.tag_name))
+"""
+
+
+def parse_date(date):
+    try:
+        return datetime.fromisoformat(date)
+    except (TypeError, ValueError):
+        return None
+
+
+def match_copies(defaults, copies):
+    """
+    Match the copies a user was given when they were created to the defaults, both
+    (id, name) in the order they were made. Returns the (default id, copy id) pairs
+    and the ids of the defaults the user has no copy of.
+    """
+    matches, missing = [], []
+    matcher = difflib.SequenceMatcher(None, [name for _, name in defaults],
+                                      [name for _, name in copies], autojunk=False)
+    for _, i1, i2, j1, j2 in matcher.get_opcodes():
+        # equal names, or renamed copies in the place of the defaults they were copied from
+        paired = min(i2 - i1, j2 - j1)
+        matches += [(defaults[i][0], copies[j][0]) for i, j in zip(range(i1, i1 + paired), range(j1, j1 + paired))]
+        missing += [defaults[i][0] for i in range(i1 + paired, i2)]
+    return matches, missing
+
+
+def link_copies(connection):
+    """
+    Link every other user's copies of the default documents to them with default_id,
+    and add a 'deleted' copy of each default document the user has deleted
+    """
+    defaults = defaultdict(list)
+    for id, type, name in connection.execute(sa.text(
+            f"SELECT id, type, name FROM documents WHERE user_id = '{DEFAULT_DOCUMENTS_USER_ID}' "
+            f"AND visibility = 'default' ORDER BY created_date, id")):
+        defaults[type].append((id, name))
+    if not defaults:
+        return
+    first_created = {user_id: parse_date(created) for user_id, created in connection.execute(sa.text(
+        "SELECT user_id, MIN(created_date) FROM documents GROUP BY user_id"))}
+    copies = defaultdict(lambda: defaultdict(list))
+    for id, user_id, type, name, created in connection.execute(sa.text(
+            f"SELECT id, user_id, type, name, created_date FROM documents "
+            f"WHERE user_id != '{DEFAULT_DOCUMENTS_USER_ID}' AND type IN {DEFAULT_DOCUMENT_TYPES} "
+            f"ORDER BY created_date, id")):
+        created, first = parse_date(created), first_created.get(user_id)
+        if created is not None and first is not None and created - first <= SEEDING_WINDOW:
+            copies[user_id][type].append((id, name))
+
+    links, deleted = [], []
+    now = str(datetime.now())
+    users = [row[0] for row in connection.execute(sa.text(
+        f"SELECT id FROM users WHERE id != '{DEFAULT_DOCUMENTS_USER_ID}'"))]
+    for user_id in users:
+        for type, type_defaults in defaults.items():
+            matches, missing = match_copies(type_defaults, copies[user_id][type])
+            links += [{"id": copy_id, "default_id": default_id} for default_id, copy_id in matches]
+            deleted += [{"id": str(uuid.uuid4()), "user_id": user_id, "default_id": default_id,
+                         "now": now} for default_id in missing]
+    if links:
+        connection.execute(sa.text("UPDATE documents SET default_id = :default_id WHERE id = :id"), links)
+    if deleted:
+        connection.execute(sa.text(
+            "INSERT INTO documents (id, user_id, default_id, name, type, created_date, updated_date, "
+            "properties, content, visibility, size) "
+            "SELECT :id, :user_id, id, name, type, :now, :now, '{}', '{}', 'deleted', 0 "
+            "FROM documents WHERE id = :default_id"), deleted)
+
+
+def upgrade():
+    with op.batch_alter_table('documents', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('default_id', sa.String(), nullable=True))
+
+    op.execute(f"UPDATE documents SET visibility = 'default' "
+               f"WHERE user_id = '{DEFAULT_DOCUMENTS_USER_ID}' AND visibility = 'private' "
+               f"AND type IN {DEFAULT_DOCUMENT_TYPES}")
+    connection = op.get_bind()
+    link_copies(connection)
+    unchanged_ids = [row[0] for row in connection.execute(sa.text(UNCHANGED_COPIES))]
+    for start in range(0, len(unchanged_ids), 1000):
+        ids = {"ids": unchanged_ids[start:start + 1000]}
+        connection.execute(sa.text("DELETE FROM document_tags WHERE document_id IN :ids")
+                           .bindparams(sa.bindparam("ids", expanding=True)), ids)
+        connection.execute(sa.text("DELETE FROM documents WHERE id IN :ids")
+                           .bindparams(sa.bindparam("ids", expanding=True)), ids)
+
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.create_index('ix_documents_user_id_default_id', 'documents', ['user_id', 'default_id'],
+                            unique=False, postgresql_concurrently=True, if_not_exists=True)
+    else:
+        with op.batch_alter_table('documents', schema=None) as batch_op:
+            batch_op.create_index('ix_documents_user_id_default_id', ['user_id', 'default_id'], unique=False)
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        with op.get_context().autocommit_block():
+            op.drop_index('ix_documents_user_id_default_id', table_name='documents',
+                          postgresql_concurrently=True, if_exists=True)
+    else:
+        with op.batch_alter_table('documents', schema=None) as batch_op:
+            batch_op.drop_index('ix_documents_user_id_default_id')
+
+    # the copies that only hide a deleted default document from a user
+    op.execute("DELETE FROM document_tags WHERE document_id IN "
+               "(SELECT id FROM documents WHERE visibility = 'deleted')")
+    op.execute("DELETE FROM documents WHERE visibility = 'deleted'")
+    op.execute("UPDATE documents SET visibility = 'private' WHERE visibility = 'default'")
+
+    with op.batch_alter_table('documents', schema=None) as batch_op:
+        batch_op.drop_column('default_id')
@@ -1,7 +1,6 @@
 import json
 import uuid
 from datetime import datetime
-from collections import Counter
 
 from app import db
 
@@ -29,12 +28,19 @@ class User(db.Model):
         return {"id": self.id, "name": self.name, "is_oidc": self.is_oidc,
                 "properties": json.loads(self.properties)}
 
-    def get_document_stats(self):
-        document_types = [doc.type for doc in self.documents]
-        return dict(Counter(document_types))
-
 class Document(db.Model):
     __tablename__ = "documents"
+    __table_args__ = (
+        # a user's documents of a type, e.g. listing their chats, and by name, e.g. their settings
+        db.Index("ix_documents_user_id_type_name", "user_id", "type", "name"),
+        # the shared documents of a type
+        db.Index("ix_documents_type_visibility_user_id", "type", "visibility", "user_id"),
+        # pages of the /docdb listings in updated_date order
+        db.Index("ix_documents_user_id_type_updated_date", "user_id", "type", "updated_date", "id"),
+        db.Index("ix_documents_type_visibility_updated_date", "type", "visibility", "updated_date", "id"),
+        # a user's copy of a shared default document
+        db.Index("ix_documents_user_id_default_id", "user_id", "default_id"),
+    )
 
     id = db.Column(db.String, default=str(uuid.uuid4()), primary_key=True)
     user_id = db.Column(db.ForeignKey(User.id), nullable=False)
@@ -49,6 +55,8 @@ class Document(db.Model):
     content = db.Column(db.String, default="{}", nullable=False)
     visibility = db.Column(db.String, default="private", nullable=False)
     size = db.Column(db.Integer, default=0, nullable=False)
+    # the shared default document that this is the user's copy of, see DBUtils.copy_on_write
+    default_id = db.Column(db.String, nullable=True)
 
     user = db.relationship("User", back_populates="documents")
 
@@ -68,22 +76,28 @@ class Document(db.Model):
     
     def as_dict(self):
         return {
-            "metadata": {
-                "id": self.id,
-                "user_id": self.user_id,
-                "user_name": self.user.name, # return the name of the user for easy reference
-                "visibility": self.visibility,
-                "name": self.name,
-                "type": self.type,
-                "created_date": self.created_date,
-                "updated_date": self.updated_date,
-                "size": self.size,
-                "tags": [tag.tag_name for tag in self.tags],
-                "properties": json.loads(self.properties),
-            },
+            "metadata": self.metadata_as_dict(),
             "content": json.loads(self.content)
         }
 
+    def metadata_as_dict(self):
+        """
+        The metadata of the document, which does not need the content to be loaded
+        """
+        return {
+            "id": self.id,
+            "user_id": self.user_id,
+            "user_name": self.user.name, # return the name of the user for easy reference
+            "visibility": self.visibility,
+            "name": self.name,
+            "type": self.type,
+            "created_date": self.created_date,
+            "updated_date": self.updated_date,
+            "size": self.size,
+            "tags": [tag.tag_name for tag in self.tags],
+            "properties": json.loads(self.properties),
+        }
+
 
 class Tag(db.Model):
     __tablename__ = "tags"
@@ -99,7 +113,7 @@ class DocumentTag(db.Model):
     __tablename__ = "document_tags"
 
     document_id = db.Column(db.ForeignKey(Document.id), primary_key=True)
-    tag_name = db.Column(db.ForeignKey(Tag.name), primary_key=True)
+    tag_name = db.Column(db.ForeignKey(Tag.name), primary_key=True, index=True)
     created_date = db.Column(db.String(), default=str(datetime.now()),
                              nullable=False)
     updated_date = db.Column(db.String(), default=str(datetime.now()),
@@ -109,8 +123,25 @@ class UserTag(db.Model):
     __tablename__ = "user_tags"
 
     user_id = db.Column(db.ForeignKey(User.id), primary_key=True)
-    tag_name = db.Column(db.ForeignKey(Tag.name), primary_key=True)
+    tag_name = db.Column(db.ForeignKey(Tag.name), primary_key=True, index=True)
     created_date = db.Column(db.String(), default=str(datetime.now()),
                              nullable=False)
     updated_date = db.Column(db.String(), default=str(datetime.now()),
                              nullable=False)
+
+
+class CachedResponse(db.Model):
+    __tablename__ = "response_cache"
+
+    key = db.Column(db.String, primary_key=True)
+    response = db.Column(db.String, nullable=False)
+    expires = db.Column(db.Float, nullable=False)
+    last_accessed = db.Column(db.Float, nullable=False, index=True)
+
+
+class CancelledStream(db.Model):
+    __tablename__ = "cancelled_streams"
+
+    user_id = db.Column(db.String, primary_key=True)
+    stream_id = db.Column(db.String, primary_key=True)
+    cancelled = db.Column(db.Float, nullable=False, index=True)
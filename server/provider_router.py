@@ -0,0 +1,159 @@
+import time
+import random
+import threading
+
+from prometheus_client import Counter, Gauge
+
+UPSTREAM_FAILOVERS = Counter(
+    "sidekick_upstream_failovers_total",
+    "Upstream requests retried on another endpoint after a connect error or 5xx response",
+    ["provider"])
+UPSTREAM_ENDPOINT_UP = Gauge(
+    "sidekick_upstream_endpoint_up",
+    "Whether an upstream endpoint is in rotation (1) or out of rotation (0)",
+    ["provider", "url"])
+UPSTREAM_ENDPOINT_OUTSTANDING = Gauge(
+    "sidekick_upstream_endpoint_outstanding_requests",
+    "Requests in progress on an upstream endpoint",
+    ["provider", "url"])
+
+ROUTING_POLICIES = ("weighted", "least_outstanding", "ewma")
+
+
+def parse_endpoints(endpoints):
+    """
+    Parse a comma separated list of endpoint base URLs, each with an optional weight, e.g.
+        http://box1:11434/v1;weight=3,http://box2:11434/v1
+    Returns a list of (url, weight) tuples.
+    """
+    parsed = []
+    for endpoint in endpoints.split(","):
+        if not endpoint.strip():
+            continue
+        url, *options = endpoint.strip().split(";")
+        weight = 1.0
+        for option in options:
+            name, _, value = option.partition("=")
+            if name.strip() == "weight":
+                weight = float(value)
+        parsed.append((url.rstrip("/"), weight))
+    return parsed
+
+
+class Endpoint:
+    def __init__(self, provider, url, weight=1.0):
+        self.provider = provider
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.healthy = True
+        self.consecutive_failures = 0
+        UPSTREAM_ENDPOINT_UP.labels(provider=provider, url=url).set(1)
+
+    def __repr__(self):
+        return "<Endpoint %r>" % self.url
+
+
+class ProviderRouter:
+    """
+    Spreads the requests for one provider across several OpenAI compatible endpoints.
+
+    Policies:
+        weighted: pick an endpoint at random in proportion to its weight
+        least_outstanding: pick the endpoint with the fewest requests in progress per unit of weight
+        ewma: pick the endpoint with the lowest exponentially weighted moving average latency,
+              scaled by the requests it already has in progress
+
+    An endpoint is taken out of rotation after failure_threshold consecutive
+    connect errors or 5xx responses, or when a health check fails, and is put
+    back when a health check succeeds. If every endpoint is out of rotation
+    they are all tried anyway rather than failing without trying.
+    """
+    def __init__(self, provider, endpoints, policy="least_outstanding",
+                 ewma_alpha=0.3, failure_threshold=3):
+        if policy not in ROUTING_POLICIES:
+            raise ValueError(f"Unknown routing policy {policy}, expected one of {ROUTING_POLICIES}")
+        self.provider = provider
+        self.endpoints = [Endpoint(provider, url, weight) for url, weight in endpoints]
+        self.policy = policy
+        self.ewma_alpha = ewma_alpha
+        self.failure_threshold = failure_threshold
+        self.lock = threading.Lock()
+
+    def candidates(self, exclude=()):
+        endpoints = [e for e in self.endpoints if e not in exclude]
+        return [e for e in endpoints if e.healthy] or endpoints
+
+    def choose(self, exclude=()):
+        """
+        Return the endpoint to send the next request to, or None if all have been tried
+        """
+        with self.lock:
+            endpoints = self.candidates(exclude)
+            if not endpoints:
+                return None
+            if len(endpoints) == 1:
+                return endpoints[0]
+            if self.policy == "weighted":
+                return random.choices(endpoints, weights=[e.weight for e in endpoints])[0]
+            if self.policy == "ewma":
+                # endpoints without a latency yet are tried first
+                def score(e):
+                    return (e.ewma_latency or 0) * (e.outstanding + 1) / e.weight
+            else:
+                def score(e):
+                    return e.outstanding / e.weight
+            best = min(score(e) for e in endpoints)
+            return random.choice([e for e in endpoints if score(e) == best])
+
+    def start(self, endpoint):
+        with self.lock:
+            endpoint.outstanding += 1
+        UPSTREAM_ENDPOINT_OUTSTANDING.labels(provider=self.provider, url=endpoint.url).inc()
+
+    def finish(self, endpoint):
+        with self.lock:
+            endpoint.outstanding -= 1
+        UPSTREAM_ENDPOINT_OUTSTANDING.labels(provider=self.provider, url=endpoint.url).dec()
+
+    def record_success(self, endpoint, latency):
+        with self.lock:
+            endpoint.consecutive_failures = 0
+            if endpoint.ewma_latency is None:
+                endpoint.ewma_latency = latency
+            else:
+                endpoint.ewma_latency += self.ewma_alpha * (latency - endpoint.ewma_latency)
+        self.set_healthy(endpoint, True)
+
+    def record_failure(self, endpoint):
+        with self.lock:
+            endpoint.consecutive_failures += 1
+            failed = endpoint.consecutive_failures >= self.failure_threshold
+        if failed:
+            self.set_healthy(endpoint, False)
+
+    def record_failover(self):
+        UPSTREAM_FAILOVERS.labels(provider=self.provider).inc()
+
+    def set_healthy(self, endpoint, healthy):
+        if endpoint.healthy != healthy:
+            endpoint.healthy = healthy
+            endpoint.consecutive_failures = 0
+            UPSTREAM_ENDPOINT_UP.labels(provider=self.provider, url=endpoint.url).set(1 if healthy else 0)
+
+    def check_health(self, session, headers, timeout=5):
+        """
+        Probe each endpoint by listing its models and update whether it is in rotation
+        """
+        for endpoint in self.endpoints:
+            start_time = time.time()
+            try:
+                response = session.get(f"{endpoint.url}/models", headers=headers, timeout=timeout)
+                healthy = response.status_code < 500
+            except Exception:
+                healthy = False
+            if healthy:
+                self.record_success(endpoint, time.time() - start_time)
+            else:
+                self.set_healthy(endpoint, False)
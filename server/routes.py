@@ -1,11 +1,12 @@
 import os
 import json
-import requests
+import uuid
 import socket
-import sseclient
+import threading
 import jwt
 
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 
 from flask import request, jsonify, Response, stream_with_context, redirect, session
@@ -22,10 +23,17 @@ from app import app
 from app import VERSION, server_instance_id
 
 from utils import DBUtils, construct_ai_request, RequestLogger,\
-    server_stats, increment_server_stat, openai_num_tokens_from_messages, \
-    get_random_string, num_characters_from_messages, update_default_settings, \
-    get_well_known_metadata, get_oauth2_session, get_jwks_client
-from custom_utils.get_openai_token import get_openai_token
+    server_stats, increment_server_stat, record_stream_usage, stream_usage_requested, \
+    chat_turn_messages, get_random_string, num_characters_from_messages, update_default_settings, \
+    get_well_known_metadata, get_oauth2_session, get_jwks_client, token_counter, \
+    DOCUMENT_SORT_COLUMNS, document_visibilities, CHAT_STREAM_ERROR
+from ai_client import get_upstream_client
+from ai_health import get_ai_health_probe
+from sse_relay import SSERelay, relay_stream, read_available
+from ai_cache import cached_chat_completion, cache_bypass_requested
+from chat_streams import chat_streams, request_cancel, STREAM_ID_HEADER
+from admission import admission, admission_controlled
+from context_window import fit_ai_request, approximate_token_counter
 
 
 class OrderedEncoder(json.JSONEncoder):
@@ -107,39 +115,17 @@ def test_server_up():
 def test_ai():
     with RequestLogger(request) as rl:
         increment_server_stat(category="requests", stat_name="healthAi")
-        try:
-            url = f"{app.config['OPENAI_BASE_URL']}/chat/completions"
-            headers = {
-                'content-type': 'application/json; charset=utf-8',
-                'Authorization': f"Bearer {get_openai_token()}"
-            }
-            ai_request = {
-                "model": app.config['SIDEKICK_UTILITY_MODEL'],
-                "temperature": 0.9,
-                "messages": [
-                    {"role": "system", "content": "You are an AI that has "
-                                                "just run a self-test."},
-                    {"role": "user",
-                    "content": "Give me an update on your status. "
-                                "Do not ask any questions or offer any help."}]
-                }
-            response = requests.post(url, headers=headers,
-                                    data=json.dumps(ai_request))
-            openai_health = {
-                "success": True,
-                "status": "UP",
-                "timestamp": datetime.now().isoformat(),
-                "ai_response": response.json()["choices"][0]["message"]["content"]
-            }
-        except:
-            openai_health = {"success": False, "status": "DOWN"}
-            rl.info("AI is DOWN")
+        # The provider is probed in the background, so polling this
+        # endpoint does not call the provider on every request
+        openai_health = get_ai_health_probe().get_health()
+        if not openai_health["success"]:
+            rl.info("AI is DOWN", error=openai_health.get("error"))
             return app.response_class(
                 response=json.dumps(openai_health),
                 status=500,
                 mimetype='application/json'
             )
-        rl.info("AI is UP")
+        rl.info("AI is UP", latency=openai_health["latency"])
         return app.response_class(
             response=json.dumps(openai_health),
             status=200,
@@ -195,8 +181,18 @@ def get_users_stats():
         increment_server_stat(category="requests", stat_name="getUsersStats")
         acting_user_id = get_jwt_identity()
         if DBUtils.user_isadmin(acting_user_id):
+            # With sizes, the total size of each type of document as well as their number.
+            # With a limit, a page of users and the cursor to pass as after to get the next page
+            sizes = request.args.get("sizes", "false").lower() in ("true", "1")
+            try:
+                limit = int(request.args.get("limit", 0))
+            except ValueError:
+                limit = -1
+            if limit < 0:
+                return "limit must be a positive number of users", 400
             try:
-                users_stats = DBUtils.get_users_stats()
+                users_stats = DBUtils.get_users_stats(sizes=sizes, limit=limit,
+                                                      after=request.args.get("after"))
                 return jsonify(users_stats)
             except Exception as e:
                 rl.exception(e)
@@ -340,63 +336,68 @@ def save_settings(name):
             return str(e), 500
 
 
+def construct_name_topic_request(text):
+    ai_request = {
+        "model": app.config['SIDEKICK_UTILITY_MODEL'],
+        "temperature": 0.9,
+        "messages": [
+            {"role": "system", "content": "You generate concise names \
+        for topics by reading the text and generating a name that is short and \
+        reflects what the text is about. Do not surround the name in speech marks."}, \
+            {"role": "user",
+            "content": "Provide a short single phrase to use as a title for this text: " +
+                        text[:8000]}]
+    }
+    return ai_request
+
+
+def name_topic_for_text(text, bypass=False):
+    """
+    Ask the utility model for a name for the topic of the text and record the usage stats.
+    Returns the /nametopic/v1 response.
+    """
+    message_usage = {}
+    ai_request = construct_name_topic_request(text)
+    promptCharacters = num_characters_from_messages(ai_request["messages"])
+    message_usage["prompt_characters"] = promptCharacters
+    increment_server_stat(category="usage", stat_name="promptCharacters", increment=promptCharacters)
+    increment_server_stat(category="usage", stat_name="totalCharacters", increment=promptCharacters)
+    response_json, cache_hit = cached_chat_completion("nameTopic", ai_request, bypass=bypass)
+    topic_name = response_json["choices"][0]["message"]["content"]
+    message_usage["completion_characters"] = len(topic_name)
+    increment_server_stat(category="usage", stat_name="completionCharacters", increment=len(topic_name))
+    increment_server_stat(category="usage", stat_name="totalCharacters", increment=len(topic_name))
+    if "\n" in topic_name:
+        topic_name = topic_name.split("\n", 1)[0]  # if there are multiple lines, just use the first one
+    topic_name = topic_name.strip('"\'').lstrip('- ').rstrip(':')
+    ai_response = {
+        "success": True,
+        "topic_name": topic_name,
+        "cached": cache_hit
+    }
+    if app.config["SIDEKICK_COUNT_TOKENS"] and not cache_hit:
+        increment_server_stat(category="usage", stat_name="promptTokens",
+                        increment=response_json["usage"]["prompt_tokens"])
+        increment_server_stat(category="usage", stat_name="completionTokens",
+                        increment=response_json["usage"]["completion_tokens"])
+        increment_server_stat(category="usage", stat_name="totalTokens",
+                        increment=response_json["usage"]["total_tokens"])
+        # Usage is metadata about the chat rather than the document that contains the chat, so it goes in the content
+        message_usage["prompt_tokens"] = response_json["usage"]["prompt_tokens"]
+        message_usage["completion_tokens"] = response_json["usage"]["completion_tokens"]
+        message_usage["total_tokens"] = response_json["usage"]["total_tokens"]
+    ai_response["usage"] = message_usage
+    return ai_response
+
+
 @app.route("/nametopic/v1", methods=['POST'])
 @jwt_required()
+@admission_controlled("nameTopic")
 def name_topic():
     with RequestLogger(request) as rl:
-        acting_user_id = get_jwt_identity()
-        message_usage = {}
-        def construct_name_topic_request(request):
-            increment_server_stat(category="requests", stat_name="nameTopic")
-            ai_request = {
-                "model": app.config['SIDEKICK_UTILITY_MODEL'],
-                "temperature": 0.9,
-                "messages": [
-                    {"role": "system", "content": "You generate concise names \
-        for topics by reading the text and generating a name that is short and \
-        reflects what the text is about. Do not surround the name in speech marks."}, \
-                    {"role": "user",
-                    "content": "Provide a short single phrase to use as a title for this text: " +
-                                request.json['text'][:8000]}]
-            }
-            return ai_request
-
         try:
-            url = f"{app.config['OPENAI_BASE_URL']}/chat/completions"
-            headers = {
-                'content-type': 'application/json; charset=utf-8',
-                'Authorization': f"Bearer {get_openai_token()}"
-            }
-            ai_request = construct_name_topic_request(request)
-            promptCharacters = num_characters_from_messages(ai_request["messages"])
-            message_usage["prompt_characters"] = promptCharacters
-            increment_server_stat(category="usage", stat_name="promptCharacters", increment=promptCharacters)
-            increment_server_stat(category="usage", stat_name="totalCharacters", increment=promptCharacters)
-            response = requests.post(url, headers=headers,
-                                    data=json.dumps(ai_request))
-            topic_name = response.json()["choices"][0]["message"]["content"]
-            message_usage["completion_characters"] = len(topic_name)
-            increment_server_stat(category="usage", stat_name="completionCharacters", increment=len(topic_name))
-            increment_server_stat(category="usage", stat_name="totalCharacters", increment=len(topic_name))
-            if "\n" in topic_name:
-                topic_name = topic_name.split("\n", 1)[0]  # if there are multiple lines, just use the first one
-            topic_name = topic_name.strip('"\'').lstrip('- ').rstrip(':')
-            ai_response = {
-                "success": True,
-                "topic_name": topic_name
-            }
-            if app.config["SIDEKICK_COUNT_TOKENS"]:
-                increment_server_stat(category="usage", stat_name="promptTokens",
-                                increment=response.json()["usage"]["prompt_tokens"])
-                increment_server_stat(category="usage", stat_name="completionTokens",
-                                increment=response.json()["usage"]["completion_tokens"])
-                increment_server_stat(category="usage", stat_name="totalTokens",
-                                increment=response.json()["usage"]["total_tokens"])
-                # Usage is metadata about the chat rather than the document that contains the chat, so it goes in the content
-                message_usage["prompt_tokens"] = response.json()["usage"]["prompt_tokens"]
-                message_usage["completion_tokens"] = response.json()["usage"]["completion_tokens"]
-                message_usage["total_tokens"] = response.json()["usage"]["total_tokens"]
-            ai_response["usage"] = message_usage
+            increment_server_stat(category="requests", stat_name="nameTopic")
+            ai_response = name_topic_for_text(request.json['text'], bypass=cache_bypass_requested(request))
         except Exception as e:
             rl.exception(e)
             ai_response = {
@@ -410,8 +411,80 @@ def name_topic():
         return ai_response_json
 
 
+_batch_executor = None
+_batch_executor_pid = None
+_batch_executor_lock = threading.Lock()
+
+
+def get_batch_executor():
+    """
+    Return the thread pool this worker process names the texts of batch requests in,
+    so that SIDEKICK_BATCH_CONCURRENCY limits the upstream calls of all batches together.
+    A new pool is created after a fork.
+    """
+    global _batch_executor, _batch_executor_pid
+    if _batch_executor is None or _batch_executor_pid != os.getpid():
+        with _batch_executor_lock:
+            if _batch_executor is None or _batch_executor_pid != os.getpid():
+                _batch_executor = ThreadPoolExecutor(max_workers=app.config["SIDEKICK_BATCH_CONCURRENCY"],
+                                                     thread_name_prefix="nametopic-batch")
+                _batch_executor_pid = os.getpid()
+    return _batch_executor
+
+
+# Name the topics of a list of texts, e.g. when renaming or importing chats in bulk.
+# The texts are named concurrently and each result is streamed back as a line of JSON
+# with the index of its text as soon as it is ready, so results arrive out of order.
+@app.route("/nametopic/v1/batch", methods=['POST'])
+@jwt_required()
+def name_topic_batch():
+    with RequestLogger(request) as rl:
+        increment_server_stat(category="requests", stat_name="nameTopicBatch")
+        texts = request.json.get("texts") if request.is_json else None
+        if not isinstance(texts, list) or not texts:
+            return "texts must be a non-empty list", 400
+        if len(texts) > app.config["SIDEKICK_BATCH_MAX_ITEMS"]:
+            return f"texts must have at most {app.config['SIDEKICK_BATCH_MAX_ITEMS']} items", 400
+        bypass = cache_bypass_requested(request)
+        user_id = get_jwt_identity()
+        rl.push(count=len(texts))
+
+        def name_topic_in_app_context(text):
+            # Each text is admitted separately so a batch gets its user's fair share of upstream calls
+            ticket = admission.acquire(user_id, "nameTopicBatch")
+            try:
+                with app.app_context():
+                    return name_topic_for_text(text, bypass=bypass)
+            finally:
+                ticket.release()
+
+        def generate():
+            succeeded = 0
+            executor = get_batch_executor()
+            futures = {}
+            try:
+                futures = {executor.submit(name_topic_in_app_context, text): index
+                           for index, text in enumerate(texts)}
+                for future in as_completed(futures):
+                    try:
+                        result = {"index": futures[future], **future.result()}
+                        succeeded += 1
+                    except Exception as e:
+                        rl.exception(e, "Error naming topic", index=futures[future])
+                        result = {"index": futures[future], "success": False, "error": str(e)}
+                    yield json.dumps(result) + "\n"
+            finally:
+                # Stop naming the remaining texts if the client has gone away
+                for future in futures:
+                    future.cancel()
+            rl.info("batch-completed", count=len(texts), succeeded=succeeded)
+
+        return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
+
 @app.route("/generatetext/v1", methods=['POST'])
 @jwt_required()
+@admission_controlled("generateText")
 def query_ai():
     with RequestLogger(request) as rl:
         message_usage = {}
@@ -438,24 +511,20 @@ def query_ai():
             promptCharacters = num_characters_from_messages(ai_request["messages"])
             increment_server_stat(category="usage", stat_name="promptCharacters", increment=promptCharacters)
             increment_server_stat(category="usage", stat_name="totalCharacters", increment=promptCharacters)
-            url = f"{app.config['OPENAI_BASE_URL']}/chat/completions"
-            headers = {
-                'content-type': 'application/json; charset=utf-8',
-                'Authorization': f"Bearer {get_openai_token()}"
-            }
             message_usage["prompt_characters"] = num_characters_from_messages(
                 ai_request["messages"])
-            response = requests.post(url, headers=headers,
-                                    data=json.dumps(ai_request))
-            generated_text = response.json()["choices"][0]["message"]["content"]
+            response_json, cache_hit = cached_chat_completion(
+                "generateText", ai_request, bypass=cache_bypass_requested(request))
+            generated_text = response_json["choices"][0]["message"]["content"]
             increment_server_stat(category="usage", stat_name="completionCharacters", increment=len(generated_text))
             increment_server_stat(category="usage", stat_name="totalCharacters", increment=len(generated_text))
             ai_response = {
                 "success": True,
-                "generated_text": generated_text
+                "generated_text": generated_text,
+                "cached": cache_hit
             }
-            response_usage = response.json()["usage"]
-            if app.config["SIDEKICK_COUNT_TOKENS"]:
+            response_usage = response_json["usage"]
+            if app.config["SIDEKICK_COUNT_TOKENS"] and not cache_hit:
                 increment_server_stat(category="usage",
                                     stat_name="promptTokens",
                                     increment=response_usage["prompt_tokens"])
@@ -487,78 +556,140 @@ def query_ai():
 CHATV2_ROUTE = '/chat/v2'
 @app.route(CHATV2_ROUTE, methods=['POST'])
 @jwt_required()
+@admission_controlled("chatV2")
 def chat_v2():
     with RequestLogger(request) as rl:
         increment_server_stat(category="requests", stat_name="chatV2")
 
+        provider = request.json["model_settings"].get("provider")
+        ai_request = construct_ai_request(request.json)
+        ai_request["stream"] = True
+        if stream_usage_requested(provider):
+            # Ask the provider to report the tokens used in a final event
+            ai_request["stream_options"] = {"include_usage": True}
+        dropped_messages, dropped_tokens = fit_ai_request(
+            ai_request, request.json["model_settings"],
+            token_counter if provider in (None, "OpenAI") else approximate_token_counter)
+        if dropped_messages:
+            increment_server_stat(category="usage", stat_name="contextDroppedMessages", increment=dropped_messages)
+            increment_server_stat(category="usage", stat_name="contextDroppedTokens", increment=dropped_tokens)
+            rl.info("context-fitted", dropped_messages=dropped_messages, dropped_tokens=dropped_tokens)
+
+        # The web UI can send its own stream_id so it can cancel before the response headers arrive
+        stream_id = request.json.get("stream_id") or str(uuid.uuid4())
+        user_id = get_jwt_identity()
+        # If the chat document is given, the prompt and reply are appended to it when the
+        # stream ends so the web UI does not have to upload the whole chat after each turn.
+        # document_prompt is the prompt as shown in the chat, if different to the prompt sent to the AI
+        document_id = request.json.get("document_id")
+        document_prompt = request.json.get("document_prompt", request.json["prompt"])
+
         def generate():
-            url = f"{app.config['OPENAI_BASE_URL']}/chat/completions"
-            headers = {
-                'content-type': 'application/json; charset=utf-8',
-                'Authorization': f"Bearer {get_openai_token()}"
-            }
-            ai_request = construct_ai_request(request)
-            ai_request["stream"] = True
+            stream = chat_streams.open(user_id, stream_id)
+            completion = []
             promptCharacters = num_characters_from_messages(ai_request["messages"])
             increment_server_stat(category="usage", stat_name="promptCharacters", increment=promptCharacters)
             increment_server_stat(category="usage", stat_name="totalCharacters", increment=promptCharacters)
-            if app.config["SIDEKICK_COUNT_TOKENS"]:
-                try:
-                    prompt_tokens = openai_num_tokens_from_messages(ai_request["messages"], ai_request["model"])
-                    increment_server_stat(category="usage", stat_name="promptTokens", increment=prompt_tokens)
-                except Exception as e:
-                    rl.exception(e, "Error calculating prompt tokens")
-            response = requests.post(url, headers=headers,
-                                    data=json.dumps(ai_request), stream=True)
-            if response.status_code != 200:
-                error_message = f"Error - OpenAI API returned status code {response.status_code}"
-                if response.reason:
-                    reason = response.reason
-                    error_message += f" ({response.reason})"
-                if response.json() and "error" in response.json():
-                    for k, v in response.json()["error"].items():
-                        error_message += f", {k}: {v}"
-                else:
-                    reason = None
-                rl.error("Error returned by OpenAI", status_code=response.status_code, reason=reason, error_message=error_message)
-                yield (error_message)
-            increment_server_stat(category="responses", stat_name="chatV2")
-
-            client = sseclient.SSEClient(response)
-            response_size = 0
-            for event in client.events():
+            relay = None
+            closed_early = None
+            failed = False
+            try:
+                response = get_upstream_client().chat_completions(ai_request, provider=provider,
+                                                                  stream=True)
+                # Closing the response frees its endpoint for the provider router
+                # and stops the provider generating the rest of the completion
+                with response:
+                    if response.status_code != 200:
+                        error_message = f"Error - OpenAI API returned status code {response.status_code}"
+                        if response.reason:
+                            reason = response.reason
+                            error_message += f" ({response.reason})"
+                        if response.json() and "error" in response.json():
+                            for k, v in response.json()["error"].items():
+                                error_message += f", {k}: {v}"
+                        else:
+                            reason = None
+                        rl.error("Error returned by OpenAI", status_code=response.status_code, reason=reason, error_message=error_message)
+                        # The error is shown to the user but not saved in the chat document as a reply
+                        yield (error_message)
+                        return
+                    increment_server_stat(category="responses", stat_name="chatV2")
+
+                    relay = SSERelay(flush_interval=app.config["SIDEKICK_STREAM_FLUSH_INTERVAL"],
+                                     flush_size=app.config["SIDEKICK_STREAM_FLUSH_SIZE"])
+                    for texts in relay_stream(relay, read_available(response)):
+                        for text in texts:
+                            completion.append(text)
+                            yield text
+                        if stream.cancelled():
+                            closed_early = "cancel"
+                            break
+                for text in relay.close():
+                    completion.append(text)
+                    yield text
+                for error in relay.errors:
+                    rl.error("Error in chat stream", error_message=error)
+                response_size = relay.characters
+                increment_server_stat(category="usage", stat_name="completionCharacters", increment=response_size)
+                increment_server_stat(category="usage", stat_name="totalCharacters", increment=response_size)
                 if app.config["SIDEKICK_COUNT_TOKENS"]:
-                    # The streaming interface does not provide the number of tokens used
-                    # but as it returns one token at a time, we can count them
-                    increment_server_stat(category="usage", stat_name="completionTokens", increment=1)
-                    increment_server_stat(category="usage", stat_name="totalTokens", increment=1)
-                if event.data != '[DONE]':
+                    prompt_tokens, completion_tokens = record_stream_usage(ai_request, relay)
+                    rl.info("stream-completed", size=response_size, prompt_tokens=prompt_tokens,
+                            completion_tokens=completion_tokens)
+                else:
+                    rl.info("stream-completed", size=response_size)
+            except GeneratorExit:
+                # The client disconnected, closing the response above stopped the upstream stream
+                closed_early = "disconnect"
+                raise
+            except Exception as e:
+                # The response has started, so end it with the same error text as the
+                # async chat server rather than cutting it off
+                rl.exception(e, "Error in chat stream")
+                failed = True
+                yield CHAT_STREAM_ERROR
+            finally:
+                chat_streams.close(stream)
+                if relay is not None:
+                    if closed_early:
+                        tokens_saved = chat_streams.record_closed_early(closed_early, relay.events)
+                        rl.info("stream-closed-early", reason=closed_early, tokens_saved=tokens_saved)
+                        if closed_early == "disconnect" and app.config["SIDEKICK_COUNT_TOKENS"]:
+                            # The provider does not report the usage of a stream closed early
+                            record_stream_usage(ai_request, relay)
+                    elif relay.done:
+                        chat_streams.record_completed(relay.events)
+                if document_id:
                     try:
-                        data = json.loads(event.data)
-                        delta = data['choices'][0]['delta']
-                        if 'content' in delta:
-                            text = delta['content']
-                            response_size += len(text)
-                            increment_server_stat(category="usage", stat_name="completionCharacters", increment=len(text))
-                            increment_server_stat(category="usage", stat_name="totalCharacters", increment=len(text))
-                            yield (text)
-                        elif 'role' in delta:
-                            # discard
-                            pass
-                        elif delta == {}:
-                            yield ('')  # end of stream
-                        else:
-                            # Unexpected delta content
-                            rl.error(f"Error - Unexpected delta in chat stream; content - {delta}")
+                        if not DBUtils.append_chat_messages(document_id, user_id, chat_turn_messages(
+                                document_prompt, "".join(completion), closed_early, failed)):
+                            rl.error("Chat document not found", document_id=document_id)
                     except Exception as e:
-                        rl.exception(e)
-                        yield ('Error - ' + str(e))
-            rl.info("stream-completed", size=response_size)
+                        rl.exception(e, "Error appending to chat document", document_id=document_id)
 
         result = Response(stream_with_context(generate()))
+        result.headers["X-Sidekick-Context-Dropped-Messages"] = str(dropped_messages)
+        result.headers["X-Sidekick-Context-Dropped-Tokens"] = str(dropped_tokens)
+        result.headers[STREAM_ID_HEADER] = stream_id
         return result
 
 
+@app.route(CHATV2_ROUTE + '/cancel', methods=['POST'])
+@jwt_required()
+def chat_v2_cancel():
+    with RequestLogger(request) as rl:
+        increment_server_stat(category="requests", stat_name="chatV2Cancel")
+        stream_id = request.json.get("stream_id") if request.is_json else None
+        if not stream_id:
+            return "stream_id is required", 400
+        # The stream may be open in another worker process, which will pick up
+        # the cancellation from the database
+        if not chat_streams.cancel(stream_id, get_jwt_identity()):
+            request_cancel(stream_id, get_jwt_identity())
+        rl.info("stream-cancel-requested", stream_id=stream_id)
+        return jsonify({"success": True, "stream_id": stream_id})
+
+
 @app.route('/docdb/<document_type>/<scope>/documents', methods=['GET'])
 @jwt_required()
 def docdb_list_documents(document_type, scope=""):
@@ -566,6 +697,29 @@ def docdb_list_documents(document_type, scope=""):
         acting_user_id = get_jwt_identity()    
         increment_server_stat(category="requests", stat_name=f"docdbList({document_type})")
 
+        # With a limit, return a page sorted by sort (updated_date or name) in order (desc or asc)
+        # with the cursor to pass as after to get the next page, or null on the last page
+        if "limit" in request.args:
+            sort = request.args.get("sort", "updated_date")
+            order = request.args.get("order", "desc" if sort == "updated_date" else "asc")
+            try:
+                limit = int(request.args["limit"])
+            except ValueError:
+                limit = 0
+            if not 0 < limit <= app.config["SIDEKICK_DOCDB_MAX_PAGE_SIZE"]:
+                return f"limit must be between 1 and {app.config['SIDEKICK_DOCDB_MAX_PAGE_SIZE']}", 400
+            if sort not in DOCUMENT_SORT_COLUMNS or order not in ("asc", "desc"):
+                return "sort must be updated_date or name and order must be asc or desc", 400
+            try:
+                documents = DBUtils.list_documents_page(
+                    DBUtils.documents_in_scope(document_type, scope, acting_user_id),
+                    limit, after=request.args.get("after"), sort=sort, order=order, user_id=acting_user_id)
+            except ValueError as e:
+                return str(e), 400
+            rl.push(action="listed documents", document_type=document_type,
+                    count=documents["file_count"], limit=limit)
+            return jsonify(documents)
+
         if scope == "mine":
             documents = DBUtils.list_documents(document_type=document_type, user_id=acting_user_id)
         elif scope == "my-shared":
@@ -595,6 +749,8 @@ def docdb_create_document(document_type=""):
         data = request.get_json()
         if not data['metadata'].get('visibility'):
             data['metadata']['visibility'] = "private"
+        if data['metadata']['visibility'] not in document_visibilities(acting_user_id):
+            return f"Invalid visibility: {data['metadata']['visibility']}", 400
         data_size = len(json.dumps(data['content']))
         props = data['metadata']['properties'] if 'properties' in data['metadata'] else {}
         document = DBUtils.create_document(
@@ -617,7 +773,7 @@ def docdb_load_document(document_id, document_type=""):
         acting_user_id = get_jwt_identity()
         increment_server_stat(category="requests", stat_name=f"docdbGet({document_type})")
         try:
-            document = DBUtils.get_document(document_id=document_id)
+            document = DBUtils.get_document_for_user(document_id, acting_user_id)
 
             # if the document privacy is set to private, only the owner can access it
             if document['metadata'].get("visibility", "private") == "private" and document["metadata"].get("user_id", "") != acting_user_id:
@@ -641,7 +797,7 @@ def docdb_save_document(document_id, document_type=""):
     with RequestLogger(request) as rl:
         acting_user_id = get_jwt_identity()
 
-        document = DBUtils.get_document(document_id=document_id)
+        document = DBUtils.get_document_for_user(document_id, acting_user_id)
         
         # users can only save documents they own
         if document["metadata"].get("user_id","") != acting_user_id:
@@ -655,9 +811,11 @@ def docdb_save_document(document_id, document_type=""):
         document_size = len(json.dumps(data['content']))
         if not data['metadata'].get('visibility'):
             data['metadata']['visibility'] = "private"
+        if data['metadata']['visibility'] not in document_visibilities(acting_user_id):
+            return f"Invalid visibility: {data['metadata']['visibility']}", 400
         props = data['metadata']['properties'] if 'properties' in data['metadata'] else {}
         document = DBUtils.update_document(
-            id=document_id,
+            id=DBUtils.copy_on_write(document_id, acting_user_id),
             visibility=data['metadata']['visibility'],
             name=data['metadata']['name'],
             tags=data['metadata']['tags'] if 'tags' in data['metadata'] else [],
@@ -675,7 +833,7 @@ def docdb_rename_document(document_type, document_id):
         acting_user_id = get_jwt_identity()
 
         # users can only rename documents they own
-        document = DBUtils.get_document(document_id=document_id)
+        document = DBUtils.get_document_for_user(document_id, acting_user_id)
         if document["metadata"]["user_id"] != acting_user_id:
             rl.warning("SECURITY_ALERT: Attempt to rename another user's document",
                         document_id=document_id, acting_user_id=acting_user_id,
@@ -683,7 +841,7 @@ def docdb_rename_document(document_type, document_id):
             return "Not authorized", 401
 
         increment_server_stat(category="requests", stat_name=f"docdbRename({document_type})")
-        document = DBUtils.update_document_name(document_id,
+        document = DBUtils.update_document_name(DBUtils.copy_on_write(document_id, acting_user_id),
                                                 request.get_json()["name"])
         return jsonify(document)
 
@@ -695,7 +853,7 @@ def docdb_move_document(document_type, document_id):
         acting_user_id = get_jwt_identity()
 
         # users can only move documents they own
-        document = DBUtils.get_document(document_id=document_id)
+        document = DBUtils.get_document_for_user(document_id, acting_user_id)
         if document["metadata"]["user_id"] != acting_user_id:
             rl.warning("SECURITY_ALERT: Attempt to move another user's document",
                         document_id=document_id, acting_user_id=acting_user_id,
@@ -703,7 +861,8 @@ def docdb_move_document(document_type, document_id):
             return "Not authorized", 401
 
         increment_server_stat(category="requests", stat_name=f"docdbMove({document_type})")
-        document = DBUtils.update_document_type(id, request.get_json()["type"])
+        document = DBUtils.update_document_type(DBUtils.copy_on_write(document_id, acting_user_id),
+                                                request.get_json()["type"])
         rl.push(action="moved document", document_id=document_id)
         return jsonify(document)
 
@@ -716,7 +875,7 @@ def docdb_delete_document(document_type, document_id):
         acting_user_id = get_jwt_identity()
 
         # users can only delete documents they own
-        document = DBUtils.get_document(document_id=document_id)
+        document = DBUtils.get_document_for_user(document_id, acting_user_id)
         if document["metadata"]["user_id"] != acting_user_id:
             rl.warning("SECURITY_ALERT: Attempt to delete another user's document",
                         document_id=document_id, acting_user_id=acting_user_id,
@@ -724,7 +883,7 @@ def docdb_delete_document(document_type, document_id):
             return "Not authorized", 401
 
         increment_server_stat(category="requests", stat_name=f"docdbDelete({document_type})")
-        document = DBUtils.delete_document(document_id)
+        document = DBUtils.delete_document(DBUtils.copy_on_write(document_id, acting_user_id))
         return jsonify(document)
 
 
@@ -1014,7 +1173,7 @@ def delete_user():
             )
         try:
             if DBUtils.login(acting_user_id, password)['success']:
-                result = DBUtils.delete_user(user_id_to_delete)
+                result = DBUtils.delete_user(user_id_to_delete, background=data.get('background', False))
                 rl.info("delete user success", acting_user_id=acting_user_id, user_id_to_delete=user_id_to_delete, success=True)
                 return jsonify(result)
             else:
@@ -0,0 +1,103 @@
+import os
+import time
+import fcntl
+import hashlib
+import threading
+from contextlib import contextmanager
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs one call at a time for each key, with concurrent callers for the
+    same key waiting for that call and sharing its result instead of making
+    their own. Under gevent the lock and event are cooperative.
+
+    Usage:
+        result, shared = single_flight.do(key, fetch)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, fn):
+        """
+        Return (result, shared) where shared is True if the result came from
+        a call made by another caller. An exception raised by the call is
+        raised for every caller waiting on it.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+@contextmanager
+def file_lock(lock_dir, key, timeout=60, poll_interval=0.01):
+    """
+    Hold an exclusive lock for the key shared by all processes using lock_dir.
+
+    Each key has its own lock file, named by a hash of the key, so requests for
+    different keys never wait for each other. The file is removed by the holder
+    before it releases the lock, and a waiter that then locks the removed file
+    opens the key's new file and locks that instead, so the directory only holds
+    the files of locks currently held. The lock is polled without blocking so that
+    a gevent worker keeps serving other requests while it waits. If the lock cannot
+    be acquired within timeout seconds the body runs without it.
+
+    Yields True if the lock had to be waited for, i.e. another process held it.
+    """
+    os.makedirs(lock_dir, exist_ok=True)
+    path = os.path.join(lock_dir, f"{hashlib.sha256(key.encode('utf-8')).hexdigest()}.lock")
+    waited = False
+    deadline = time.time() + timeout
+    while True:
+        f = open(path, "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            f.close()
+            waited = True
+            if time.time() > deadline:
+                f = None
+                break
+            time.sleep(poll_interval)
+            continue
+        try:
+            current = os.stat(path).st_ino == os.fstat(f.fileno()).st_ino
+        except FileNotFoundError:
+            current = False
+        if current:
+            break
+        # The previous holder removed this file before releasing it
+        f.close()
+        waited = True
+    try:
+        yield waited
+    finally:
+        if f is not None:
+            os.unlink(path)
+            fcntl.flock(f, fcntl.LOCK_UN)
+            f.close()
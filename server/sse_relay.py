@@ -0,0 +1,204 @@
+import json
+import time
+import queue
+import threading
+from json.decoder import scanstring
+
+
+class SSERelay:
+    """
+    Incremental parser for an OpenAI compatible chat completions SSE stream
+    that relays only the text of the content deltas, coalesced into chunks.
+
+    Rather than decoding every event with json.loads, each data line is scanned
+    for the content string of its delta, which is the only part of the event
+    the web UI needs. Text is buffered and released once flush_size characters have
+    accumulated or flush_interval seconds have passed since the first buffered
+    text, so a stream is written as a few larger chunks instead of one tiny
+    chunk per token. The first text of a stream is released straight away to
+    keep the time to first token low. While the upstream is quiet, poll() releases
+    the buffered text once flush_interval has passed, flush_due_in() seconds from now.
+
+    If the request asked for stream_options.include_usage, the usage the
+    provider reports in the final event is available as relay.usage once the
+    stream has ended.
+
+    Usage:
+        relay = SSERelay()
+        for texts in relay_stream(relay, read_available(response)):
+            for text in texts:
+                yield text
+        for text in relay.close():
+            yield text
+    """
+    def __init__(self, flush_interval=0.02, flush_size=256, clock=time.monotonic):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.clock = clock
+        self.done = False
+        self.events = 0  # number of data events received, including [DONE]
+        self.characters = 0  # number of characters of content relayed
+        self.errors = []
+        self.usage = None  # the usage reported by the provider at the end of the stream, if any
+        self._line_buffer = b""
+        self._text = []
+        self._text_size = 0
+        self._first_text_time = None
+        self._relayed = False
+
+    def feed(self, data):
+        """
+        Consume the next bytes of the upstream stream and
+        return a list of text chunks ready to be sent downstream.
+        """
+        lines = (self._line_buffer + data).split(b"\n")
+        self._line_buffer = lines.pop()
+        for line in lines:
+            self._process_line(line)
+        return self._flush(force=False)
+
+    def poll(self):
+        """
+        Return a list of the buffered text if it is due to be released, for
+        calling when no more of the upstream stream has arrived in flush_due_in() seconds
+        """
+        return self._flush(force=False)
+
+    def flush_due_in(self):
+        """
+        Return the seconds until the buffered text is due to be released, or None if there is none
+        """
+        if not self._text:
+            return None
+        return max(0.0, self._first_text_time + self.flush_interval - self.clock())
+
+    def close(self):
+        """
+        Process any unterminated final line and return the remaining buffered text
+        """
+        if self._line_buffer:
+            self._process_line(self._line_buffer)
+            self._line_buffer = b""
+        return self._flush(force=True)
+
+    def _process_line(self, line):
+        if self.done or not line.startswith(b"data:"):
+            return
+        self.events += 1
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            self.done = True
+            return
+        text = self.extract_content(data)
+        if text is None:
+            return
+        self._append(text)
+
+    def extract_content(self, data):
+        """
+        Return the delta content string from a chunk event without parsing the rest of the event.
+        Events without a delta, such as errors and the final usage event, are parsed in full.
+        """
+        delta_index = data.find(b'"delta"')
+        if delta_index == -1:
+            return self._other_event(data)
+        content_index = data.find(b'"content"', delta_index)
+        if content_index == -1:
+            return None
+        event = data[content_index + 9:].decode("utf-8")
+        position = 0
+        while position < len(event) and event[position] in " \t:":
+            position += 1
+        if event[position:position + 1] != '"':
+            return None  # null content, or the content of another field after an empty delta
+        text, _ = scanstring(event, position + 1)
+        return text
+
+    def _other_event(self, data):
+        """
+        Record the usage from a usage event and return the error text of an error event
+        """
+        try:
+            event = json.loads(data)
+        except ValueError as e:
+            error = f"Error - {e}"
+        else:
+            if isinstance(event.get("usage"), dict):
+                self.usage = event["usage"]
+            if "error" not in event:
+                return None
+            error = "Error - " + ", ".join(f"{k}: {v}" for k, v in event["error"].items()) \
+                if isinstance(event["error"], dict) else f"Error - {event['error']}"
+        self.errors.append(error)
+        return error
+
+    def _append(self, text):
+        if not text:
+            return
+        if self._first_text_time is None:
+            self._first_text_time = self.clock()
+        self._text.append(text)
+        self._text_size += len(text)
+        self.characters += len(text)
+
+    def _flush(self, force):
+        if not self._text:
+            return []
+        if not force and self._relayed \
+                and self._text_size < self.flush_size \
+                and self.clock() - self._first_text_time < self.flush_interval:
+            return []
+        text = "".join(self._text)
+        self._text = []
+        self._text_size = 0
+        self._first_text_time = None
+        self._relayed = True
+        return [text]
+
+
+_END_OF_STREAM = object()
+
+
+def read_available(response, size=65536):
+    """
+    Yield the body of a streamed requests response as its bytes arrive, up to size
+    bytes at a time, rather than waiting for a fixed number of bytes as iter_content
+    does when the response is not chunked.
+    """
+    while True:
+        data = response.raw.read1(size, decode_content=True)
+        if not data:
+            return
+        yield data
+
+
+def relay_stream(relay, chunks):
+    """
+    Feed the chunks of an upstream stream to the relay and yield the lists of text
+    it releases, including buffered text released by polling while the upstream is quiet.
+
+    The chunks are read in a background thread, a greenlet under gevent, so that
+    waiting for the next chunk can time out when buffered text is due.
+    """
+    received = queue.Queue()
+
+    def read():
+        try:
+            for data in chunks:
+                received.put(data)
+        except Exception as e:
+            received.put(e)
+        received.put(_END_OF_STREAM)
+
+    threading.Thread(target=read, daemon=True).start()
+    while True:
+        try:
+            data = received.get(timeout=relay.flush_due_in())
+        except queue.Empty:
+            yield relay.poll()
+            continue
+        if data is _END_OF_STREAM:
+            return
+        if isinstance(data, Exception):
+            raise data
+        yield relay.feed(data)
@@ -0,0 +1,50 @@
+"""
+Serve the fake provider from benchmarks/fake_provider.py in a background thread,
+for the tests of the code that calls the model providers
+"""
+import asyncio
+import threading
+
+from benchmarks.fake_provider import FakeProvider
+
+
+class FakeProviderThread:
+    """
+    Run a FakeProvider on its own event loop. Tests that need other responses
+    pass a subclass that overrides completion, stream_completion or list_models.
+    """
+    def __init__(self, provider=None):
+        self.provider = provider or FakeProvider(tokens=1, token_interval=0)
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.server = None
+
+    def start(self):
+        """
+        Start serving and return the base URL of the provider
+        """
+        self.thread.start()
+        self.server = asyncio.run_coroutine_threadsafe(
+            asyncio.start_server(self.provider.handle_connection, "127.0.0.1", 0), self.loop).result()
+        return f"http://127.0.0.1:{self.server.sockets[0].getsockname()[1]}/v1"
+
+    def stop(self):
+        """
+        Stop serving and close the connections to the provider. Can be called more than once.
+        """
+        if self.loop.is_closed():
+            return
+        if self.thread.is_alive():
+            if self.server is not None:
+                asyncio.run_coroutine_threadsafe(self.close(), self.loop).result()
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+        self.loop.close()
+
+    async def close(self):
+        self.server.close()
+        # end the connections kept alive by the clients
+        connections = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for connection in connections:
+            connection.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
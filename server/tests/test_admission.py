@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from flask_jwt_extended import create_access_token
+
+import admission as admission_module
+from app import app
+from admission import AdmissionController, AdmissionRejected
+
+
+class AdmissionControllerTest(unittest.TestCase):
+    def test_admits_up_to_limits(self):
+        controller = AdmissionController(max_concurrent=3, max_per_user=2)
+        tickets = [controller.enqueue("alice", "test", lambda: None) for _ in range(3)]
+        self.assertEqual([t.granted for t in tickets], [True, True, False])
+        bob = controller.enqueue("bob", "test", lambda: None)
+        self.assertTrue(bob.granted)
+        self.assertFalse(controller.enqueue("carol", "test", lambda: None).granted)
+        self.assertEqual(controller.active, 3)
+        self.assertEqual(controller.queued, 2)
+
+    def test_users_take_turns(self):
+        controller = AdmissionController(max_concurrent=1, max_per_user=0)
+        granted = []
+        first = controller.enqueue("alice", "test", lambda: None)
+        tickets = [controller.enqueue("alice", "test", lambda i=i: granted.append(f"alice{i}"))
+                   for i in range(3)]
+        tickets += [controller.enqueue("bob", "test", lambda i=i: granted.append(f"bob{i}"))
+                    for i in range(2)]
+        first.release()
+        while len(granted) < len(tickets):
+            next(t for t in tickets if t.granted and not t.released).release()
+        self.assertEqual(granted, ["alice0", "bob0", "alice1", "bob1", "alice2"])
+
+    def test_rejects_when_queue_full(self):
+        controller = AdmissionController(max_concurrent=1, max_per_user=0, max_queue=2,
+                                         max_queue_per_user=1)
+        controller.enqueue("alice", "test", lambda: None)
+        controller.enqueue("alice", "test", lambda: None)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.enqueue("alice", "test", lambda: None)
+        self.assertEqual(rejected.exception.reason, "user_queue_full")
+        self.assertGreaterEqual(rejected.exception.retry_after, 1)
+        controller.enqueue("bob", "test", lambda: None)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.enqueue("carol", "test", lambda: None)
+        self.assertEqual(rejected.exception.reason, "queue_full")
+
+    def test_acquire_waits_for_release(self):
+        controller = AdmissionController(max_concurrent=1, max_wait=5)
+        ticket = controller.acquire("alice", "test")
+        acquired = []
+        waiter = threading.Thread(target=lambda: acquired.append(controller.acquire("bob", "test")))
+        waiter.start()
+        ticket.release()
+        waiter.join(5)
+        self.assertTrue(acquired[0].granted)
+        acquired[0].release()
+        self.assertEqual(controller.active, 0)
+
+    def test_acquire_times_out(self):
+        controller = AdmissionController(max_concurrent=1, max_wait=0.05)
+        controller.acquire("alice", "test")
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire("bob", "test")
+        self.assertEqual(rejected.exception.reason, "timeout")
+        self.assertEqual(controller.queued, 0)
+
+    def test_acquire_async(self):
+        controller = AdmissionController(max_concurrent=1, max_wait=0.05)
+
+        async def run():
+            ticket = await controller.acquire_async("alice", "test")
+            waiting = asyncio.ensure_future(controller.acquire_async("bob", "test"))
+            await asyncio.sleep(0)
+            ticket.release()
+            (await waiting).release()
+            await controller.acquire_async("alice", "test")
+            with self.assertRaises(AdmissionRejected):
+                await controller.acquire_async("bob", "test")
+
+        asyncio.run(run())
+        self.assertEqual(controller.queued, 0)
+
+
+class AdmissionControlledRouteTest(unittest.TestCase):
+    def test_rejects_with_retry_after(self):
+        controller = AdmissionController(max_concurrent=1, max_queue=0, max_wait=0.01)
+        with app.app_context():
+            token = create_access_token(identity="alice")
+        with mock.patch.object(admission_module, "admission", controller):
+            ticket = controller.acquire("bob", "test")
+            response = app.test_client().post("/generatetext/v1",
+                                              headers={"Authorization": f"Bearer {token}"},
+                                              json={"request": "more", "context": "text"})
+            ticket.release()
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response.headers["Retry-After"]), 1)
+        self.assertEqual(controller.active, 0)
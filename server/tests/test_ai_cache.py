@@ -0,0 +1,102 @@
+import time
+import unittest
+from flask import Flask
+from sqlalchemy import event
+from app import db
+from models import CachedResponse
+from ai_cache import MemoryResponseCache, DatabaseResponseCache, response_cache_key
+
+app = Flask(__name__)
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+db.init_app(app)
+
+
+def ai_request(text, temperature=0.9):
+    return {"model": "gpt-4o", "temperature": temperature,
+            "messages": [{"role": "user", "content": text}]}
+
+
+class ResponseCacheKeyTest(unittest.TestCase):
+    def test_key_depends_on_request(self):
+        self.assertEqual(response_cache_key(ai_request("a")),
+                         response_cache_key(dict(ai_request("a"), stream=False)))
+        self.assertNotEqual(response_cache_key(ai_request("a")),
+                            response_cache_key(ai_request("b")))
+        self.assertNotEqual(response_cache_key(ai_request("a")),
+                            response_cache_key(ai_request("a", temperature=0.1)))
+
+
+class MemoryResponseCacheTest(unittest.TestCase):
+    def test_lru_eviction(self):
+        cache = MemoryResponseCache(ttl=60, max_entries=2)
+        cache.set("a", {"n": 1})
+        cache.set("b", {"n": 2})
+        cache.get("a")
+        cache.set("c", {"n": 3})
+        self.assertEqual(cache.get("a"), {"n": 1})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), {"n": 3})
+
+    def test_ttl(self):
+        cache = MemoryResponseCache(ttl=-1)
+        cache.set("a", {"n": 1})
+        self.assertIsNone(cache.get("a"))
+
+
+class DatabaseResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        app.app_context().push()
+        with app.app_context():
+            db.create_all()
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_lru_eviction(self):
+        cache = DatabaseResponseCache(ttl=60, max_entries=2)
+        cache.set("a", {"n": 1})
+        time.sleep(0.01)
+        cache.set("b", {"n": 2})
+        time.sleep(0.01)
+        self.assertEqual(cache.get("a"), {"n": 1})
+        time.sleep(0.01)
+        cache.set("c", {"n": 3})
+        self.assertEqual(cache.get("a"), {"n": 1})
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("c"), {"n": 3})
+
+    def test_ttl(self):
+        cache = DatabaseResponseCache(ttl=-1)
+        cache.set("a", {"n": 1})
+        self.assertIsNone(cache.get("a"))
+
+    def test_hits_do_not_write(self):
+        cache = DatabaseResponseCache(ttl=60, max_entries=10)
+        cache.set("a", {"n": 1})
+        statements = []
+
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", record)
+        try:
+            for _ in range(3):
+                self.assertEqual(cache.get("a"), {"n": 1})
+        finally:
+            event.remove(db.engine, "before_cursor_execute", record)
+        self.assertEqual(len(statements), 3)
+        self.assertTrue(all(statement.lstrip().upper().startswith("SELECT") for statement in statements))
+        self.assertIn("a", cache.touched)
+        cache.set("b", {"n": 2})
+        self.assertEqual(cache.touched, {})
+
+    def test_touches_written_every_touch_interval(self):
+        cache = DatabaseResponseCache(ttl=60, touch_interval=0)
+        cache.set("a", {"n": 1})
+        last_accessed = db.session.get(CachedResponse, "a").last_accessed
+        time.sleep(0.01)
+        cache.get("a")
+        db.session.expire_all()
+        self.assertGreater(db.session.get(CachedResponse, "a").last_accessed, last_accessed)
+        self.assertEqual(cache.touched, {})
@@ -0,0 +1,96 @@
+import unittest
+from unittest import mock
+
+import requests
+from ai_client import UpstreamClient, UPSTREAM_REQUESTS
+from benchmarks.fake_provider import FakeProvider
+from tests.provider_thread import FakeProviderThread
+
+
+def completions_provider(**kwargs):
+    """
+    A provider that answers each completion with "hi"
+    """
+    return FakeProvider(tokens=1, token_interval=0, token_text="hi", **kwargs)
+
+
+class UpstreamClientTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = FakeProviderThread(completions_provider())
+        base_url = self.provider.start()
+        self.client = UpstreamClient(base_urls={"OpenAI": base_url, "Ollama": base_url})
+
+    def tearDown(self):
+        self.provider.stop()
+
+    def pool_count(self, pool):
+        return UPSTREAM_REQUESTS.labels(provider="OpenAI", pool=pool)._value.get()
+
+    def test_connection_is_reused(self):
+        hits, misses = self.pool_count("hit"), self.pool_count("miss")
+        for _ in range(3):
+            response = self.client.chat_completions({"model": "test", "messages": []})
+            self.assertEqual(response.json()["choices"][0]["message"]["content"], "hi")
+        self.assertEqual(self.pool_count("miss") - misses, 1)
+        self.assertEqual(self.pool_count("hit") - hits, 2)
+
+    def test_unknown_provider_uses_openai(self):
+        self.assertEqual(self.client.base_url("Unknown"), self.client.base_url("OpenAI"))
+
+
+class UpstreamFailoverTest(unittest.TestCase):
+    def start_provider(self, provider):
+        provider_thread = FakeProviderThread(provider)
+        self.addCleanup(provider_thread.stop)
+        return provider_thread.start()
+
+    def test_fails_over_on_5xx(self):
+        failing_url = self.start_provider(completions_provider(error_rate=1, error_status=503))
+        working_url = self.start_provider(completions_provider())
+        client = UpstreamClient(base_urls={"OpenAI": [(failing_url, 1), (working_url, 1)]},
+                                failure_threshold=1)
+        # break ties in favour of the first endpoint so the failing one is tried first
+        with mock.patch("provider_router.random.choice", lambda endpoints: endpoints[0]):
+            for _ in range(3):
+                response = client.chat_completions({"model": "test", "messages": []})
+                self.assertEqual(response.status_code, 200)
+        failing, working = client.router("OpenAI").endpoints
+        self.assertFalse(failing.healthy)
+        self.assertTrue(working.healthy)
+        self.assertEqual(working.outstanding, 0)
+
+    def test_fails_over_on_connect_error(self):
+        closed = FakeProviderThread()
+        closed_url = closed.start()
+        closed.stop()
+        working_url = self.start_provider(completions_provider())
+        client = UpstreamClient(base_urls={"OpenAI": f"{closed_url},{working_url}"})
+        for _ in range(3):
+            response = client.chat_completions({"model": "test", "messages": []})
+            self.assertEqual(response.status_code, 200)
+
+    def test_does_not_fail_over_on_read_timeout(self):
+        slow_url = self.start_provider(completions_provider(latency=1))
+        working_url = self.start_provider(completions_provider())
+        client = UpstreamClient(base_urls={"OpenAI": [(slow_url, 1), (working_url, 1)]},
+                                read_timeout=0.2)
+        # the request may already be being answered, so it is not sent to the working endpoint
+        with mock.patch("provider_router.random.choice", lambda endpoints: endpoints[0]):
+            with self.assertRaises(requests.ReadTimeout):
+                client.chat_completions({"model": "test", "messages": []})
+        slow, working = client.router("OpenAI").endpoints
+        self.assertEqual(slow.consecutive_failures, 1)
+        self.assertEqual(working.outstanding, 0)
+        self.assertIsNone(working.ewma_latency)
+
+    def test_returns_5xx_when_no_endpoint_left(self):
+        failing_url = self.start_provider(completions_provider(error_rate=1, error_status=503))
+        client = UpstreamClient(base_urls={"OpenAI": failing_url})
+        self.assertEqual(client.chat_completions({"model": "test", "messages": []}).status_code, 503)
+
+    def test_stream_keeps_endpoint_outstanding_until_closed(self):
+        client = UpstreamClient(base_urls={"OpenAI": self.start_provider(completions_provider())})
+        endpoint = client.router("OpenAI").endpoints[0]
+        with client.chat_completions({"model": "test", "messages": []}, stream=True):
+            self.assertEqual(endpoint.outstanding, 1)
+        self.assertEqual(endpoint.outstanding, 0)
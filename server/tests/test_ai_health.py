@@ -0,0 +1,62 @@
+import os
+import unittest
+
+import ai_client
+from ai_client import UpstreamClient
+from ai_health import AIHealthProbe, AI_UP
+from benchmarks.fake_provider import FakeProvider
+from tests.provider_thread import FakeProviderThread
+
+
+class RecordingProvider(FakeProvider):
+    """
+    Records the requests received, and answers each completion with "OK"
+    """
+    def __init__(self):
+        super().__init__(tokens=1, token_interval=0, token_text="OK", models=("gpt-4o", "gpt-4o-mini"))
+        self.requests_received = []
+
+    async def list_models(self, writer):
+        self.requests_received.append(("GET", "/v1/models", None))
+        await super().list_models(writer)
+
+    async def completion(self, writer, ai_request):
+        self.requests_received.append(("POST", "/v1/chat/completions", ai_request))
+        await super().completion(writer, ai_request)
+
+
+class AIHealthProbeTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = RecordingProvider()
+        self.provider_thread = FakeProviderThread(self.provider)
+        base_url = self.provider_thread.start()
+        self.previous_client = ai_client._upstream_client, ai_client._upstream_client_pid
+        ai_client._upstream_client = UpstreamClient(base_urls={"OpenAI": base_url})
+        ai_client._upstream_client_pid = os.getpid()
+
+    def tearDown(self):
+        ai_client._upstream_client, ai_client._upstream_client_pid = self.previous_client
+        self.provider_thread.stop()
+
+    def test_models_probe(self):
+        probe = AIHealthProbe(probe="models", interval=3600)
+        health = probe.get_health()
+        self.assertEqual(health["status"], "UP")
+        self.assertEqual(health["models"], 2)
+        self.assertEqual(AI_UP._value.get(), 1)
+        # the cached result is returned until the next background probe
+        self.assertIs(probe.get_health(), health)
+        self.assertEqual(self.provider.requests_received, [("GET", "/v1/models", None)])
+
+    def test_completion_probe_asks_for_one_token(self):
+        health = AIHealthProbe(probe="completion", interval=3600).probe()
+        self.assertEqual(health["ai_response"], "OK")
+        method, path, ai_request = self.provider.requests_received[0]
+        self.assertEqual(ai_request["max_tokens"], 1)
+
+    def test_down(self):
+        self.provider_thread.stop()
+        health = AIHealthProbe(probe="models", interval=3600).probe()
+        self.assertFalse(health["success"])
+        self.assertEqual(health["status"], "DOWN")
+        self.assertEqual(AI_UP._value.get(), 0)
@@ -0,0 +1,294 @@
+import json
+import asyncio
+import threading
+import unittest
+from unittest import mock
+from flask_jwt_extended import create_access_token
+from app import app, db
+from benchmarks.fake_provider import FakeProvider
+from chat_stream_server import ChatStreamServer, read_headers, iter_body
+from models import Document, User
+from utils import server_stats, DBUtils, CHAT_STREAM_ERROR
+from chat_streams import chat_streams
+from provider_router import ProviderRouter
+from admission import AdmissionController
+
+CHAT_REQUEST = {
+    "model_settings": {"provider": "OpenAI", "request": {"model": "fake-model"}},
+    "system_prompt": "You are a helpful assistant",
+    "prompt": "Hello",
+}
+
+
+class RecordingProvider(FakeProvider):
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.ai_requests = []
+
+    async def stream_completion(self, writer, ai_request):
+        self.ai_requests.append(ai_request)
+        await super().stream_completion(writer, ai_request)
+
+
+class KeepAliveTimeoutProvider(FakeProvider):
+    """
+    Closes each connection instead of answering a second request on it,
+    like a provider whose keep-alive timeout ends as the request arrives
+    """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.served = set()
+
+    async def stream_completion(self, writer, ai_request):
+        if writer in self.served:
+            raise ConnectionResetError("Keep-alive timeout")
+        self.served.add(writer)
+        await super().stream_completion(writer, ai_request)
+
+
+class ChatStreamServerTest(unittest.TestCase):
+    def setUp(self):
+        with app.app_context():
+            db.create_all()
+            self.token = create_access_token(identity="testuser")
+
+    def run_server(self, provider, test, provider_port=None, **server_args):
+        """
+        Run the chat server against a fake provider and call test(server, port)
+        """
+        async def run():
+            provider_server = await asyncio.start_server(provider.handle_connection, "127.0.0.1",
+                                                         provider_port or 0)
+            url = f"http://127.0.0.1:{provider_server.sockets[0].getsockname()[1]}/v1"
+            if provider_port is None:
+                # nothing listening, to test a provider that cannot be reached
+                provider_server.close()
+                await provider_server.wait_closed()
+            server = ChatStreamServer({"OpenAI": ProviderRouter("OpenAI", [(url, 1.0)])}, **server_args)
+            chat_server = await asyncio.start_server(server.handle_connection, "127.0.0.1", 0)
+            try:
+                await test(server, chat_server.sockets[0].getsockname()[1])
+            finally:
+                chat_server.close()
+                provider_server.close()
+        asyncio.run(run())
+
+    def post(self, port, body):
+        return (f"POST /chat/v2 HTTP/1.1\r\nHost: 127.0.0.1\r\n"
+                f"Authorization: Bearer {self.token}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n\r\n").encode() + body
+
+    async def chat(self, port, body):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(self.post(port, body))
+        status_line = await reader.readline()
+        headers = await read_headers(reader)
+        text = b"".join([data async for data in iter_body(reader, headers, timeout=5)]).decode()
+        writer.close()
+        return int(status_line.split(b" ", 2)[1]), headers, text
+
+    def test_chat_stream(self):
+        async def test(server, port):
+            status, headers, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(headers["transfer-encoding"], "chunked")
+            self.assertEqual(text, "token " * 5)
+            self.assertEqual(server.open_streams, 0)
+        self.run_server(FakeProvider(tokens=5, token_interval=0), test, provider_port=0)
+
+    def test_buffered_text_flushed_while_provider_is_quiet(self):
+        async def test(server, port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(self.post(port, json.dumps(CHAT_REQUEST).encode()))
+            await reader.readline()
+            headers = await read_headers(reader)
+            chunks = [data async for data in iter_body(reader, headers, timeout=5)]
+            writer.close()
+            # each token is released by the flush interval rather than held until the next one
+            self.assertEqual(chunks, [b"token "] * 3)
+        self.run_server(FakeProvider(tokens=3, token_interval=0.2), test, provider_port=0)
+
+    def test_client_disconnect(self):
+        provider = FakeProvider(tokens=1000, token_interval=0.01)
+
+        async def test(server, port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(self.post(port, json.dumps(CHAT_REQUEST).encode()))
+            self.assertIn(b" 200 ", await reader.readline())
+            await read_headers(reader)
+            await reader.readline()  # the first chunk
+            self.assertEqual(server.open_streams, 1)
+            writer.close()
+            for _ in range(100):
+                if server.open_streams == 0:
+                    break
+                await asyncio.sleep(0.05)
+            self.assertEqual(server.open_streams, 0)
+            # the upstream connection is closed rather than returned to the pool
+            self.assertEqual(sum(len(idle) for idle in server.pool.idle.values()), 0)
+        self.run_server(provider, test, provider_port=0)
+
+    def test_cancel_poll_error_does_not_end_stream(self):
+        async def test(server, port):
+            status, _, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(text, "token " * 5)
+            self.assertGreater(check.call_count, 0)
+        with mock.patch.object(chat_streams, "poll_interval", 0.01), \
+                mock.patch("chat_streams.cancelled_streams", side_effect=RuntimeError("no such table")) as check:
+            self.run_server(FakeProvider(tokens=5, token_interval=0.02), test, provider_port=0)
+
+    def test_stream_usage_only_requested_when_counting_tokens(self):
+        provider = RecordingProvider(tokens=3, token_interval=0)
+
+        async def test(server, port):
+            await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            with mock.patch.dict(app.config, {"SIDEKICK_COUNT_TOKENS": True}):
+                await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+                ollama_request = json.loads(json.dumps(CHAT_REQUEST))
+                ollama_request["model_settings"]["provider"] = "Ollama"
+                await self.chat(port, json.dumps(ollama_request).encode())
+            self.assertEqual([ai_request.get("stream_options") for ai_request in provider.ai_requests],
+                             [None, {"include_usage": True}, None])
+        self.run_server(provider, test, provider_port=0)
+
+    def test_usage_counted_when_client_disconnects(self):
+        provider = FakeProvider(tokens=1000, token_interval=0.01)
+
+        async def test(server, port):
+            prompt_tokens = server_stats.get("usage", {}).get("promptTokens", 0)
+            with mock.patch.dict(app.config, {"SIDEKICK_COUNT_TOKENS": True}):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(self.post(port, json.dumps(CHAT_REQUEST).encode()))
+                await reader.readline()
+                await read_headers(reader)
+                await reader.readline()  # the first chunk
+                writer.close()
+                for _ in range(100):
+                    if server.open_streams == 0:
+                        break
+                    await asyncio.sleep(0.05)
+            self.assertGreater(server_stats["usage"]["promptTokens"], prompt_tokens)
+        self.run_server(provider, test, provider_port=0)
+
+    def test_upstream_error(self):
+        async def test(server, port):
+            status, _, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(status, 200)
+            self.assertTrue(text.startswith("Error - OpenAI API returned status code 500"))
+        self.run_server(FakeProvider(error_rate=1, error_status=500), test, provider_port=0)
+
+    def test_reconnects_when_pooled_connection_is_stale(self):
+        provider = KeepAliveTimeoutProvider(tokens=3, token_interval=0)
+
+        async def test(server, port):
+            router = server.routers["OpenAI"]
+            router.record_failure = mock.Mock(wraps=router.record_failure)
+            for _ in range(2):
+                status, _, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+                self.assertEqual(status, 200)
+                self.assertEqual(text, "token " * 3)
+            router.record_failure.assert_not_called()
+            # the second request was sent on the pooled connection, then on a new one
+            self.assertEqual(provider.requests, 3)
+            self.assertEqual(len(provider.served), 2)
+        self.run_server(provider, test, provider_port=0)
+
+    def test_upstream_error_not_saved_as_reply(self):
+        with app.app_context():
+            if User.query.filter_by(id="testuser").first() is None:
+                DBUtils.create_user("testuser", "testpassword")
+            doc_id = DBUtils.create_document(user_id="testuser", name="testchat", type="chat",
+                                             content={"chat": []})["metadata"]["id"]
+
+        def saved_chat():
+            with app.app_context():
+                return json.loads(Document.query.filter_by(id=doc_id).first().content)["chat"]
+
+        async def test(server, port):
+            status, _, text = await self.chat(port, json.dumps(dict(CHAT_REQUEST, document_id=doc_id)).encode())
+            self.assertTrue(text.startswith("Error - "))
+            # the prompt is appended to the chat document once the response has been sent
+            for _ in range(100):
+                if await asyncio.to_thread(saved_chat):
+                    break
+                await asyncio.sleep(0.01)
+        self.run_server(FakeProvider(error_rate=1, error_status=500), test, provider_port=0)
+        self.assertEqual(saved_chat(), [{"role": "user", "content": "Hello"}])
+
+    def test_upstream_unreachable(self):
+        async def test(server, port):
+            status, _, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(text, CHAT_STREAM_ERROR)
+            self.assertEqual(server.open_streams, 0)
+        self.run_server(FakeProvider(), test)
+
+    def test_upstream_read_timeout(self):
+        async def test(server, port):
+            status, _, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(text, CHAT_STREAM_ERROR)
+        self.run_server(FakeProvider(latency=5), test, provider_port=0, read_timeout=0.2)
+
+    def test_admission_limits(self):
+        async def test(server, port):
+            # the server's own limits, by default none
+            self.assertEqual(ChatStreamServer({}).admission.max_concurrent, 0)
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(self.post(port, json.dumps(CHAT_REQUEST).encode()))
+            self.assertIn(b" 200 ", await reader.readline())
+            status, headers, _ = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(status, 429)
+            self.assertIn("retry-after", headers)
+            writer.close()
+        self.run_server(FakeProvider(tokens=1000, token_interval=0.01), test, provider_port=0,
+                        admission=AdmissionController(max_concurrent=1, max_wait=0.1))
+
+    def test_admission_released_when_stream_cannot_open(self):
+        async def test(server, port):
+            with mock.patch("chat_stream_server.chat_streams.open", side_effect=RuntimeError("Registry error")):
+                reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(self.post(port, json.dumps(CHAT_REQUEST).encode()))
+                # the connection is closed without a response
+                self.assertEqual(await reader.readline(), b"")
+                writer.close()
+            status, _, text = await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+            self.assertEqual(status, 200)
+            self.assertEqual(text, "token " * 3)
+        self.run_server(FakeProvider(tokens=3, token_interval=0), test, provider_port=0,
+                        admission=AdmissionController(max_concurrent=1, max_wait=0.1))
+
+    def test_tokens_counted_off_the_event_loop(self):
+        threads = []
+
+        def fit(*args):
+            threads.append(threading.current_thread())
+            return 0, 0
+
+        def record_usage(*args):
+            threads.append(threading.current_thread())
+
+        async def test(server, port):
+            await self.chat(port, json.dumps(CHAT_REQUEST).encode())
+        with mock.patch("chat_stream_server.fit_ai_request", side_effect=fit), \
+                mock.patch("chat_stream_server.record_stream_usage", side_effect=record_usage), \
+                mock.patch.dict(app.config, {"SIDEKICK_COUNT_TOKENS": True}):
+            self.run_server(FakeProvider(tokens=3, token_interval=0), test, provider_port=0)
+        self.assertEqual(len(threads), 2)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_bad_request_body(self):
+        async def test(server, port):
+            status, _, _ = await self.chat(port, b"not json")
+            self.assertEqual(status, 400)
+            request = dict(CHAT_REQUEST)
+            del request["model_settings"]
+            status, _, _ = await self.chat(port, json.dumps(request).encode())
+            self.assertEqual(status, 400)
+            self.assertEqual(server.open_streams, 0)
+        self.run_server(FakeProvider(), test, provider_port=0)
+
+
+if __name__ == '__main__':
+    unittest.main()
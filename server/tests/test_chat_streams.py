@@ -0,0 +1,91 @@
+import unittest
+from unittest import mock
+from flask import Flask
+from sqlalchemy.exc import OperationalError
+from app import db
+from chat_streams import ChatStreams, request_cancel, cancelled_streams, CHAT_CANCEL_TOKENS_SAVED
+from models import CancelledStream
+
+app = Flask(__name__)
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
+db.init_app(app)
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+class ChatStreamsTest(unittest.TestCase):
+    def setUp(self):
+        app.app_context().push()
+        with app.app_context():
+            db.create_all()
+        self.clock = FakeClock()
+        self.streams = ChatStreams(poll_interval=1, clock=self.clock)
+
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+    def test_cancel_in_this_process(self):
+        stream = self.streams.open("alice")
+        self.assertFalse(self.streams.cancel(stream.id, "bob"))
+        self.assertFalse(stream.cancelled())
+        self.assertTrue(self.streams.cancel(stream.id, "alice"))
+        self.assertTrue(stream.cancelled())
+        self.streams.close(stream)
+        self.assertFalse(self.streams.cancel(stream.id, "alice"))
+
+    def test_cancel_from_another_process(self):
+        stream = self.streams.open("alice", "stream-1")
+        request_cancel("stream-1", "bob")
+        request_cancel("stream-1", "alice")
+        # the database is only checked once per poll interval
+        self.assertFalse(stream.cancelled())
+        self.clock.time = 1
+        self.assertTrue(stream.cancelled())
+        self.streams.close(stream)
+        # bob's request for the same stream id is his own and did not touch alice's
+        self.assertEqual([(cancelled.user_id, cancelled.stream_id) for cancelled in CancelledStream.query],
+                         [("bob", "stream-1")])
+
+    def test_one_query_for_all_open_streams(self):
+        streams = [self.streams.open("alice", f"stream-{i}") for i in range(3)]
+        request_cancel("stream-1", "alice")
+        request_cancel("stream-2", "bob")
+        self.clock.time = 1
+        with mock.patch("chat_streams.cancelled_streams", wraps=cancelled_streams) as check:
+            self.assertEqual([stream.cancelled() for stream in streams], [False, True, False])
+        check.assert_called_once()
+
+    def test_poll_error_does_not_cancel(self):
+        stream = self.streams.open("alice", "stream-1")
+        self.clock.time = 1
+        error = OperationalError("SELECT", {}, Exception("no such table: cancelled_streams"))
+        with mock.patch("chat_streams.cancelled_streams", side_effect=error):
+            self.assertFalse(stream.cancelled())
+        request_cancel("stream-1", "alice")
+        self.clock.time = 2
+        self.assertTrue(stream.cancelled())
+
+    def test_same_stream_id_from_another_user(self):
+        stream = self.streams.open("alice", "stream-1")
+        other = self.streams.open("bob", "stream-1")
+        self.assertTrue(self.streams.cancel("stream-1", "bob"))
+        self.assertFalse(stream.cancelled())
+        self.streams.close(other)
+        self.assertTrue(self.streams.cancel("stream-1", "alice"))
+        self.assertTrue(stream.cancelled())
+
+    def test_tokens_saved_estimate(self):
+        self.streams.record_completed(100)
+        self.streams.record_completed(300)
+        saved_before = CHAT_CANCEL_TOKENS_SAVED._value.get()
+        self.assertEqual(self.streams.record_closed_early("cancel", 50), 150)
+        self.assertEqual(self.streams.record_closed_early("disconnect", 500), 0)
+        self.assertEqual(CHAT_CANCEL_TOKENS_SAVED._value.get() - saved_before, 150)
@@ -0,0 +1,119 @@
+import os
+import json
+import time
+import asyncio
+import unittest
+
+from flask_jwt_extended import create_access_token
+
+import ai_client
+from app import app, db
+from ai_client import UpstreamClient
+from benchmarks.fake_provider import FakeProvider
+from models import Document, User
+from utils import DBUtils, CHAT_STOPPED_NOTE, CHAT_STREAM_ERROR
+from tests.provider_thread import FakeProviderThread
+
+CHAT_REQUEST = {
+    "model_settings": {"provider": "OpenAI", "request": {"model": "fake-model"}},
+    "system_prompt": "You are a helpful assistant",
+    "prompt": "Hello",
+}
+
+
+class UnchunkedProvider(FakeProvider):
+    """
+    Streams without chunked transfer encoding, ending the body by closing the connection
+    """
+    async def stream_completion(self, writer, ai_request):
+        writer.write(b"HTTP/1.1 200 OK\r\n"
+                     b"Content-Type: text/event-stream\r\n"
+                     b"Connection: close\r\n\r\n")
+        for token in range(self.tokens):
+            event = json.dumps(self.chunk(ai_request["model"], {"content": self.token_text}))
+            writer.write(f"data: {event}\n\n".encode())
+            await writer.drain()
+            await asyncio.sleep(self.token_interval)
+        writer.write(b"data: [DONE]\n\n")
+        writer.close()
+
+
+class ChatV2Test(unittest.TestCase):
+    def setUp(self):
+        self.app_context = app.app_context()
+        self.app_context.push()
+        db.create_all()
+        self.provider = FakeProviderThread(FakeProvider(tokens=1000, token_interval=0.01))
+        self.previous_client = ai_client._upstream_client, ai_client._upstream_client_pid
+        ai_client._upstream_client = UpstreamClient(base_urls={"OpenAI": self.provider.start()})
+        ai_client._upstream_client_pid = os.getpid()
+        if User.query.filter_by(id="testuser").first() is None:
+            DBUtils.create_user("testuser", "testpassword")
+        self.document_id = DBUtils.create_document(user_id="testuser", name="testchat", type="chat",
+                                                   content={"chat": []})["metadata"]["id"]
+        self.headers = {"Authorization": f"Bearer {create_access_token(identity='testuser')}"}
+        self.client = app.test_client()
+
+    def tearDown(self):
+        ai_client._upstream_client, ai_client._upstream_client_pid = self.previous_client
+        self.provider.stop()
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def saved_chat(self):
+        db.session.expire_all()
+        return json.loads(db.session.get(Document, self.document_id).content)["chat"]
+
+    def start_provider(self, provider):
+        self.provider.stop()
+        self.provider = FakeProviderThread(provider)
+        ai_client._upstream_client = UpstreamClient(base_urls={"OpenAI": self.provider.start()})
+
+    def test_cancel_saves_reply_as_shown(self):
+        response = self.client.post("/chat/v2", headers=self.headers, buffered=False, json=dict(
+            CHAT_REQUEST, document_id=self.document_id, stream_id="stream-1"))
+        chunks = iter(response.response)
+        text = next(chunks).decode()
+        cancel = self.client.post("/chat/v2/cancel", headers=self.headers, json={"stream_id": "stream-1"})
+        self.assertTrue(cancel.json["success"])
+        # the stream ends at the next text from the provider rather than after all 1000 tokens
+        text += b"".join(chunks).decode()
+        response.close()
+        self.assertLess(len(text), len("token " * 1000))
+        self.assertEqual(self.saved_chat(), [
+            {"role": "user", "content": "Hello"},
+            {"role": "assistant", "content": text + "\n\n" + CHAT_STOPPED_NOTE}])
+
+    def test_reply_appended_to_chat(self):
+        self.provider.provider.tokens = 3
+        response = self.client.post("/chat/v2", headers=self.headers, json=dict(
+            CHAT_REQUEST, document_id=self.document_id, document_prompt="Hi"))
+        self.assertEqual(response.get_data(as_text=True), "token " * 3)
+        self.assertEqual(self.saved_chat(), [{"role": "user", "content": "Hi"},
+                                             {"role": "assistant", "content": "token " * 3}])
+
+    def test_upstream_error_ends_stream_with_error(self):
+        self.start_provider(FakeProvider(tokens=5, token_interval=0, disconnect_rate=1, seed=1))
+        response = self.client.post("/chat/v2", headers=self.headers, json=dict(
+            CHAT_REQUEST, document_id=self.document_id))
+        text = response.get_data(as_text=True)
+        self.assertTrue(text.endswith(CHAT_STREAM_ERROR))
+        self.assertEqual(self.saved_chat(), [{"role": "user", "content": "Hello"},
+                                             {"role": "assistant", "content": text}])
+
+    def test_unchunked_response_relayed_as_it_arrives(self):
+        self.start_provider(UnchunkedProvider(tokens=2, token_interval=2))
+        start = time.monotonic()
+        response = self.client.post("/chat/v2", headers=self.headers, buffered=False, json=CHAT_REQUEST)
+        chunks = iter(response.response)
+        # the first event is far shorter than a fixed size read, so it is only
+        # relayed before the next token if the bytes available are read
+        self.assertEqual(next(chunks).decode(), "token ")
+        self.assertLess(time.monotonic() - start, 1)
+        self.assertEqual(b"".join(chunks).decode(), "token ")
+        response.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
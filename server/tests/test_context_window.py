@@ -0,0 +1,44 @@
+import unittest
+
+from context_window import fit_context_window, get_context_token_size
+from token_counter import TokenCounter
+
+
+class FitContextWindowTest(unittest.TestCase):
+    def setUp(self):
+        # with one token per character each history message and the prompt is 3 + 4 + 100 = 107 tokens
+        # and the system prompt is 3 + 6 + 100 = 109 tokens
+        self.counter = TokenCounter(approximate=True, chars_per_token=1)
+        self.messages = [{"role": "system", "content": "s" * 100}] + \
+            [{"role": "user" if i % 2 == 0 else "asst", "content": str(i) * 100} for i in range(5)] + \
+            [{"role": "user", "content": "p" * 100}]
+
+    def test_fits_without_dropping(self):
+        messages, dropped_messages, dropped_tokens = fit_context_window(
+            self.messages, 10000, 1000, "llama3", self.counter)
+        self.assertIs(messages, self.messages)
+        self.assertEqual((dropped_messages, dropped_tokens), (0, 0))
+
+    def test_drops_oldest_history(self):
+        # room for the system prompt, the prompt, two history messages and 3 reply priming tokens
+        messages, dropped_messages, dropped_tokens = fit_context_window(
+            self.messages, 109 + 3 * 107 + 3 + 100, 100, "llama3", self.counter)
+        self.assertEqual(messages, [self.messages[0]] + self.messages[4:])
+        self.assertEqual((dropped_messages, dropped_tokens), (3, 3 * 107))
+
+    def test_keeps_system_prompt_and_prompt(self):
+        messages, dropped_messages, _ = fit_context_window(
+            self.messages, 10, 0, "llama3", self.counter)
+        self.assertEqual(messages, [self.messages[0], self.messages[-1]])
+        self.assertEqual(dropped_messages, 5)
+
+
+class ContextTokenSizeTest(unittest.TestCase):
+    def test_from_default_model_settings(self):
+        self.assertEqual(get_context_token_size(
+            {"provider": "OpenAI", "request": {"model": "gpt-4"}, "contextTokenSize": 1}), 8192)
+
+    def test_from_request(self):
+        self.assertEqual(get_context_token_size(
+            {"provider": "Other", "request": {"model": "x"}, "contextTokenSize": 2048}), 2048)
+        self.assertIsNone(get_context_token_size({"request": {"model": "x"}}))
@@ -0,0 +1,88 @@
+import os
+import sys
+import json
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+from init import SQLITE_CREATE_ALL_REVISION
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class InitTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.db_path = os.path.join(self.directory.name, "sidekick.db")
+        self.env = dict(os.environ, SQLALCHEMY_DATABASE_URI=f"sqlite:///{self.db_path}", FLASK_APP="app.py")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def run_server_command(self, *args):
+        subprocess.run([sys.executable, *args], cwd=SERVER_DIR, env=self.env, check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def create_all_database(self):
+        """
+        Create a database with the tables that init used to set up with create_all on SQLite
+        """
+        self.run_server_command("-m", "flask", "db", "upgrade", SQLITE_CREATE_ALL_REVISION)
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("DROP TABLE alembic_version")
+
+    def insert_document(self, id, user_id, name, content, tags=(), created="2026-01-01 00:00:00"):
+        with sqlite3.connect(self.db_path) as connection:
+            connection.execute("INSERT OR IGNORE INTO users VALUES (?, 'hash', '{}', ?, 0)", (user_id, user_id))
+            connection.execute("INSERT INTO documents VALUES (?, ?, ?, 'personas', ?, ?, '{}', ?, 'private', ?)",
+                               (id, user_id, name, created, created, json.dumps(content), len(json.dumps(content))))
+            for tag in tags:
+                connection.execute("INSERT OR IGNORE INTO tags VALUES (?, ?, ?)", (tag, created, created))
+                connection.execute("INSERT INTO document_tags VALUES (?, ?, ?, ?)", (id, tag, created, created))
+
+    def query(self, statement):
+        with sqlite3.connect(self.db_path) as connection:
+            return connection.execute(statement).fetchall()
+
+    def test_init_new_database(self):
+        self.run_server_command("init.py")
+        self.assertEqual(len(self.query("SELECT version_num FROM alembic_version")), 1)
+        self.assertEqual(self.query("SELECT id FROM users ORDER BY id"), [("admin",), ("sidekick",)])
+
+    def test_init_upgrades_create_all_database(self):
+        self.create_all_database()
+        self.run_server_command("init.py")
+        indexes = {row[0] for row in self.query("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        self.assertTrue({"ix_documents_user_id_type_name", "ix_documents_type_visibility_user_id",
+                         "ix_document_tags_tag_name", "ix_user_tags_tag_name"} <= indexes)
+        self.run_server_command("-m", "flask", "db", "check")
+
+    def test_init_shares_default_documents_of_create_all_database(self):
+        self.create_all_database()
+        # the copies of the default documents that every user used to get, made in the same order
+        for user_id, created in (("sidekick", "2026-01-01 00:00:0"), ("testuser", "2026-01-02 00:00:0")):
+            self.insert_document(f"{user_id}-a", user_id, "Persona A", {"persona": "a"}, tags=["tag"],
+                                 created=created + "1")
+            if user_id == "testuser":
+                # testuser edited and renamed B, deleted C and made their own persona later
+                self.insert_document("testuser-b", user_id, "My Persona", {"persona": "b changed"},
+                                     created=created + "2")
+                self.insert_document("testuser-own", user_id, "Persona C", {"persona": "own"},
+                                     created="2026-02-01 00:00:00")
+            else:
+                self.insert_document("sidekick-b", user_id, "Persona B", {"persona": "b"}, created=created + "2")
+                self.insert_document("sidekick-c", user_id, "Persona C", {"persona": "c"}, created=created + "3")
+        self.run_server_command("init.py")
+        self.assertEqual(self.query("SELECT user_id, name, visibility, default_id FROM documents "
+                                    "WHERE id LIKE 'sidekick-%' OR user_id = 'testuser' ORDER BY user_id, visibility, name"),
+                         [("sidekick", "Persona A", "default", None),
+                          ("sidekick", "Persona B", "default", None),
+                          ("sidekick", "Persona C", "default", None),
+                          ("testuser", "Persona C", "deleted", "sidekick-c"),
+                          ("testuser", "My Persona", "private", "sidekick-b"),
+                          ("testuser", "Persona C", "private", None)])
+        self.assertEqual(self.query("SELECT document_id FROM document_tags WHERE tag_name = 'tag'"),
+                         [("sidekick-a",)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import json
+import asyncio
+import threading
+import unittest
+from unittest import mock
+
+from flask_jwt_extended import create_access_token
+
+import ai_client
+import routes
+from app import app
+from ai_client import UpstreamClient
+from benchmarks.fake_provider import FakeProvider
+from tests.provider_thread import FakeProviderThread
+
+
+class NamingProvider(FakeProvider):
+    """
+    Names each topic after the text at the end of the prompt, failing for the text "fail",
+    and records the most completions it was answering at once
+    """
+    def __init__(self, delay=0):
+        super().__init__(token_interval=0)
+        self.delay = delay
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def completion(self, writer, ai_request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.in_flight -= 1
+        text = ai_request["messages"][-1]["content"].rsplit(": ", 1)[-1]
+        if text == "fail":
+            self.write_error(writer)
+            return
+        self.write_json(writer, 200, {"choices": [{"message": {"content": f'"Topic {text}"'}}],
+                                      "usage": {"prompt_tokens": 1, "completion_tokens": 1,
+                                                "total_tokens": 2}})
+
+
+class NameTopicBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.provider = FakeProviderThread(NamingProvider())
+        base_url = self.provider.start()
+        self.previous_client = ai_client._upstream_client, ai_client._upstream_client_pid
+        ai_client._upstream_client = UpstreamClient(base_urls={"OpenAI": base_url})
+        ai_client._upstream_client_pid = os.getpid()
+        with app.app_context():
+            token = create_access_token(identity="alice")
+        self.headers = {"Authorization": f"Bearer {token}", "X-Sidekick-Cache": "bypass"}
+        self.client = app.test_client()
+
+    def tearDown(self):
+        ai_client._upstream_client, ai_client._upstream_client_pid = self.previous_client
+        self.provider.stop()
+
+    def test_results_for_each_text(self):
+        response = self.client.post("/nametopic/v1/batch", headers=self.headers,
+                                    json={"texts": ["a", "fail", "b"]})
+        self.assertEqual(response.mimetype, "application/x-ndjson")
+        results = {result["index"]: result
+                   for result in map(json.loads, response.get_data(as_text=True).splitlines())}
+        self.assertEqual(sorted(results), [0, 1, 2])
+        self.assertEqual(results[0]["topic_name"], "Topic a")
+        self.assertEqual(results[2]["topic_name"], "Topic b")
+        self.assertFalse(results[1]["success"])
+        self.assertIn("error", results[1])
+
+    def test_concurrency_shared_by_batch_requests(self):
+        slow_provider = NamingProvider(delay=0.05)
+        slow_provider_thread = FakeProviderThread(slow_provider)
+        self.addCleanup(slow_provider_thread.stop)
+        ai_client._upstream_client = UpstreamClient(base_urls={"OpenAI": slow_provider_thread.start()})
+        previous_executor = routes._batch_executor, routes._batch_executor_pid
+        routes._batch_executor = None
+        self.addCleanup(setattr, routes, "_batch_executor", previous_executor[0])
+        self.addCleanup(setattr, routes, "_batch_executor_pid", previous_executor[1])
+        self.addCleanup(lambda: routes._batch_executor.shutdown())
+
+        def post_batch(prefix):
+            response = app.test_client().post("/nametopic/v1/batch", headers=self.headers,
+                                              json={"texts": [f"{prefix}{i}" for i in range(6)]})
+            self.assertEqual(len(response.get_data(as_text=True).splitlines()), 6)
+
+        with mock.patch.dict(app.config, {"SIDEKICK_BATCH_CONCURRENCY": 2}):
+            threads = [threading.Thread(target=post_batch, args=(prefix,)) for prefix in "abc"]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(slow_provider.max_in_flight, 2)
+
+    def test_texts_required(self):
+        for body in ({}, {"texts": []}, {"texts": ["a"] * (app.config["SIDEKICK_BATCH_MAX_ITEMS"] + 1)}):
+            response = self.client.post("/nametopic/v1/batch", headers=self.headers, json=body)
+            self.assertEqual(response.status_code, 400)
@@ -0,0 +1,57 @@
+import unittest
+
+from provider_router import ProviderRouter, parse_endpoints
+
+
+class ProviderRouterTest(unittest.TestCase):
+    def router(self, policy, endpoints=(("http://a/v1", 1), ("http://b/v1", 1))):
+        return ProviderRouter("Ollama", list(endpoints), policy=policy, failure_threshold=2)
+
+    def test_parse_endpoints(self):
+        self.assertEqual(parse_endpoints("http://a/v1/;weight=3, http://b/v1"),
+                         [("http://a/v1", 3.0), ("http://b/v1", 1.0)])
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            self.router("round_robin")
+
+    def test_least_outstanding(self):
+        router = self.router("least_outstanding")
+        a, b = router.endpoints
+        router.start(a)
+        self.assertIs(router.choose(), b)
+        router.start(b)
+        router.start(b)
+        self.assertIs(router.choose(), a)
+
+    def test_ewma_prefers_lower_latency(self):
+        router = self.router("ewma")
+        a, b = router.endpoints
+        router.record_success(a, 2.0)
+        router.record_success(b, 0.5)
+        self.assertIs(router.choose(), b)
+        # a busy fast endpoint loses to an idle slower one
+        for _ in range(4):
+            router.start(b)
+        self.assertIs(router.choose(), a)
+
+    def test_weighted(self):
+        router = self.router("weighted", (("http://a/v1", 1), ("http://b/v1", 0)))
+        for _ in range(20):
+            self.assertEqual(router.choose().url, "http://a/v1")
+
+    def test_failures_take_endpoint_out_of_rotation(self):
+        router = self.router("least_outstanding")
+        a, b = router.endpoints
+        router.record_failure(a)
+        self.assertTrue(a.healthy)
+        router.record_failure(a)
+        self.assertFalse(a.healthy)
+        router.start(b)
+        self.assertIs(router.choose(), b)
+        self.assertIsNone(router.choose(exclude=[a, b]))
+        # when every endpoint is out of rotation they are all still tried
+        router.set_healthy(b, False)
+        self.assertIs(router.choose(exclude=[b]), a)
+        router.record_success(a, 0.1)
+        self.assertTrue(a.healthy)
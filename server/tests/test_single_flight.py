@@ -0,0 +1,98 @@
+import os
+import time
+import threading
+import tempfile
+import unittest
+from multiprocessing import Process, Queue
+
+from single_flight import SingleFlight, file_lock
+
+
+def hold_lock(lock_dir, started, release):
+    with file_lock(lock_dir, "key"):
+        started.put(True)
+        release.get()
+
+
+class CountingLock:
+    """
+    A lock that counts how many times it has been acquired
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquired = 0
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.acquired += 1
+
+    def __exit__(self, *args):
+        self.lock.release()
+
+
+class SingleFlightTest(unittest.TestCase):
+    def test_concurrent_calls_share_one_result(self):
+        single_flight = SingleFlight()
+        single_flight.lock = CountingLock()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            release.wait()
+            return {"n": len(calls)}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(single_flight.do("k", fetch)))
+                   for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        # release the call once every thread has looked it up, i.e. is inside do()
+        while single_flight.lock.acquired < 5:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual([result for result, shared in results], [{"n": 1}] * 5)
+        self.assertEqual(sorted(shared for result, shared in results), [False] + [True] * 4)
+        # once the call has finished the next one is made again
+        self.assertEqual(single_flight.do("k", fetch), ({"n": 2}, False))
+
+    def test_error_is_raised_for_every_caller(self):
+        single_flight = SingleFlight()
+
+        def fail():
+            raise ValueError("upstream down")
+
+        with self.assertRaises(ValueError):
+            single_flight.do("k", fail)
+        self.assertEqual(single_flight.calls, {})
+
+
+class FileLockTest(unittest.TestCase):
+    def test_lock_is_shared_between_processes(self):
+        with tempfile.TemporaryDirectory() as lock_dir:
+            started, release = Queue(), Queue()
+            process = Process(target=hold_lock, args=(lock_dir, started, release))
+            process.start()
+            started.get(timeout=10)
+            threading.Timer(0.1, release.put, args=(True,)).start()
+            with file_lock(lock_dir, "key") as waited:
+                self.assertTrue(waited)
+            process.join()
+            # the lock files are removed when the locks are released
+            self.assertEqual(os.listdir(lock_dir), [])
+
+    def test_keys_are_locked_separately(self):
+        with tempfile.TemporaryDirectory() as lock_dir:
+            started, release = Queue(), Queue()
+            process = Process(target=hold_lock, args=(lock_dir, started, release))
+            process.start()
+            started.get(timeout=10)
+            try:
+                with file_lock(lock_dir, "other key", timeout=1) as waited:
+                    self.assertFalse(waited)
+            finally:
+                release.put(True)
+                process.join()
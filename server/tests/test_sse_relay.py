@@ -0,0 +1,112 @@
+import json
+import threading
+import unittest
+
+from sse_relay import SSERelay, relay_stream
+
+
+def event(delta, **choice):
+    return ("data: " + json.dumps({"id": "chatcmpl-1", "object": "chat.completion.chunk",
+                                   "choices": [dict(index=0, delta=delta, finish_reason=None,
+                                                    **choice)]}) + "\n\n").encode()
+
+
+class FakeClock:
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+class SSERelayTest(unittest.TestCase):
+    def test_relays_only_content(self):
+        relay = SSERelay(flush_interval=0, flush_size=0)
+        stream = event({"role": "assistant", "content": ""}) + \
+            event({"content": "Hello"}) + \
+            event({"content": " \"wörld\"\n"}) + \
+            event({}, logprobs={"content": [{"token": "x"}]}) + \
+            b"data: [DONE]\n\n"
+        text = "".join(relay.feed(stream) + relay.close())
+        self.assertEqual(text, "Hello \"wörld\"\n")
+        self.assertEqual(relay.events, 5)
+        self.assertTrue(relay.done)
+
+    def test_events_split_across_reads(self):
+        relay = SSERelay(flush_interval=0, flush_size=0)
+        stream = event({"content": "one"}) + event({"content": " two"})
+        text = ""
+        for i in range(0, len(stream), 7):
+            text += "".join(relay.feed(stream[i:i + 7]))
+        text += "".join(relay.close())
+        self.assertEqual(text, "one two")
+
+    def test_coalesces_until_size_or_interval(self):
+        clock = FakeClock()
+        relay = SSERelay(flush_interval=0.02, flush_size=10, clock=clock)
+        # the first text is relayed straight away
+        self.assertEqual(relay.feed(event({"content": "a"})), ["a"])
+        self.assertEqual(relay.feed(event({"content": "b"})), [])
+        self.assertEqual(relay.feed(event({"content": "c"})), [])
+        clock.time = 0.03
+        self.assertEqual(relay.feed(event({"content": "d"})), ["bcd"])
+        self.assertEqual(relay.feed(event({"content": "0123456789"})), ["0123456789"])
+        self.assertEqual(relay.feed(event({"content": "e"})), [])
+        self.assertEqual(relay.close(), ["e"])
+
+    def test_poll_releases_text_while_upstream_is_quiet(self):
+        clock = FakeClock()
+        relay = SSERelay(flush_interval=0.02, flush_size=10, clock=clock)
+        self.assertIsNone(relay.flush_due_in())
+        self.assertEqual(relay.feed(event({"content": "a"})), ["a"])
+        self.assertIsNone(relay.flush_due_in())
+        clock.time = 0.005
+        self.assertEqual(relay.feed(event({"content": "b"})), [])
+        self.assertAlmostEqual(relay.flush_due_in(), 0.02)
+        clock.time = 0.015
+        self.assertAlmostEqual(relay.flush_due_in(), 0.01)
+        self.assertEqual(relay.poll(), [])
+        clock.time = 0.025
+        self.assertEqual(relay.flush_due_in(), 0)
+        self.assertEqual(relay.poll(), ["b"])
+        self.assertIsNone(relay.flush_due_in())
+        self.assertEqual(relay.poll(), [])
+
+    def test_relay_stream_flushes_on_a_timer(self):
+        relay = SSERelay(flush_interval=0.01, flush_size=10)
+        release = threading.Event()
+
+        def chunks():
+            yield event({"content": "a"})
+            yield event({"content": "b"})
+            # the provider pauses until the buffered text has been released
+            release.wait(5)
+            yield event({"content": "c"})
+
+        texts = relay_stream(relay, chunks())
+        self.assertEqual(next(texts), ["a"])
+        released = []
+        while not released:
+            released = next(texts)
+        self.assertEqual(released, ["b"])
+        release.set()
+        self.assertEqual([text for texts in texts for text in texts] + relay.close(), ["c"])
+
+    def test_error_event(self):
+        relay = SSERelay()
+        stream = b'data: {"error": {"message": "overloaded", "type": "server_error"}}\n\n'
+        text = "".join(relay.feed(stream) + relay.close())
+        self.assertEqual(text, "Error - message: overloaded, type: server_error")
+        self.assertEqual(relay.errors, [text])
+
+    def test_usage_event(self):
+        relay = SSERelay(flush_interval=0, flush_size=0)
+        usage = {"prompt_tokens": 12, "completion_tokens": 2, "total_tokens": 14}
+        stream = event({"content": "Hi"}) + event({"content": "!"}) + \
+            ("data: " + json.dumps({"id": "chatcmpl-1", "choices": [], "usage": usage}) + "\n\n").encode() + \
+            b"data: [DONE]\n\n"
+        self.assertIsNone(SSERelay().usage)
+        text = "".join(relay.feed(stream) + relay.close())
+        self.assertEqual(text, "Hi!")
+        self.assertEqual(relay.usage, usage)
+        self.assertEqual(relay.errors, [])
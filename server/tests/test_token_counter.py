@@ -0,0 +1,43 @@
+import unittest
+from unittest import mock
+
+import token_counter
+from token_counter import TokenCounter
+
+
+class WordEncoding:
+    """Stand-in for a tiktoken encoding with one token per word"""
+    def encode(self, text):
+        return text.split()
+
+
+@mock.patch.object(token_counter, "get_encoding", lambda model: WordEncoding())
+class TokenCounterTest(unittest.TestCase):
+    def setUp(self):
+        self.messages = [
+            {"role": "system", "content": "You are a helpful advisor."},
+            {"role": "user", "content": "Hello, how are you?", "name": "bob"},
+        ]
+
+    def test_exact_count(self):
+        # from the OpenAI cookbook: 3 tokens per message, 1 per name, 3 to prime the reply
+        # system message: 3 + 1 + 5, user message: 3 + 1 + 4 + 1 + 1
+        self.assertEqual(TokenCounter().count_messages(self.messages, "gpt-4o"), 22)
+
+    def test_only_new_messages_are_encoded(self):
+        counter = TokenCounter()
+        counter.count_messages(self.messages, "gpt-4o")
+        with mock.patch.object(counter, "count_text", wraps=counter.count_text) as count_text:
+            total = counter.count_messages(self.messages + [{"role": "assistant", "content": "Fine"}], "gpt-4o")
+            self.assertEqual(count_text.call_count, 2)
+        self.assertEqual(total, 22 + 3 + 2)
+
+    def test_approximate_count(self):
+        counter = TokenCounter(approximate=True)
+        messages = [{"role": "user", "content": "12345678"}]
+        # 1 token for "user", 2 for the content, 3 per message and 3 to prime the reply
+        self.assertEqual(counter.count_messages(messages, "llama3"), 9)
+
+    def test_unknown_model(self):
+        with self.assertRaises(NotImplementedError):
+            TokenCounter().count_messages(self.messages, "llama3")
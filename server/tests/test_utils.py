@@ -1,9 +1,13 @@
+import json
 import unittest
+from unittest import mock
 from datetime import datetime
 from flask import Flask
+from sqlalchemy import event
+from sqlalchemy.exc import NoResultFound
 from app import db
-from utils import DBUtils
-from models import User, Document
+from utils import DBUtils, DEFAULT_DOCUMENTS_USER_ID, default_user_settings, update_default_documents
+from models import User, Document, Tag, DocumentTag, UserTag
 
 app = Flask(__name__)
 app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///:memory:"
@@ -21,6 +25,20 @@ class ModelTest(unittest.TestCase):
             db.session.remove()
             db.drop_all()
 
+    def record_queries(self, fn, *args):
+        statements = []
+        listener = lambda conn, cursor, statement, *args: statements.append(statement)
+        event.listen(db.engine, "before_cursor_execute", listener)
+        try:
+            result = fn(*args)
+        finally:
+            event.remove(db.engine, "before_cursor_execute", listener)
+        return result, statements
+
+    def count_queries(self, fn, *args):
+        result, statements = self.record_queries(fn, *args)
+        return result, len(statements)
+
     def test_create_user(self):
         DBUtils.create_user("testuser", "testpassword",
                             {"propA": "testA", "propB": "testB"})
@@ -30,9 +48,56 @@ class ModelTest(unittest.TestCase):
             "id": "testuser", "properties": {"propA": "testA",
                                              "propB": "testB"}})
         self.assertListEqual(sorted(list(set(d.type for d in user.documents))),
-                             sorted(["settings", "personas",
-                                     "prompt_templates"]))
-        self.assertEqual(len(user.documents), 51)
+                             ["settings"])
+        self.assertEqual(len(user.documents), len(default_user_settings()))
+
+    def test_create_user_seeds_in_bulk(self):
+        user, queries = self.count_queries(DBUtils.create_user, "testuser", "testpassword")
+        self.assertLess(queries, 10)
+        documents = Document.query.filter_by(user_id="testuser").all()
+        seeds = {seed["name"]: seed for seed in default_user_settings()}
+        self.assertEqual(len(documents), len(seeds))
+        for document in documents:
+            self.assertEqual(document.type, "settings")
+            self.assertEqual(json.loads(document.content), json.loads(seeds[document.name]["content"]))
+
+    def test_default_documents_copy_on_write(self):
+        DBUtils.create_user(DEFAULT_DOCUMENTS_USER_ID, "testpassword")
+        DBUtils.create_user("testuser", "testpassword", name="Test User")
+        DBUtils.create_user("otheruser", "testpassword", name="Other User")
+        update_default_documents()
+        defaults = {d["name"]: d for d in DBUtils.list_documents("personas", "testuser")["documents"]}
+        self.assertGreater(len(defaults), 1)
+        self.assertTrue(all(d["user_id"] == "testuser" and d["user_name"] == "Test User" and
+                            d["visibility"] == "private" for d in defaults.values()))
+        self.assertEqual(Document.query.filter_by(type="personas").count(), len(defaults))
+        edited, deleted = list(defaults.values())[:2]
+
+        copy_id = DBUtils.copy_on_write(edited["id"], "testuser")
+        self.assertNotEqual(copy_id, edited["id"])
+        self.assertEqual(DBUtils.copy_on_write(edited["id"], "testuser"), copy_id)
+        DBUtils.update_document(id=copy_id, name="Edited", tags=["edited"], properties={},
+                                content={"persona": "edited"})
+        DBUtils.delete_document(DBUtils.copy_on_write(deleted["id"], "testuser"))
+
+        mine = {d["id"]: d for d in DBUtils.list_documents("personas", "testuser")["documents"]}
+        self.assertEqual(len(mine), len(defaults) - 1)
+        self.assertEqual(mine[copy_id]["name"], "Edited")
+        self.assertNotIn(edited["id"], mine)
+        self.assertNotIn(deleted["id"], mine)
+        self.assertEqual(len(DBUtils.list_all_visible_documents("personas", "testuser")["documents"]),
+                         len(defaults) - 1)
+        self.assertEqual(DBUtils.get_document_for_user(edited["id"], "testuser")["content"],
+                         {"persona": "edited"})
+        with self.assertRaises(NoResultFound):
+            DBUtils.get_document_for_user(deleted["id"], "testuser")
+
+        others = DBUtils.list_documents("personas", "otheruser")["documents"]
+        self.assertCountEqual([d["id"] for d in others], [d["id"] for d in defaults.values()])
+        self.assertEqual(DBUtils.get_document_for_user(edited["id"], "otheruser")["metadata"]["name"],
+                         edited["name"])
+        self.assertEqual(DBUtils.get_document_for_user(deleted["id"], "otheruser")["metadata"]["user_name"],
+                         "Other User")
 
     def test_create_document(self):
         DBUtils.create_user("testuser", "testpassword")
@@ -112,6 +177,206 @@ class ModelTest(unittest.TestCase):
         DBUtils.delete_user("testuser")
         user = Document.query.filter_by(id="1").first()
         self.assertIsNone(user)
+
+    def test_delete_user_set_based(self):
+        query_counts = []
+        for user_id, documents in (("smalluser", 2), ("largeuser", 20)):
+            DBUtils.create_user(user_id, "testpassword")
+            for i in range(documents):
+                DBUtils.create_document(user_id=user_id, name=f"doc{i}", type="notes", tags=[f"tag{i}"])
+            result, queries = self.count_queries(DBUtils.delete_user, user_id)
+            self.assertTrue(result["success"])
+            query_counts.append(queries)
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Document.query.count(), 0)
+        self.assertEqual(DocumentTag.query.count(), 0)
+        self.assertEqual(UserTag.query.count(), 0)
+        self.assertFalse(DBUtils.delete_user("largeuser")["success"])
+
+    def test_delete_user_in_background(self):
+        DBUtils.create_user("testuser", "testpassword")
+        DBUtils.create_user("otheruser", "testpassword")
+        for i in range(5):
+            DBUtils.create_document(user_id="testuser", name=f"doc{i}", type="notes", tags=["tag"])
+        threads = []
+        with mock.patch("utils.DELETE_USER_BATCH_SIZE", 2), \
+                mock.patch("threading.Thread.start", lambda thread: threads.append(thread)):
+            result = DBUtils.delete_user("testuser", background=True)
+        self.assertTrue(result["background"])
+        threads[0].run()
+        db.session.expire_all()
+        self.assertIsNone(User.query.filter_by(id="testuser").first())
+        self.assertEqual(Document.query.filter_by(user_id="testuser").count(), 0)
+        self.assertGreater(Document.query.filter_by(user_id="otheruser").count(), 0)
+
+    def test_rename_user_id(self):
+        DBUtils.create_user("testuser", "testpassword")
+        DBUtils.create_document(user_id="testuser", name="doc", type="notes", tags=["tag"])
+        documents = Document.query.filter_by(user_id="testuser").count()
+        result, queries = self.count_queries(DBUtils.rename_user_id, "testuser", "newuser", "New User")
+        self.assertTrue(result["success"])
+        self.assertLess(queries, 10)
+        db.session.expire_all()
+        self.assertIsNone(User.query.filter_by(id="testuser").first())
+        self.assertEqual(User.query.filter_by(id="newuser").one().name, "New User")
+        self.assertEqual(Document.query.filter_by(user_id="newuser").count(), documents)
+        self.assertEqual([t.tag_name for t in UserTag.query.filter_by(user_id="newuser")], ["tag"])
+
+    def test_get_users_stats(self):
+        for user_id in ("user1", "user2", "user3"):
+            DBUtils.create_user(user_id, "testpassword")
+        settings = len(default_user_settings())
+        for i in range(3):
+            DBUtils.create_document(user_id="user1", name=f"chat{i}", type="chats")
+        DBUtils.create_document(user_id="user2", name="note", type="notes", content={"note": "text"})
+        db.session.expire_all()
+        stats, queries = self.count_queries(DBUtils.get_users_stats)
+        self.assertEqual(queries, 1)
+        self.assertEqual(stats, {"user1": {"settings": settings, "chats": 3},
+                                 "user2": {"settings": settings, "notes": 1},
+                                 "user3": {"settings": settings}})
+        stats = DBUtils.get_users_stats(sizes=True)
+        self.assertEqual(stats["user2"]["notes"],
+                         {"count": 1, "size": len(json.dumps({"note": "text"}))})
+        pages, after = [], None
+        while True:
+            page = DBUtils.get_users_stats(limit=2, after=after)
+            pages.append(list(page["users"]))
+            after = page["next_cursor"]
+            if after is None:
+                break
+        self.assertEqual(pages, [["user1", "user2"], ["user3"]])
+
+    def test_append_chat_messages(self):
+        DBUtils.create_user("testuser", "testpassword")
+        DBUtils.create_user("otheruser", "testpassword")
+        doc = DBUtils.create_document(user_id="testuser", name="testchat",
+                                      type="chat",
+                                      content={"chat": [{"role": "user",
+                                                         "content": "Hi"}]})
+        doc_id = doc["metadata"]["id"]
+        self.assertFalse(DBUtils.append_chat_messages(
+            doc_id, "otheruser", [{"role": "user", "content": "Hello"}]))
+        self.assertTrue(DBUtils.append_chat_messages(
+            doc_id, "testuser", [{"role": "user", "content": "Hello"},
+                                 {"role": "assistant", "content": "Hi there"}]))
+        document = Document.query.filter_by(id=doc_id).first()
+        self.assertListEqual(json.loads(document.content)["chat"], [
+            {"role": "user", "content": "Hi"},
+            {"role": "user", "content": "Hello"},
+            {"role": "assistant", "content": "Hi there"}])
+        self.assertEqual(document.size, len(document.content))
+
+    def test_append_chat_messages_retries_after_concurrent_save(self):
+        DBUtils.create_user("testuser", "testpassword")
+        doc = DBUtils.create_document(user_id="testuser", name="testchat", type="chat",
+                                      content={"chat": [{"role": "user", "content": "Hi"}]})
+        doc_id = doc["metadata"]["id"]
+        loads = json.loads
+        saved = []
+
+        def save_between_read_and_write(content):
+            if not saved:
+                # the web UI saves the chat after the append has read it
+                saved.append(True)
+                Document.query.filter_by(id=doc_id).update({
+                    "content": json.dumps({"chat": [{"role": "user", "content": "Hi"},
+                                                    {"role": "assistant", "content": "Hello"}]}),
+                    "updated_date": "2026-10-19 12:00:00"})
+                db.session.commit()
+            return loads(content)
+
+        with mock.patch("utils.json.loads", side_effect=save_between_read_and_write):
+            self.assertTrue(DBUtils.append_chat_messages(
+                doc_id, "testuser", [{"role": "user", "content": "Bye"}]))
+        document = Document.query.filter_by(id=doc_id).first()
+        self.assertListEqual(json.loads(document.content)["chat"], [
+            {"role": "user", "content": "Hi"},
+            {"role": "assistant", "content": "Hello"},
+            {"role": "user", "content": "Bye"}])
+
+    def test_list_documents_does_not_load_content(self):
+        DBUtils.create_user("testuser", "testpassword")
+        DBUtils.create_document(user_id="testuser", name="testchat", type="chat",
+                                tags=["tag1"], properties={"propertyA": "testA"},
+                                content={"chat": [{"role": "user", "content": "Hi"}]})
+        db.session.expire_all()
+        result, statements = self.record_queries(DBUtils.list_documents, "chat", "testuser")
+        documents = result["documents"]
+        self.assertEqual(len(documents), 1)
+        self.assertEqual(documents[0]["name"], "testchat")
+        self.assertEqual(documents[0]["tags"], ["tag1"])
+        self.assertEqual(documents[0]["properties"], {"propertyA": "testA"})
+        self.assertNotIn("content", documents[0])
+        self.assertFalse(any("documents.content" in statement for statement in statements))
+
+    def test_list_documents_query_count(self):
+        owners = ["owner1", "owner2", "owner3"]
+        for owner in owners:
+            DBUtils.create_user(owner, "testpassword", name=owner.title())
+        query_counts = []
+        documents_per_owner = 0
+        for new_documents_per_owner in (1, 10):
+            documents_per_owner += new_documents_per_owner
+            for owner in owners:
+                for i in range(new_documents_per_owner):
+                    DBUtils.create_document(user_id=owner, name=f"doc{i}", type="notes",
+                                            visibility="shared", tags=[f"tag{i}", "common"])
+            db.session.expire_all()
+            listing, mine = self.count_queries(DBUtils.list_documents, "notes", "owner1")
+            self.assertEqual(mine, 1)
+            listing, others = self.count_queries(DBUtils.list_others_shared_documents, "notes", "owner1")
+            self.assertEqual(listing["file_count"], 2 * documents_per_owner)
+            self.assertEqual({d["user_name"] for d in listing["documents"]}, {"Owner2", "Owner3"})
+            self.assertTrue(all("common" in d["tags"] for d in listing["documents"]))
+            listing, visible = self.count_queries(DBUtils.list_all_visible_documents, "notes", "owner1")
+            self.assertEqual(listing["file_count"], 3 * documents_per_owner)
+            self.assertEqual(len({d["id"] for d in listing["documents"]}), 3 * documents_per_owner)
+            self.assertEqual(visible, 1)
+            query_counts.append((mine, others, visible))
+        self.assertEqual(query_counts[0], query_counts[1])
+
+    def test_list_documents_page(self):
+        DBUtils.create_user("testuser", "testpassword")
+        DBUtils.create_user("otheruser", "testpassword")
+        for name in ["b", "d", "a", "e", "c"]:
+            DBUtils.create_document(user_id="testuser", name=name, type="notes")
+        DBUtils.create_document(user_id="otheruser", name="f", type="notes", visibility="shared")
+        DBUtils.create_document(user_id="otheruser", name="g", type="notes")
+        for scope, sort, order, expected in [("mine", "name", "asc", ["a", "b", "c", "d", "e"]),
+                                             ("mine", "updated_date", "desc", ["c", "e", "a", "d", "b"]),
+                                             ("all", "name", "desc", ["f", "e", "d", "c", "b", "a"])]:
+            names, after = [], None
+            while True:
+                page = DBUtils.list_documents_page(DBUtils.documents_in_scope("notes", scope, "testuser"),
+                                                   limit=2, after=after, sort=sort, order=order)
+                self.assertLessEqual(page["file_count"], 2)
+                names += [document["name"] for document in page["documents"]]
+                after = page["next_cursor"]
+                if after is None:
+                    break
+            self.assertListEqual(names, expected)
+        with self.assertRaises(ValueError):
+            DBUtils.list_documents_page(DBUtils.documents_in_scope("notes", "mine", "testuser"),
+                                        limit=2, after="not a cursor")
+
+    def test_update_document_tags(self):
+        DBUtils.create_user("testuser", "testpassword")
+        document = DBUtils.create_document(user_id="testuser", name="note", type="notes",
+                                           tags=["a", "b", "b"])
+        self.assertCountEqual(document["metadata"]["tags"], ["a", "b"])
+        query_counts = []
+        for tags in (["b", "c"], [f"tag{i}" for i in range(10)] + ["b"]):
+            document, queries = self.count_queries(DBUtils.update_document, document["metadata"]["id"], "note",
+                                                   tags, {}, {})
+            self.assertCountEqual(document["metadata"]["tags"], set(tags))
+            query_counts.append(queries)
+        self.assertEqual(query_counts[0], query_counts[1])
+        user_tags = [t.tag_name for t in UserTag.query.filter_by(user_id="testuser")]
+        self.assertEqual(len(user_tags), len(set(user_tags)))
+        self.assertLessEqual({"a", "b", "c"} | {f"tag{i}" for i in range(10)}, set(user_tags))
+        self.assertEqual(Tag.query.count(), len(set(user_tags)))
     #
     # def test_list_types(self):
     #     DBUtils.create_user("testuser", "testpassword")
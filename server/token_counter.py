@@ -0,0 +1,115 @@
+import hashlib
+import threading
+from functools import lru_cache
+from collections import OrderedDict
+
+import tiktoken
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """
+    Return the tiktoken encoding for the model, loading each encoding only once per process
+    """
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Model not found. Using cl100k_base encoding.
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def message_format(model):
+    """
+    Return the (tokens_per_message, tokens_per_name, encoding_model) used to count
+    tokens for the model.
+    from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    """
+    if model in {
+        "gpt-3.5-turbo-0613",
+        "gpt-3.5-turbo-16k-0613",
+        "gpt-4-0314",
+        "gpt-4-32k-0314",
+        "gpt-4-0613",
+        "gpt-4-32k-0613",
+        "gpt-4o"
+        }:
+        return 3, 1, model
+    elif model == "gpt-3.5-turbo-0301":
+        # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        # if there's a name, the role is omitted
+        return 4, -1, model
+    elif "gpt-3.5-turbo" in model:
+        # Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.
+        return message_format("gpt-3.5-turbo-0613")
+    elif "gpt-4" in model:
+        # Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.
+        return message_format("gpt-4-0613")
+    raise NotImplementedError(
+        f"""openai_num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
+    )
+
+
+class TokenCounter:
+    """
+    Counts the tokens in chat messages, remembering the count for each message
+    so that on each turn of a chat only the new messages are encoded.
+
+    In approximate mode no encoding is done, and each message is assumed to have
+    one token per chars_per_token characters, which is close enough for usage
+    statistics and much cheaper for long chats.
+    """
+    def __init__(self, approximate=False, chars_per_token=4, max_entries=100000):
+        self.approximate = approximate
+        self.chars_per_token = chars_per_token
+        self.max_entries = max_entries
+        self.message_tokens = OrderedDict()
+        self.lock = threading.Lock()
+
+    def count_text(self, text, model):
+        if self.approximate:
+            return -(-len(text) // self.chars_per_token)
+        return len(get_encoding(model).encode(text))
+
+    def count_message(self, message, model, tokens_per_name=1):
+        """
+        Return the number of tokens in the values of a message, excluding the per-message overhead
+        """
+        key = hashlib.sha1(f"{self.approximate}\0{model}\0{tokens_per_name}\0".encode("utf-8") +
+                           "\0".join(f"{k}\0{v}" for k, v in message.items()).encode("utf-8")).digest()
+        with self.lock:
+            num_tokens = self.message_tokens.get(key)
+            if num_tokens is not None:
+                self.message_tokens.move_to_end(key)
+                return num_tokens
+        num_tokens = 0
+        for key_name, value in message.items():
+            num_tokens += self.count_text(value, model)
+            if key_name == "name":
+                num_tokens += tokens_per_name
+        with self.lock:
+            self.message_tokens[key] = num_tokens
+            while len(self.message_tokens) > self.max_entries:
+                self.message_tokens.popitem(last=False)
+        return num_tokens
+
+    def count_each_message(self, messages, model="gpt-3.5-turbo-0613"):
+        """
+        Return the number of tokens used by each message in a list of messages,
+        including the per-message overhead
+        """
+        try:
+            tokens_per_message, tokens_per_name, encoding_model = message_format(model)
+        except NotImplementedError:
+            if not self.approximate:
+                raise
+            tokens_per_message, tokens_per_name, encoding_model = 3, 1, model
+        return [tokens_per_message + self.count_message(message, encoding_model, tokens_per_name)
+                for message in messages]
+
+    def count_messages(self, messages, model="gpt-3.5-turbo-0613"):
+        """
+        Return the number of tokens used by a list of messages
+        """
+        num_tokens = sum(self.count_each_message(messages, model))
+        num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+        return num_tokens
@@ -7,18 +7,38 @@ import bcrypt
 import traceback
 import time
 import ssl
+import threading
+import base64
 from datetime import datetime
+from functools import lru_cache
+from sqlalchemy import and_, exists, func, insert, or_, tuple_
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.exc import NoResultFound, OperationalError
-import tiktoken
+from sqlalchemy.orm import aliased, defer, joinedload
+from sqlalchemy.orm.exc import StaleDataError
 import requests
-from flask import url_for
+from flask import current_app, url_for
 from requests_oauthlib import OAuth2Session
 from flask_jwt_extended import get_jwt_identity
 from jwt import PyJWKClient
 
 from app import app, db, VERSION
 from models import User, Document, Tag, DocumentTag, UserTag
-
+from token_counter import TokenCounter
+from context_window import approximate_token_counter
+
+# the user who owns the default documents, e.g. personas, that all users share
+DEFAULT_DOCUMENTS_USER_ID = "sidekick"
+# the documents deleted in each transaction when a user is deleted in the background
+DELETE_USER_BATCH_SIZE = 1000
+# the attempts to append to a chat document while other requests are updating it
+APPEND_CHAT_ATTEMPTS = 5
+# the note at the end of a chat response stopped by the user, as the web UI adds it
+CHAT_STOPPED_NOTE = "(Chat stopped by user)"
+# the text that ends a chat stream cut short by an error, which the web UI shows as the
+# note at the end of the response
+CHAT_STREAM_ERROR = "\n\n(Response truncated due to error in chat stream)"
 
 server_stats = {
     "serverStartTime": datetime.now()
@@ -132,7 +152,7 @@ class RequestLogger:
         app.logger.error(self._construct_log_message("ERROR", message, **kwargs))
 
     def exception(self, e, message="", **kwargs):
-        app.logger.exception(self._construct_log_message("EXCEPTION", message, **kwargs), e)
+        app.logger.exception(self._construct_log_message("EXCEPTION", message, exception_message=str(e), **kwargs))
 
     def warning(self, message, **kwargs):
         app.logger.warning(self._construct_log_message("WARNING", message, **kwargs))
@@ -150,56 +170,76 @@ def num_characters_from_messages(messages):
     return num_characters    
     
 
+token_counter = TokenCounter(approximate=app.config["SIDEKICK_COUNT_TOKENS_MODE"] == "approximate")
+
+
 def openai_num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
     """Return the number of tokens used by a list of messages.
-    from: https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+    Encodings are loaded once per model and each message is only encoded
+    the first time it is counted, see TokenCounter.
     """
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        # Model not found. Using cl100k_base encoding.
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        "gpt-4o"
-        }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        # Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.
-        return openai_num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        # Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.
-        return openai_num_tokens_from_messages(messages, model="gpt-4-0613")
+    return token_counter.count_messages(messages, model)
+
+
+def stream_usage_requested(provider):
+    """
+    Return True if a chat stream should ask the provider to report the tokens used in a
+    final event: only when tokens are counted, and only from the OpenAI provider, as other
+    OpenAI compatible servers may reject the stream_options field with a 400.
+    """
+    return bool(app.config["SIDEKICK_COUNT_TOKENS"]) and app.config["SIDEKICK_STREAM_USAGE"] \
+        and provider in (None, "OpenAI")
+
+
+def record_stream_usage(ai_request, relay):
+    """
+    Record the tokens used by a streamed chat completion once the stream has ended.
+
+    The usage the provider reported at the end of the stream is used if there is
+    one, see stream_usage_requested. Otherwise, including when the stream was closed
+    early, the prompt tokens are counted locally and the completion is assumed to be
+    one token per event.
+
+    Returns the (prompt_tokens, completion_tokens) recorded.
+    """
+    if relay.usage:
+        prompt_tokens = relay.usage.get("prompt_tokens") or 0
+        completion_tokens = relay.usage.get("completion_tokens") or 0
     else:
-        raise NotImplementedError(
-            f"""openai_num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
-
-
-def construct_ai_request(request):
-    model_settings = request.json["model_settings"]
-    system_prompt = request.json["system_prompt"]
-    prompt = request.json["prompt"]
-    chatHistory = request.json["chatHistory"] if (
-                'chatHistory' in request.json) else []
+        try:
+            prompt_tokens = openai_num_tokens_from_messages(ai_request["messages"], ai_request["model"])
+        except Exception:
+            # Models from other providers are not known to tiktoken
+            prompt_tokens = approximate_token_counter.count_messages(ai_request["messages"], ai_request["model"])
+        completion_tokens = relay.events
+    increment_server_stat(category="usage", stat_name="promptTokens", increment=prompt_tokens)
+    increment_server_stat(category="usage", stat_name="completionTokens", increment=completion_tokens)
+    increment_server_stat(category="usage", stat_name="totalTokens", increment=prompt_tokens + completion_tokens)
+    return prompt_tokens, completion_tokens
+
+
+def chat_turn_messages(prompt, completion, closed_early=None, failed=False):
+    """
+    Return the messages a /chat/v2 stream adds to its chat document, as the web UI shows them:
+    the user's prompt and, if any text was streamed, the assistant's reply, with a note
+    at the end if the stream was stopped by the user or cut short by an error
+    """
+    messages = [{"role": "user", "content": prompt}]
+    if closed_early:
+        completion += "\n\n" + CHAT_STOPPED_NOTE
+    elif failed:
+        completion += CHAT_STREAM_ERROR
+    if completion:
+        messages.append({"role": "assistant", "content": completion})
+    return messages
+
+
+def construct_ai_request(request_json):
+    model_settings = request_json["model_settings"]
+    system_prompt = request_json["system_prompt"]
+    prompt = request_json["prompt"]
+    chatHistory = request_json["chatHistory"] if (
+                'chatHistory' in request_json) else []
     ai_request = model_settings["request"]
     ai_request["messages"] = [{"role": "system", "content": system_prompt}] + \
                              chatHistory + [
@@ -289,6 +329,34 @@ def update_default_settings(user_id):
                                             content=filesystem_settings)
 
 
+
+def update_default_documents(user_id=DEFAULT_DOCUMENTS_USER_ID):
+    """
+    Add the default documents that all users share, owned by the sidekick user,
+    and update them if they have changed in this app release (i.e. on the filesystem)
+    """
+    defaults = {(document.type, document.name): document for document in
+                Document.query.filter_by(user_id=user_id, visibility="default")}
+    for filename in os.listdir("default_documents"):
+        if filename.endswith(".json"):
+            with open(os.path.join("default_documents", filename), "r") as f:
+                document_types = json.load(f)
+            for type, documents in document_types.items():
+                for name, document in documents.items():
+                    tags = list(set(document.get("tags", [])))
+                    properties = document.get("properties", {})
+                    content = document.get("content", {})
+                    default = defaults.get((type, name))
+                    if default is None:
+                        DBUtils.create_document(user_id=user_id, name=name, type=type,
+                                                visibility="default", tags=tags,
+                                                properties=properties, content=content)
+                    elif (json.loads(default.content), json.loads(default.properties),
+                          sorted(tag.tag_name for tag in default.tags)) != (content, properties, sorted(tags)):
+                        DBUtils.update_document(id=default.id, name=name, tags=tags,
+                                                properties=properties, content=content,
+                                                visibility="default")
+
 def get_well_known_metadata():
     """
     Get the well known metadata from the OIDC well-known URL
@@ -329,6 +397,74 @@ def get_jwks_client():
     return jwks_client
 
 
+# The columns a document listing can be sorted by
+DOCUMENT_SORT_COLUMNS = {"updated_date": Document.updated_date, "name": Document.name}
+
+
+def encode_document_cursor(document, sort):
+    """
+    Return the cursor for the page of a document listing that follows the document
+    """
+    position = json.dumps([getattr(document, sort), document.id])
+    return base64.urlsafe_b64encode(position.encode("utf-8")).decode("ascii")
+
+
+def decode_document_cursor(cursor):
+    """
+    Return the sort value and id of the last document of the previous page, or raise ValueError
+    """
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, UnicodeEncodeError) as e:
+        raise ValueError(f"Invalid cursor: {cursor}") from e
+    if not isinstance(position, list) or len(position) != 2 or \
+            not all(isinstance(value, str) for value in position):
+        raise ValueError(f"Invalid cursor: {cursor}")
+    return position
+
+
+def as_users_documents(documents, user_id):
+    """
+    Return the metadata of the documents as user_id sees them. A shared default document
+    is shown as the user's own private document, which it becomes when they change
+    it, see DBUtils.copy_on_write. The user's name is only looked up if there is one.
+    """
+    user_name = None
+    users_documents = []
+    for metadata in documents:
+        if metadata["visibility"] == "default" and user_id and metadata["user_id"] != user_id:
+            if user_name is None:
+                user_name = db.session.query(User.name).filter_by(id=user_id).scalar()
+            metadata = dict(metadata, user_id=user_id, user_name=user_name, visibility="private")
+        users_documents.append(metadata)
+    return users_documents
+
+
+def document_visibilities(user_id):
+    """
+    The visibilities the user can give their documents. Only the user who owns the
+    shared default documents can add them.
+    """
+    if user_id == DEFAULT_DOCUMENTS_USER_ID:
+        return ("private", "shared", "default")
+    return ("private", "shared")
+
+
+@lru_cache(maxsize=1)
+def default_user_settings():
+    """
+    The default settings every new user gets, read from the default_settings
+    directory once per process
+    """
+    seeds = []
+    for filename in os.listdir("default_settings"):
+        if filename.endswith(".json"):
+            with open(os.path.join("default_settings", filename), "r") as f:
+                seeds.append({"name": os.path.splitext(filename)[0],
+                              "content": json.dumps(json.load(f))})
+    return tuple(seeds)
+
+
 class DBUtils:
 
     @staticmethod
@@ -338,53 +474,62 @@ class DBUtils:
         user = User(id=user_id, password_hash=password_hash,
                     name=name, is_oidc=is_oidc, properties=properties)
         db.session.add(user)
+        db.session.flush()
+        DBUtils.add_default_settings(user_id)
         db.session.commit()
-
-        # Setup default user settings
-        for filename in os.listdir("default_settings"):
-            if filename.endswith(".json"):
-                name = os.path.splitext(filename)[0]
-                with open(os.path.join("default_settings", filename),
-                          "r") as f:
-                    settings = json.load(f)
-                    DBUtils.create_document(user_id=user_id,
-                                            name=name,
-                                            tags=[],
-                                            properties={},
-                                            content=settings,
-                                            type="settings")
-        # Setup default user documents
-        for filename in os.listdir("default_documents"):
-            if filename.endswith(".json"):
-                with open(os.path.join("default_documents", filename),
-                          "r") as f:
-                    document_types = json.load(f)
-                    for type, documents in document_types.items():
-                        for name, document in documents.items():
-                            DBUtils.create_document(
-                                user_id=user_id,
-                                name=name,
-                                tags=list(set(document["tags"]
-                                if "tags" in document else "[]")),
-                                properties=document["properties"]
-                                if "properties" in document else "{}",
-                                content=document["content"]
-                                if "content" in document else "{}",
-                                type=type)
         return user.as_dict()
     
+    @staticmethod
+    def add_default_settings(user_id):
+        """
+        Give a new user their copy of the default settings in one INSERT, leaving
+        the commit to the caller. The default documents are shared rather than
+        copied, see update_default_documents.
+        """
+        now = str(datetime.now())
+        db.session.execute(insert(Document), [
+            {"id": str(uuid.uuid4()), "user_id": user_id, "name": seed["name"],
+             "type": "settings", "visibility": "private", "properties": json.dumps({}),
+             "content": seed["content"], "size": len(seed["content"]),
+             "created_date": now, "updated_date": now}
+            for seed in default_user_settings()])
+
     @staticmethod
     def list_users():
         users = [user.as_dict() for user in User.query.all()]
         return users
     
     @staticmethod
-    def get_users_stats():
-        users = User.query.all()
+    def get_users_stats(sizes=False, limit=None, after=None):
+        """
+        Return the number of documents of each type that each user has, and with sizes,
+        their total size too, from one GROUP BY query. With a limit, return the stats of
+        a page of that many users in user id order, after the user id after, and the
+        cursor to pass as after for the next page, which is null on the last page.
+        """
+        user_ids = db.session.query(User.id)
+        if after:
+            user_ids = user_ids.filter(User.id > after)
+        if limit:
+            user_ids = user_ids.order_by(User.id).limit(limit + 1)
+        query = db.session.query(User.id, Document.type, func.count(Document.id),
+                                 func.coalesce(func.sum(Document.size), 0)) \
+            .outerjoin(Document, and_(Document.user_id == User.id, Document.visibility != 'deleted')) \
+            .filter(User.id.in_(user_ids.scalar_subquery())) \
+            .group_by(User.id, Document.type) \
+            .order_by(User.id)
         user_stats = {}
-        for user in users:
-            user_stats[user.id] = user.get_document_stats()
-        return user_stats
+        for user_id, document_type, count, size in query:
+            stats = user_stats.setdefault(user_id, {})
+            if document_type is not None:
+                stats[document_type] = {"count": count, "size": size} if sizes else count
+        if not limit:
+            return user_stats
+        next_cursor = None
+        if len(user_stats) > limit:
+            del user_stats[list(user_stats)[-1]]
+            next_cursor = list(user_stats)[-1]
+        return {"users": user_stats, "next_cursor": next_cursor}
     
     @staticmethod
     def update_user(user_id, name=None, properties=None):
@@ -476,35 +621,80 @@ class DBUtils:
                         name=user_name, is_oidc=user.is_oidc,
                         properties=json.loads(user.properties))
         db.session.add(new_user)
-        # Update user_id in all documents
-        documents = Document.query.filter_by(user_id=user_id).all()
-        for document in documents:
-            document.user_id = new_user_id
-        # Update user_id in all user tags
-        user_tags = UserTag.query.filter_by(user_id=user_id).all()
-        for user_tag in user_tags:
-            user_tag.user_id = new_user_id
+        db.session.flush()
+        # Move the documents and user tags to the new user_id with one UPDATE each
+        Document.query.filter_by(user_id=user_id).update(
+            {Document.user_id: new_user_id}, synchronize_session=False)
+        UserTag.query.filter_by(user_id=user_id).update(
+            {UserTag.user_id: new_user_id}, synchronize_session=False)
         # Delete the old user
         db.session.delete(user)
         db.session.commit()
         return {'success': True, 'message': 'User ID renamed'}
 
     @staticmethod
-    def delete_user(user_id):
-        try:
-            user = User.query.filter_by(id=user_id).one()
-            for document in user.documents:
-                DocumentTag.query.filter_by(document_id=document.id).delete()
-                DBUtils.delete_document(document.id)
-            UserTag.query.filter_by(user_id=user_id).delete()
-            db.session.delete(user)
-            db.session.commit()
-            app.logger.info(f"Deleted user: {user_id}")
-            return {'success': True, 'message': f'Deleted user: {user_id}'}
-        except NoResultFound:
+    def delete_user(user_id, background=False):
+        """
+        Delete the user, their documents and their tags. The whole account is deleted in
+        one transaction, or with background=True or more than
+        SIDEKICK_DELETE_USER_BACKGROUND_DOCUMENTS documents, in a background thread that
+        deletes the documents in batches of DELETE_USER_BATCH_SIZE, each in its own
+        transaction, and the user last, so that deleting the user again carries on where it stopped.
+        """
+        if User.query.filter_by(id=user_id).count() == 0:
             app.logger.error(f"Tried to delete a user with user ID: "
                              f"{user_id}, but that document doesn't exist.")
             return {'success': False, 'message': f'Error deleting user: {user_id}'}
+        threshold = app.config["SIDEKICK_DELETE_USER_BACKGROUND_DOCUMENTS"]
+        if not background and threshold and Document.query.filter_by(user_id=user_id).count() > threshold:
+            background = True
+        if not background:
+            DBUtils.delete_user_documents(user_id)
+            DBUtils.delete_user_account(user_id)
+            db.session.commit()
+            app.logger.info(f"Deleted user: {user_id}")
+            return {'success': True, 'message': f'Deleted user: {user_id}'}
+
+        current = current_app._get_current_object()
+
+        def run():
+            with current.app_context():
+                try:
+                    while DBUtils.delete_user_documents(user_id, limit=DELETE_USER_BATCH_SIZE):
+                        db.session.commit()
+                    DBUtils.delete_user_account(user_id)
+                    db.session.commit()
+                    app.logger.info(f"Deleted user: {user_id}")
+                except Exception as e:
+                    app.logger.exception(f"Error deleting user: {user_id}: {e}")
+
+        threading.Thread(target=run, name=f"delete-user-{user_id}", daemon=True).start()
+        app.logger.info(f"Deleting user in the background: {user_id}")
+        return {'success': True, 'message': f'Deleting user: {user_id}', 'background': True}
+
+    @staticmethod
+    def delete_user_documents(user_id, limit=None):
+        """
+        Delete the user's documents and their tags, or just limit of them, without
+        committing. Returns the number of documents deleted.
+        """
+        document_ids = db.session.query(Document.id).filter_by(user_id=user_id)
+        if limit:
+            document_ids = [document_id for document_id, in document_ids.limit(limit)]
+        else:
+            document_ids = document_ids.scalar_subquery()
+        DocumentTag.query.filter(DocumentTag.document_id.in_(document_ids)).delete(
+            synchronize_session=False)
+        return Document.query.filter(Document.id.in_(document_ids)).delete(
+            synchronize_session=False)
+
+    @staticmethod
+    def delete_user_account(user_id):
+        """
+        Delete the user and their tags, without committing, once their documents have been deleted
+        """
+        UserTag.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+        User.query.filter_by(id=user_id).delete(synchronize_session=False)
 
     @staticmethod
     def get_user(user_id):
@@ -527,30 +717,39 @@ class DBUtils:
 
 
     @staticmethod
-    def add_tags(tags, document_id=None, user_id=None):
-        for tag_name in tags:
-            try:
-                Tag.query.filter_by(name=tag_name).one()
-            except NoResultFound:
-                db.session.add(Tag(name=tag_name))
-
-            if document_id:
-                try:
-                    DocumentTag.query.filter_by(document_id=document_id,
-                                                tag_name=tag_name).one()
-                except NoResultFound:
-                    db.session.add(DocumentTag(document_id=document_id,
-                                               tag_name=tag_name))
-
-            if user_id:
-                try:
-                    UserTag.query.filter_by(user_id=user_id,
-                                            tag_name=tag_name).one()
-                except NoResultFound:
-                    db.session.add(UserTag(user_id=user_id,
-                                           tag_name=tag_name))
+    def insert_or_ignore(model, rows):
+        """
+        Insert the rows into the model's table in one statement, skipping the rows
+        whose primary key is already there
+        """
+        if not rows:
+            return
+        dialect_name = db.session.get_bind().dialect.name
+        if dialect_name == "postgresql":
+            statement = postgresql_insert(model).on_conflict_do_nothing()
+        elif dialect_name == "sqlite":
+            statement = sqlite_insert(model).on_conflict_do_nothing()
+        else:
+            statement = insert(model).prefix_with("IGNORE")
+        db.session.execute(statement, rows)
 
-            db.session.commit()
+    @staticmethod
+    def add_tags(tags, document_id=None, user_id=None):
+        """
+        Add the tags, and tag the document and the user with them, with one
+        INSERT per table and a single commit however many tags there are
+        """
+        tag_names = list(dict.fromkeys(tags))
+        if not tag_names:
+            return
+        DBUtils.insert_or_ignore(Tag, [{"name": tag_name} for tag_name in tag_names])
+        if document_id:
+            DBUtils.insert_or_ignore(DocumentTag, [{"document_id": document_id, "tag_name": tag_name}
+                                                   for tag_name in tag_names])
+        if user_id:
+            DBUtils.insert_or_ignore(UserTag, [{"user_id": user_id, "tag_name": tag_name}
+                                               for tag_name in tag_names])
+        db.session.commit()
 
     @staticmethod
     def create_document(user_id, name, type="", visibility="private", tags=[],
@@ -567,7 +766,7 @@ class DBUtils:
                             type=type, properties=properties,
                             updated_date=str(datetime.now()),
                             created_date=str(datetime.now()),
-                            content=content)
+                            content=content, size=len(json.dumps(content)))
 
         db.session.add(document)
         db.session.commit()
@@ -587,7 +786,8 @@ class DBUtils:
         document.updated_date = str(datetime.now())
         db.session.add(document)
 
-        DocumentTag.query.filter_by(document_id=id).delete()
+        DocumentTag.query.filter(DocumentTag.document_id == id,
+                                 DocumentTag.tag_name.not_in(tags)).delete(synchronize_session=False)
         DBUtils.add_tags(tags, document.id, document.user_id)
 
         db.session.commit()
@@ -604,7 +804,7 @@ class DBUtils:
 
     @staticmethod
     def update_document_type(document_id, document_type):
-        document = Document.query.filter_by(id=id).first()
+        document = Document.query.filter_by(id=document_id).first()
         document.type = document_type
         document.updated_date = str(datetime.now())
         db.session.add(document)
@@ -623,70 +823,163 @@ class DBUtils:
         return document.as_dict()
 
     @staticmethod
-    def list_documents(document_type, user_id=""):
-        documents = [doc.as_dict()["metadata"] for doc in
-                     Document.query.filter_by(type=document_type,
-                                              user_id=user_id
-                                              if user_id else None).all()]
+    def get_document_for_user(document_id, user_id):
+        """
+        Return the document as user_id sees it: for a shared default document, the
+        user's copy of it if they have changed it, or the default document as their own.
+        Raises NoResultFound if the document does not exist or the user has deleted it.
+        """
+        document = Document.query.filter_by(id=document_id).one()
+        if document.visibility == "default" and document.user_id != user_id:
+            document = Document.query.filter_by(user_id=user_id, default_id=document_id).first() or document
+        if document.visibility == "deleted":
+            raise NoResultFound(f"Document {document_id} has been deleted")
+        document_as_dict = document.as_dict()
+        document_as_dict["metadata"] = as_users_documents([document_as_dict["metadata"]], user_id)[0]
+        return document_as_dict
+
+    @staticmethod
+    def copy_on_write(document_id, user_id):
+        """
+        Return the id of the document that user_id changes when they change the document.
+        This is the document itself, unless it is a shared default document, when it is
+        the user's copy of it, which is made the first time they change it.
+        """
+        document = Document.query.filter_by(id=document_id).one()
+        if document.visibility != "default" or document.user_id == user_id:
+            return document.id
+        copy = Document.query.filter_by(user_id=user_id, default_id=document_id).first()
+        if copy is not None:
+            return copy.id
+        copy = Document(id=str(uuid.uuid4()), user_id=user_id, default_id=document.id,
+                        name=document.name, type=document.type, visibility="private",
+                        updated_date=str(datetime.now()), created_date=str(datetime.now()),
+                        size=document.size)
+        copy.properties = document.properties
+        copy.content = document.content
+        db.session.add(copy)
+        db.session.flush()
+        DBUtils.add_tags([tag.tag_name for tag in document.tags], copy.id, user_id)
+        db.session.commit()
+        return copy.id
+
+    @staticmethod
+    def with_metadata_only(query):
+        """
+        Load just the metadata of the documents selected by the query, in one SELECT
+        that joins the owner's name and the tags rather than one SELECT of each per document.
+        The content of the documents, which can be large, is not loaded from the database.
+        """
+        return query.options(defer(Document.content),
+                             joinedload(Document.user).load_only(User.name),
+                             joinedload(Document.tags).load_only(DocumentTag.tag_name))
+
+    @staticmethod
+    def list_documents_metadata(query, user_id=None):
+        """
+        Return the listing of the documents selected by the query, with just their metadata.
+        The shared default documents are listed as user_id's own.
+        """
+        documents = as_users_documents([doc.metadata_as_dict() for doc in
+                                        DBUtils.with_metadata_only(query).all()], user_id)
         return {"file_count": len(documents), "error_count": 0, "status": "OK",
                 "message": "All files read successfully",
                 "documents": documents}
 
     @staticmethod
-    def list_my_shared_documents(document_type, user_id):
-        documents = [doc.as_dict()["metadata"] for doc in
-            Document.query.filter_by(type=document_type,
-                                     user_id=user_id,
-                                     visibility='shared').all()]
+    def documents_in_scope(document_type, scope, user_id):
+        """
+        Return the query for the documents of a type in a scope of the /docdb listing:
+        the user's own (mine, the default), my-shared, my-private, all-shared,
+        others-shared, or all the documents visible to the user
+        """
+        query = Document.query.filter_by(type=document_type)
+        if scope == "my-shared":
+            return query.filter_by(user_id=user_id, visibility='shared')
+        if scope == "my-private":
+            return query.filter(or_(and_(Document.user_id == user_id, Document.visibility == 'private'),
+                                    DBUtils.default_documents_not_copied(user_id)))
+        if scope == "all-shared":
+            return query.filter_by(visibility='shared')
+        if scope == "others-shared":
+            return query.filter_by(visibility='shared').filter(Document.user_id != user_id)
+        own = and_(Document.user_id == user_id, Document.visibility != 'deleted')
+        if scope == "all":
+            return query.filter(or_(own, Document.visibility == 'shared',
+                                    DBUtils.default_documents_not_copied(user_id)))
+        if not user_id:
+            return query.filter_by(user_id=None)
+        return query.filter(or_(own, DBUtils.default_documents_not_copied(user_id)))
+
+    @staticmethod
+    def default_documents_not_copied(user_id):
+        """
+        Return the filter for the shared default documents that the user has not
+        changed or deleted, i.e. that the user has no copy of
+        """
+        copy = aliased(Document)
+        return and_(Document.visibility == 'default',
+                    ~exists().where(copy.user_id == user_id, copy.default_id == Document.id))
+
+    @staticmethod
+    def list_documents_page(query, limit, after=None, sort="updated_date", order="desc", user_id=None):
+        """
+        Return a page of the listing of the documents selected by the query, sorted by
+        sort then id. after is the cursor returned as next_cursor with the previous page,
+        which is null on the last page. Each page is read from where the previous one ended
+        rather than by skipping the documents before it, so every page costs the same.
+        The shared default documents are listed as user_id's own.
+        """
+        column = DOCUMENT_SORT_COLUMNS[sort]
+        position = tuple_(column, Document.id)
+        if after:
+            last_sort_value, last_id = decode_document_cursor(after)
+            query = query.filter(position < tuple_(last_sort_value, last_id) if order == "desc"
+                                 else position > tuple_(last_sort_value, last_id))
+        if order == "desc":
+            query = query.order_by(column.desc(), Document.id.desc())
+        else:
+            query = query.order_by(column.asc(), Document.id.asc())
+        page = DBUtils.with_metadata_only(query.limit(limit + 1)).all()
+        next_cursor = encode_document_cursor(page[limit - 1], sort) if len(page) > limit else None
+        documents = as_users_documents([doc.metadata_as_dict() for doc in page[:limit]], user_id)
         return {"file_count": len(documents), "error_count": 0, "status": "OK",
                 "message": "All files read successfully",
-                "documents": documents}
+                "documents": documents, "next_cursor": next_cursor}
+
+    @staticmethod
+    def list_documents(document_type, user_id=""):
+        return DBUtils.list_documents_metadata(
+            DBUtils.documents_in_scope(document_type, "mine", user_id), user_id)
+
+    @staticmethod
+    def list_my_shared_documents(document_type, user_id):
+        return DBUtils.list_documents_metadata(
+            DBUtils.documents_in_scope(document_type, "my-shared", user_id))
 
     @staticmethod
     def list_my_private_documents(document_type, user_id):
-        documents = [doc.as_dict()["metadata"] for doc in
-            Document.query.filter_by(type=document_type,
-                                     user_id=user_id,
-                                     visibility='private').all()]
-        return {"file_count": len(documents), "error_count": 0, "status": "OK",
-                "message": "All files read successfully",
-                "documents": documents}
+        return DBUtils.list_documents_metadata(
+            DBUtils.documents_in_scope(document_type, "my-private", user_id), user_id)
 
     @staticmethod
     def list_all_shared_documents(document_type):
-        documents = [doc.as_dict()["metadata"] for doc in
-            Document.query.filter_by(type=document_type,
-                                     visibility='shared').all()]
-        return {"file_count": len(documents), "error_count": 0, "status": "OK",
-                "message": "All files read successfully",
-                "documents": documents}
+        return DBUtils.list_documents_metadata(
+            DBUtils.documents_in_scope(document_type, "all-shared", None))
 
     @staticmethod
     def list_others_shared_documents(document_type, user_id):
-        documents = [doc.as_dict()["metadata"] for doc in
-            Document.query.filter_by(type=document_type,
-                                     visibility='shared').filter(Document.user_id != user_id).all()]
-        return {"file_count": len(documents), "error_count": 0, "status": "OK",
-                "message": "All files read successfully",
-                "documents": documents}
+        return DBUtils.list_documents_metadata(
+            DBUtils.documents_in_scope(document_type, "others-shared", user_id))
 
     @staticmethod
     def list_all_visible_documents(document_type, user_id):
-        my_documents = Document.query.filter_by(type=document_type, user_id=user_id).all()
-        shared_documents = Document.query.filter_by(type=document_type, visibility='shared').all()
-        documents = [doc.as_dict()["metadata"] for doc in
-            list(set(my_documents + shared_documents))]
-        return {"file_count": len(documents), "error_count": 0, "status": "OK",
-                "message": "All files read successfully",
-                "documents": documents}
-    
+        return DBUtils.list_documents_metadata(DBUtils.documents_in_scope(document_type, "all", user_id),
+                                               user_id)
+
     @staticmethod
     def list_feedback():
-        documents = [doc.as_dict()["metadata"] for doc in
-                     Document.query.filter_by(type="feedback").all()]
-        return {"file_count": len(documents), "error_count": 0, "status": "OK",
-                "message": "All files read successfully",
-                "documents": documents}
+        return DBUtils.list_documents_metadata(Document.query.filter_by(type="feedback"))
 
     @staticmethod
     def delete_document(document_id):
@@ -695,7 +988,16 @@ class DBUtils:
             document_as_dict = document.as_dict()
             for tag in document.tags:
                 db.session.delete(tag)
-            db.session.delete(document)
+            if document.default_id:
+                # keep the user's copy of a shared default document, emptied,
+                # so that the default document stays deleted for them
+                document.visibility = "deleted"
+                document.properties = json.dumps({})
+                document.content = json.dumps({})
+                document.size = 0
+                document.updated_date = str(datetime.now())
+            else:
+                db.session.delete(document)
             db.session.commit()
             return document_as_dict
         except NoResultFound:
@@ -723,6 +1025,33 @@ class DBUtils:
 
         return document.as_dict()
 
+    @staticmethod
+    def append_chat_messages(document_id, user_id, messages):
+        """
+        Append messages to the chat in a chat document owned by the user,
+        in a single write. Returns False if the user has no such document.
+
+        The write only succeeds if the document has not been updated since it was
+        read, e.g. by the web UI saving the chat, and is retried with the new content
+        if it has, so neither update is lost.
+        """
+        for _ in range(APPEND_CHAT_ATTEMPTS):
+            document = db.session.query(Document.content, Document.updated_date) \
+                .filter_by(id=document_id, user_id=user_id).first()
+            if document is None:
+                return False
+            content = json.loads(document.content)
+            content["chat"] = content.get("chat", []) + messages
+            content = json.dumps(content)
+            updated = Document.query \
+                .filter_by(id=document_id, user_id=user_id, updated_date=document.updated_date) \
+                .update({"content": content, "size": len(content), "updated_date": str(datetime.now())},
+                        synchronize_session=False)
+            db.session.commit()
+            if updated:
+                return True
+        raise StaleDataError(f"Chat document {document_id} kept changing while appending messages")
+
     @staticmethod
     def health():
         database_health = {}
@@ -1,5 +1,6 @@
 import axios from 'axios'
 import { debounce } from "lodash";
+import { v4 as uuidv4 } from 'uuid';
 import React from 'react';
 
 import { useEffect, useState, useContext, useCallback, useRef, memo } from 'react';
@@ -70,6 +71,11 @@ import NativeTextEditorEventHandlers from './NativeTextEditorEventHandlers';
 import Toolbox from './Toolbox';
 import ContentElement from './ContentElement';
 
+// the notes added to the end of a response that was stopped or cut short,
+// the same as the server adds when it saves the response in the chat document
+const CHAT_STOPPED_NOTE = "(Chat stopped by user)";
+const CHAT_ERROR_NOTE = "(Response truncated due to error in chat stream)";
+
 const Chat = ({
     provider, modelSettings, persona,
     closeOtherPanels, restoreOtherPanels, windowMaximized, setWindowMaximized,
@@ -147,6 +153,8 @@ const Chat = ({
     const [newStreamDelta, setNewStreamDelta] = useState(null);
     const streamingChatResponseRef = useRef("");
     const stopStreamingRef = useRef(false);
+    // the stream id and reader of the chat stream being read, so Stop can cancel it
+    const chatStreamRef = useRef(null);
     const [systemPrompt, setSystemPrompt] = useState("");
     const [promptPlaceholder, setPromptPlaceholder] = useState(userPromptReady.current);
     const [menuToolboxesAnchorEl, setMenuToolboxesAnchorEl] = useState(null);
@@ -168,6 +176,9 @@ const Chat = ({
     const chatLoading = useRef(false);
     const chatCreating = useRef(false);
     const chatSaving = useRef(false);
+    // the messages after appending a message that the server saves in the chat, see sendPrompt
+    const messagesSavedByServer = useRef(null);
+    const [saveRequested, setSaveRequested] = useState(null);
     const [folder, setFolder] = useState("chats");
     const [tags, setTags] = useState([]);
     const [bookmarked, setBookmarked] = useState(false);
@@ -2610,6 +2621,12 @@ const Chat = ({
         debugMode && console.log("setOpenChatId", id);
     }, [id]);
 
+    useEffect(()=>{
+        if (saveRequested) {
+            save();
+        }
+    }, [saveRequested]);
+
     useEffect(()=>{
         if (!chatLoading.current && // don't save if this hook was called as a result of loading a chat
                 (
@@ -2619,7 +2636,13 @@ const Chat = ({
                 )
             ) {
             if (id !== "" && id !== null) {
-                save();
+                if (messages === messagesSavedByServer.current) {
+                    // the server is saving this message in the chat, saving the whole
+                    // chat as well would race with it and one of the saves would be lost
+                    messagesSavedByServer.current = null;
+                } else {
+                    save();
+                }
             } else {
                 create();
             }
@@ -2918,8 +2941,14 @@ const Chat = ({
         chatMessagesRef.current?.scrollIntoView({ behavior: "instant", block: "end" });
     }
     
-    const appendMessage = (message) => {
-        setMessages(prevMessages => [...prevMessages, message]);
+    const appendMessage = (message, savedByServer = false) => {
+        setMessages(prevMessages => {
+            const newMessages = [...prevMessages, message];
+            if (savedByServer) {
+                messagesSavedByServer.current = newMessages;
+            }
+            return newMessages;
+        });
         if (!chatOpen) { setChatOpen(Date.now()) };
         if (!isScrolledOffBottom()) {
             setTimeout(() => {
@@ -3146,7 +3175,7 @@ const Chat = ({
         }
     }
 
-    const closeChatStream = (message) => {
+    const closeChatStream = (message, savedByServer = false) => {
         let chatResponse = streamingChatResponseRef.current;
         if (message) {
             chatResponse += "\n\n" + message;
@@ -3154,13 +3183,30 @@ const Chat = ({
         streamingChatResponseRef.current = "";
         setStreamingChatResponse("");
         if (chatResponse !== "") {
-            appendMessage({"role": "assistant", "content": chatResponse});
+            appendMessage({"role": "assistant", "content": chatResponse}, savedByServer);
         }
         showReady();
     }
 
+    const cancelChatStream = (streamId) => {
+        // stop the server streaming the rest of the response, and saving it in the chat document
+        const url = `${serverUrl}/chat/v2/cancel`;
+        axios.post(url, {stream_id: streamId}, {
+            headers: {
+                Authorization: 'Bearer ' + token
+            }
+        }).catch(error => {
+            system.error(`System Error cancelling chat stream`, error, url + " POST");
+        });
+    }
+
     const getChatStream = useCallback(async (requestData) => {
             debugMode && console.log("debugMode getChatStream requestData", requestData);
+            // the server saves the response in the chat document once the stream has started
+            const savedByServer = !!requestData.document_id;
+            // sent with the request so the stream can be cancelled before the response arrives
+            requestData.stream_id = uuidv4();
+            chatStreamRef.current = {streamId: requestData.stream_id, reader: null};
             try {
                 const url = `${serverUrl}/chat/v2`;
                 const request = {
@@ -3176,6 +3222,8 @@ const Chat = ({
                 const response = await fetch(url , request);
                 if (response.status !== 200) {
                     system.error(`System Error reading chat stream: ${response.status} ${response?.reason}`, response, "/chat/v2 POST");
+                    // the stream did not start, so the server has not saved the prompt
+                    savedByServer && setSaveRequested(Date.now());
                     showReady();
                     return;
                 }
@@ -3186,8 +3234,10 @@ const Chat = ({
                 const reader = response.body
                     .pipeThrough(decoder)
                     .getReader();
+                chatStreamRef.current = {streamId: requestData.stream_id, reader: reader};
                 try {
-                    while (!stopStreamingRef.current) {
+                    // read at least once, so a stream stopped before it started is closed with the note
+                    while (true) {
                         var {value, done} = await reader.read();
                         if (value) { 
                             streamingChatResponseRef.current += value;
@@ -3197,9 +3247,10 @@ const Chat = ({
                         }
                         if (done || stopStreamingRef.current) {
                             if (stopStreamingRef.current) { 
-                                closeChatStream("\n\n(Chat stopped by user)")
+                                reader.cancel().catch(() => {});
+                                closeChatStream(CHAT_STOPPED_NOTE, savedByServer)
                             } else {
-                                closeChatStream();
+                                closeChatStream(null, savedByServer);
                             }
                             reader.releaseLock();
                             break;
@@ -3208,7 +3259,7 @@ const Chat = ({
                     stopStreamingRef.current = false;
                 } catch(error) {
                     system.error(`System Error reading chat stream.`, error, "/chat/v2 POST");
-                    closeChatStream("\n\n(Response truncated due to error in chat stream)");
+                    closeChatStream(CHAT_ERROR_NOTE, savedByServer);
                     reader.releaseLock();
                 } finally {
                     showReady();
@@ -3216,7 +3267,10 @@ const Chat = ({
                 }
             } catch (error) {
                 system.error(`System Error reading chat stream.`, error, "/chat/v2 POST");
+                savedByServer && setSaveRequested(Date.now());
                 showReady();
+            } finally {
+                chatStreamRef.current = null;
         }
 
     }, [stopStreamingRef.current]);
@@ -3271,7 +3325,14 @@ const Chat = ({
             name: name,
             persona: myPersona,
         };
-        appendMessage({"role": "user", "content": prompt});
+        // For a chat that has been created, the server appends the prompt and response to the
+        // chat document when the stream ends, so the whole chat is not uploaded after each turn
+        const savedByServer = id !== "" && id !== null && isEditable();
+        if (savedByServer) {
+            requestData.document_id = id;
+            requestData.document_prompt = prompt;
+        }
+        appendMessage({"role": "user", "content": prompt}, savedByServer);
         // add the messages that have not been made invisible as chatHistory but remove the sidekick metadata       
         requestData.chatHistory = messages
             .filter(message => !message?.metadata?.invisibleToAi)
@@ -3342,6 +3403,12 @@ const Chat = ({
 
     const handleStopStreaming = (event) => {
         stopStreamingRef.current = true;
+        const chatStream = chatStreamRef.current;
+        if (chatStream) {
+            cancelChatStream(chatStream.streamId);
+            // end the read in getChatStream now, closing the connection to the server
+            chatStream.reader?.cancel().catch(() => {});
+        }
         // wait a second and then close the chat stream
         setTimeout(() => {
             closeChatStream();